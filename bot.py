@@ -8,25 +8,42 @@ import datetime
 import requests # Нужен для NewsAPI
 import json # Для обработки ответа
 import random
+import secrets
 import base64
-from collections import deque
+import bisect
+import cProfile
+import io
+import pstats
+import contextlib
+import functools
+import hashlib
+import hmac
+import statistics
+import sys
+import threading
+import time
+from collections import deque, OrderedDict
 from flask import Flask, Response
 import hypercorn.config
 from hypercorn.asyncio import serve as hypercorn_async_serve
+from hypercorn.middleware import AsyncioWSGIMiddleware
 import signal
 import pymongo
+from pymongo import AsyncMongoClient
 from pymongo.errors import ConnectionFailure, PyMongoError
+from pymongo import monitoring as mongo_monitoring
 from bson.objectid import ObjectId # <<<--- ВОТ ЭТОТ ИМПОРТ НУЖЕН
 # ... остальные импорты ...
 
 # Импорты для AI.IO.NET (OpenAI библиотека)
-from openai import OpenAI, AsyncOpenAI, BadRequestError
+from openai import OpenAI, AsyncOpenAI, BadRequestError, APITimeoutError, APIConnectionError, APIStatusError, RateLimitError, InternalServerError
 import httpx
 
 # Импорты Telegram
 from telegram import ( # Сгруппируем импорты из telegram
     Update,
     Bot,
+    Message,
     User,
     InlineKeyboardMarkup, # <<<--- НУЖЕН ДЛЯ КНОПОК "ПРАВДА ИЛИ ВЫСЕР"
     InlineKeyboardButton  # <<<--- НУЖЕН ДЛЯ КНОПОК "ПРАВДА ИЛИ ВЫСЕР"
@@ -37,11 +54,15 @@ from telegram.ext import ( # Сгруппируем импорты из telegram
     MessageHandler,
     filters,
     ContextTypes,
+    BaseUpdateProcessor,
+    BaseRateLimiter,
     JobQueue, # Уже есть
     CallbackQueryHandler # <<<--- НУЖЕН ДЛЯ ОБРАБОТКИ НАЖАТИЙ КНОПОК
 )
 import telegram # --->>> ВОТ ЭТА СТРОКА НУЖНА <<<--- (у тебя уже есть)
 
+from cachetools import TTLCache
+from apscheduler.events import EVENT_JOB_SUBMITTED
 from dotenv import load_dotenv
 
 # Загружаем секреты (.env для локального запуска)
@@ -106,6 +127,14 @@ TITS_TITLES_BY_SIZE = {
 TITS_GROWTH_COOLDOWN_SECONDS = 6 * 60 * 60 # 6 часов, как и для писек
 # --->>> КОНЕЦ СИСТЕМЫ <<<---
 
+# --- Логирование ---
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("hypercorn").setLevel(logging.INFO)
+logging.getLogger("openai").setLevel(logging.WARNING)
+logging.getLogger("pymongo").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
 # --- НАСТРОЙКИ ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 IO_NET_API_KEY = os.getenv("IO_NET_API_KEY")
@@ -137,148 +166,1518 @@ if not TELEGRAM_BOT_TOKEN: raise ValueError("НЕ НАЙДЕН TELEGRAM_BOT_TOKE
 if not IO_NET_API_KEY: raise ValueError("НЕ НАЙДЕН IO_NET_API_KEY!")
 if not MONGO_DB_URL: raise ValueError("НЕ НАЙДЕНА MONGO_DB_URL!")
 
-# --- Логирование ---
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("hypercorn").setLevel(logging.INFO)
-logging.getLogger("openai").setLevel(logging.WARNING)
-logging.getLogger("pymongo").setLevel(logging.WARNING)
-logger = logging.getLogger(__name__)
+# --->>> ИНДЕКСЫ MONGODB (ВСЕ В ОДНОМ МЕСТЕ) <<<---
+# Коллекция: [(ключи, опции)]. Создаются на старте через ensure_indexes(), повторный create_index - no-op.
+TRUTH_OR_SHIT_GAME_TTL_SECONDS = 7 * 24 * 60 * 60 # 7 дней, потом старые игры "Правда или Высер" удаляются сами
+MONGO_INDEXES = {
+    # История: /analyze (чат по времени), генерация ника (юзер по времени), roast/praise/pickup/ответы (юзер в чате по времени)
+    "message_history": [
+        ([("chat_id", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], {"name": "chat_ts"}),
+        ([("user_id", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], {"name": "user_ts"}),
+        ([("chat_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], {"name": "chat_user_ts"}),
+        ([("chat_id", pymongo.ASCENDING), ("message_id", pymongo.ASCENDING)], {"name": "chat_msg"}), # Водяной знак сводки чата
+    ],
+    "last_replies": [
+        ([("chat_id", pymongo.ASCENDING)], {}),
+    ],
+    "chat_activity": [
+        ([("chat_id", pymongo.ASCENDING)], {"unique": True}),
+        ([("last_message_time", pymongo.DESCENDING)], {}), # Поиск неактивных чатов и /listchats
+    ],
+    "user_profiles": [
+        ([("user_id", pymongo.ASCENDING)], {"unique": True}),
+    ],
+    "penis_stats_by_chat": [
+        ([("chat_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)], {"unique": True}), # Уникальная связка юзер-чат
+        ([("chat_id", pymongo.ASCENDING), ("penis_size", pymongo.DESCENDING)], {}), # Для топа по чату
+    ],
+    "tits_stats_by_chat": [
+        ([("chat_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)], {"unique": True}),
+        ([("chat_id", pymongo.ASCENDING), ("tits_size", pymongo.DESCENDING)], {}), # По tits_size
+    ],
+    # Важно: TTL на created_at удаляет ВСЕ старые игры, даже нераскрытые. Для автоочистки мусора этого хватает.
+    "truth_or_shit_games": [
+        ([("chat_id", pymongo.ASCENDING), ("message_id_question", pymongo.ASCENDING)], {"unique": True}), # Уникальная игра по чату и ID сообщения
+        ([("chat_id", pymongo.ASCENDING), ("revealed", pymongo.ASCENDING)], {}), # Для поиска активных игр
+        ([("created_at", pymongo.ASCENDING)], {"expireAfterSeconds": TRUTH_OR_SHIT_GAME_TTL_SECONDS}),
+    ],
+    "tos_battles": [
+        ([("chat_id", pymongo.ASCENDING), ("status", pymongo.ASCENDING)], {}), # Для поиска активных/набирающихся игр
+        ([("chat_id", pymongo.ASCENDING), ("game_id", pymongo.ASCENDING)], {}), # Кнопки и джобы ищут игру по game_id
+        ([("created_at", pymongo.ASCENDING)], {"expireAfterSeconds": 24 * 60 * 60}), # Удалять очень старые игры (1 день)
+    ],
+    "chat_summaries": [
+        ([("chat_id", pymongo.ASCENDING)], {"unique": True}),
+    ],
+    "tos_statement_pool": [
+        ([("text_hash", pymongo.ASCENDING)], {"unique": True}), # Дедуп по нормализованному тексту
+        ([("is_truth", pymongo.ASCENDING), ("used_at", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)], {"name": "pool_draw"}),
+    ],
+}
+
+# Горячие запросы бота: (название, коллекция, фильтр, сортировка, лимит). Значения фильтров - заглушки, нам важен только план.
+MONGO_HOT_QUERIES = [
+    ("analyze_chat: история чата", "message_history", {"chat_id": 0}, [("timestamp", pymongo.DESCENDING)], MAX_MESSAGES_TO_ANALYZE),
+    ("generate_and_set_nickname: история юзера", "message_history", {"user_id": 0}, [("timestamp", pymongo.DESCENDING)], 50),
+    ("roast/praise/pickup/reply: юзер в чате", "message_history", {"chat_id": 0, "user_id": 0}, [("timestamp", pymongo.DESCENDING)], 20),
+    ("update_history_with_new_name", "message_history", {"user_id": 0}, None, 0),
+    ("retry_analysis: последний ответ", "last_replies", {"chat_id": 0}, None, 1),
+    ("chat_activity по chat_id", "chat_activity", {"chat_id": 0}, None, 1),
+    ("check_inactivity_and_shitpost", "chat_activity", {"last_message_time": {"$lt": datetime.datetime(2000, 1, 1)}, "last_bot_shitpost_time": {"$lt": datetime.datetime(2000, 1, 1)}}, None, 0),
+    ("list_bot_chats", "chat_activity", {}, [("last_message_time", pymongo.DESCENDING)], 0),
+    ("профиль юзера", "user_profiles", {"user_id": 0}, None, 1),
+    ("писька юзера в чате", "penis_stats_by_chat", {"chat_id": 0, "user_id": 0}, None, 1),
+    ("топ писек", "penis_stats_by_chat", {"chat_id": 0, "penis_size": {"$gt": 0}}, [("penis_size", pymongo.DESCENDING)], 10),
+    ("сиськи юзера в чате", "tits_stats_by_chat", {"chat_id": 0, "user_id": 0}, None, 1),
+    ("топ сисек", "tits_stats_by_chat", {"chat_id": 0, "tits_size": {"$gte": 0}}, [("tits_size", pymongo.DESCENDING)], 10),
+    ("активная игра ПиВ", "truth_or_shit_games", {"chat_id": 0, "revealed": False}, None, 1),
+    ("игра ПиВ по сообщению", "truth_or_shit_games", {"chat_id": 0, "message_id_question": 0, "revealed": False}, None, 1),
+    ("активный баттл в чате", "tos_battles", {"chat_id": 0, "status": {"$in": ["recruiting", "playing"]}}, None, 1),
+    ("баттл по game_id", "tos_battles", {"chat_id": 0, "game_id": 0, "status": "recruiting"}, None, 1),
+    ("сводка чата", "chat_summaries", {"chat_id": 0}, None, 1),
+    ("сворачивание сводки: новые сообщения", "message_history", {"chat_id": 0, "message_id": {"$gt": 0}}, [("message_id", pymongo.DESCENDING)], 340),
+    ("выборка из пула утверждений", "tos_statement_pool", {"is_truth": True, "used_at": None}, [("created_at", pymongo.ASCENDING)], 1),
+]
+
+def ensure_indexes(database) -> None:
+    """Создает все индексы из MONGO_INDEXES (уже существующие Монга просто пропускает)."""
+    for collection_name, index_specs in MONGO_INDEXES.items():
+        for keys, options in index_specs:
+            database[collection_name].create_index(keys, **options)
+        logger.info(f"Индексы коллекции {collection_name} готовы ({len(index_specs)} шт.).")
+
+def _collect_plan_field(plan, field: str) -> list:
+    """Рекурсивно собирает значения поля (stage, indexName) из плана explain() - формат у разных версий Монги разный, поэтому обходим всё."""
+    values = []
+    if isinstance(plan, dict):
+        if field in plan: values.append(plan[field])
+        for value in plan.values(): values.extend(_collect_plan_field(value, field))
+    elif isinstance(plan, list):
+        for value in plan: values.extend(_collect_plan_field(value, field))
+    return values
+
+def audit_hot_queries(database) -> list[dict]:
+    """Прогоняет explain() по всем горячим запросам и возвращает отчет: какой индекс выбран и нет ли COLLSCAN."""
+    report = []
+    for query_name, collection_name, query_filter, sort_order, limit in MONGO_HOT_QUERIES:
+        entry = {"name": query_name, "collection": collection_name, "stages": [], "indexes": [], "ok": False, "error": None}
+        try:
+            cursor = database[collection_name].find(query_filter)
+            if sort_order: cursor = cursor.sort(sort_order)
+            if limit: cursor = cursor.limit(limit)
+            winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+            entry["stages"] = _collect_plan_field(winning_plan, "stage")
+            entry["indexes"] = sorted(set(_collect_plan_field(winning_plan, "indexName")))
+            entry["ok"] = "COLLSCAN" not in entry["stages"]
+        except Exception as e:
+            entry["error"] = f"{type(e).__name__}: {e}"
+        report.append(entry)
+    return report
+
+def log_index_audit(report: list[dict]) -> None:
+    """Пишет результат аудита в лог: COLLSCAN и ошибки - громко, остальное - тихо."""
+    for entry in report:
+        if entry["error"]:
+            logger.warning(f"Аудит индексов: explain для '{entry['name']}' ({entry['collection']}) не удался: {entry['error']}")
+        elif not entry["ok"]:
+            logger.error(f"Аудит индексов: '{entry['name']}' ({entry['collection']}) идет через COLLSCAN! План: {' -> '.join(entry['stages'])}")
+        else:
+            logger.info(f"Аудит индексов: '{entry['name']}' OK ({' -> '.join(entry['stages'])}; индексы: {', '.join(entry['indexes']) or '_id/пусто'})")
+    bad_count = sum(1 for entry in report if not entry["ok"])
+    if bad_count: logger.warning(f"Аудит индексов: {bad_count} из {len(report)} горячих запросов без индекса или с ошибкой.")
+    else: logger.info(f"Аудит индексов: все {len(report)} горячих запросов идут по индексам.")
+# --->>> КОНЕЦ ИНДЕКСОВ <<<---
+
+# --- НАСТРОЙКИ ПУЛА СОЕДИНЕНИЙ MONGODB ---
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))          # Максимум соединений в пуле
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))            # Сколько держать прогретыми
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")) # Закрывать простаивающие через 5 минут
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000")) # Сколько ждать свободное соединение
+
+# --->>> МЕТРИКИ ДЛЯ PROMETHEUS (/metrics) <<<---
+# Свой мини-реестр вместо prometheus_client: счетчики и гистограммы в памяти, наружу - текстовый формат Prometheus.
+# Пишет луп бота (и синхронный pymongo), читает поток Flask - поэтому всё под замком.
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRIC_DEFINITIONS = {
+    "bot_handler_duration_seconds": ("histogram", "Время работы хендлера Telegram"),
+    "bot_handler_errors_total": ("counter", "Исключения, вылетевшие из хендлера"),
+    "mongo_command_duration_seconds": ("histogram", "Время команд MongoDB по коллекциям"),
+    "llm_request_duration_seconds": ("histogram", "Латентность запросов к ИИ по моделям"),
+    "llm_tokens_total": ("counter", "Токены, потраченные в запросах к ИИ"),
+    "llm_errors_total": ("counter", "Ошибки запросов к ИИ по моделям"),
+    "bot_job_lag_seconds": ("histogram", "Опоздание запуска джоб JobQueue относительно расписания"),
+    "bot_event_loop_lag_seconds": ("histogram", "Насколько позже положенного просыпается event loop"),
+    "bot_webhook_requests_total": ("counter", "POST-запросы Телеги на вебхук по исходу"),
+    "telegram_outbound_wait_seconds": ("histogram", "Сколько исходящий запрос к Bot API ждал жетона (только те, что ждали)"),
+    "telegram_retry_after_total": ("counter", "Ответы RetryAfter (флуд-контроль) от Bot API по методам"),
+}
+EVENT_LOOP_LAG_SAMPLE_INTERVAL_SECONDS = 0.5
+EVENT_LOOP_LAG_WARN_SECONDS = float(os.getenv("EVENT_LOOP_LAG_WARN_SECONDS", "0.5")) # Лаг больше - пишем в лог, кто был в работе
+EVENT_LOOP_LAG_WARN_COOLDOWN_SECONDS = 10
+
+_metrics_lock = threading.Lock()
+_metric_series: dict[str, dict[tuple, object]] = {name: {} for name in METRIC_DEFINITIONS}
+event_loop_lag_state = {"last": 0.0, "max": 0.0, "warned_at": 0.0}
+handlers_in_flight: dict[str, int] = {} # Какие хендлеры сейчас выполняются - подозреваемые, если луп завис
+mongo_health_state = {"last_ok": None, "last_error": None, "last_error_text": None} # time.monotonic() последних команд (для /healthz)
+
+def metric_inc(name: str, labels: dict | None = None, value: float = 1.0) -> None:
+    key = tuple(sorted(labels.items())) if labels else ()
+    with _metrics_lock:
+        series = _metric_series[name]
+        series[key] = series.get(key, 0.0) + value
+
+def metric_observe(name: str, value: float, labels: dict | None = None) -> None:
+    key = tuple(sorted(labels.items())) if labels else ()
+    with _metrics_lock:
+        histogram = _metric_series[name].get(key)
+        if histogram is None: # [счетчики по корзинам (последняя - +Inf), сумма, количество]
+            histogram = _metric_series[name][key] = [[0] * (len(METRICS_LATENCY_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(METRICS_LATENCY_BUCKETS, value)] += 1
+        histogram[1] += value; histogram[2] += 1
+
+def _format_metric_labels(pairs) -> str:
+    if not pairs: return ""
+    escaped = []
+    for label, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        escaped.append(f'{label}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def render_metrics(gauges: list[tuple[str, str, list[tuple[dict, float]]]] = ()) -> str:
+    """Весь реестр + переданные gauge'и (имя, описание, [(метки, значение)]) в текстовом формате Prometheus."""
+    lines = []
+    with _metrics_lock:
+        for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}"); lines.append(f"# TYPE {name} {metric_type}")
+            for key, value in _metric_series[name].items():
+                if metric_type == "counter":
+                    lines.append(f"{name}{_format_metric_labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRICS_LATENCY_BUCKETS + ("+Inf",), value[0]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_metric_labels(key + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_metric_labels(key)} {value[1]}")
+                lines.append(f"{name}_count{_format_metric_labels(key)} {value[2]}")
+    for name, help_text, samples in gauges:
+        lines.append(f"# HELP {name} {help_text}"); lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_metric_labels(tuple(sorted(labels.items())))} {value}")
+    return "\n".join(lines) + "\n"
+
+class MongoMetricsListener(mongo_monitoring.CommandListener):
+    """Слушатель команд pymongo: время и количество команд по коллекциям в mongo_command_duration_seconds."""
+    def __init__(self):
+        self._collections = {} # (connection_id, request_id) -> коллекция из started
+
+    def started(self, event):
+        collection = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else "-"
+
+    def succeeded(self, event): self._record(event, "ok")
+    def failed(self, event): self._record(event, "error")
+
+    def _record(self, event, outcome: str) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), "-")
+        if outcome == "ok": mongo_health_state["last_ok"] = time.monotonic()
+        else: mongo_health_state["last_error"] = time.monotonic(); mongo_health_state["last_error_text"] = f"{event.command_name}: {getattr(event, 'failure', '')}"[:200]
+        metric_observe("mongo_command_duration_seconds", event.duration_micros / 1_000_000,
+                       {"collection": collection, "command": event.command_name, "outcome": outcome})
+
+mongo_metrics_listener = MongoMetricsListener()
+
+def _timed_handler(callback):
+    """Оборачивает callback хендлера: время в bot_handler_duration_seconds, исключения в bot_handler_errors_total."""
+    handler_name = getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        handlers_in_flight[handler_name] = handlers_in_flight.get(handler_name, 0) + 1
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            metric_inc("bot_handler_errors_total", {"handler": handler_name, "error": type(e).__name__})
+            raise
+        finally:
+            handlers_in_flight[handler_name] -= 1
+            if not handlers_in_flight[handler_name]: del handlers_in_flight[handler_name]
+            metric_observe("bot_handler_duration_seconds", time.perf_counter() - started, {"handler": handler_name})
+    return wrapper
+
+def instrument_handlers(application: Application) -> None:
+    """Вешает замер времени на все уже добавленные хендлеры (вызывать в main после add_handler)."""
+    count = 0
+    for group_handlers in application.handlers.values():
+        for handler in group_handlers:
+            handler.callback = _timed_handler(handler.callback); count += 1
+    logger.info(f"Метрики: обернуто {count} хендлеров.")
+
+def instrument_job_queue(job_queue) -> None:
+    """Считает опоздание джоб: APScheduler сообщает о передаче джобы исполнителю вместе с плановым временем."""
+    scheduler = job_queue.scheduler
+
+    def on_job_submitted(event) -> None:
+        aps_job = scheduler.get_job(event.job_id)
+        ptb_job = aps_job.args[-1] if aps_job and aps_job.args else None # PTB кладет свой Job последним аргументом
+        job_name = getattr(getattr(ptb_job, "callback", None), "__name__", "unknown")
+        now_utc = datetime.datetime.now(datetime.timezone.utc)
+        for run_time in event.scheduled_run_times:
+            metric_observe("bot_job_lag_seconds", max(0.0, (now_utc - run_time).total_seconds()), {"job": job_name})
+
+    scheduler.add_listener(on_job_submitted, EVENT_JOB_SUBMITTED)
+
+async def event_loop_lag_sampler() -> None:
+    """Фоновая задача: спит фиксированный интервал и меряет, насколько позже проснулась. Это и есть лаг лупа."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + EVENT_LOOP_LAG_SAMPLE_INTERVAL_SECONDS
+        await asyncio.sleep(EVENT_LOOP_LAG_SAMPLE_INTERVAL_SECONDS)
+        lag = max(0.0, loop.time() - expected)
+        event_loop_lag_state["last"] = lag; event_loop_lag_state["max"] = max(event_loop_lag_state["max"], lag)
+        metric_observe("bot_event_loop_lag_seconds", lag)
+        if lag > EVENT_LOOP_LAG_WARN_SECONDS and loop.time() - event_loop_lag_state["warned_at"] > EVENT_LOOP_LAG_WARN_COOLDOWN_SECONDS:
+            event_loop_lag_state["warned_at"] = loop.time()
+            suspects = ", ".join(f"{name}×{count}" for name, count in handlers_in_flight.items()) or "хендлеров нет (джобы/фон?)"
+            logger.warning(f"Луп завис на {lag:.2f}с! В работе: {suspects}")
+# --->>> КОНЕЦ МЕТРИК <<<---
 
 # --- ПОДКЛЮЧЕНИЕ К MONGODB ATLAS ---
+# Два клиента: синхронный (db) - только для старта (пинг, индексы, аудит) и синхронного Flask,
+# асинхронный (async_db) - для всех хендлеров, без run_in_executor и без блокировки лупа на курсорах.
+# Сами клиенты подключаются лениво - при импорте в сеть не ходим. Пинг, индексы и аудит - connect_mongo() на старте.
 try:
-    mongo_client = pymongo.MongoClient(MONGO_DB_URL, serverSelectionTimeoutMS=5000)
-    mongo_client.admin.command('ping')
-    logger.info("Успешное подключение к MongoDB Atlas!")
+    mongo_client = pymongo.MongoClient(MONGO_DB_URL, serverSelectionTimeoutMS=5000, event_listeners=[mongo_metrics_listener])
     db = mongo_client['popizdyaka_db']
-    history_collection = db['message_history']
-    last_reply_collection = db['last_replies']
-    chat_activity_collection = db['chat_activity']
-    chat_activity_collection.create_index("chat_id", unique=True)
-    user_profiles_collection = db['user_profiles']
-    user_profiles_collection.create_index("user_id", unique=True)
+
+    async_mongo_client = AsyncMongoClient(
+        MONGO_DB_URL, serverSelectionTimeoutMS=5000,
+        maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS, waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=[mongo_metrics_listener] # Время команд по коллекциям для /metrics
+    )
+    async_db = async_mongo_client['popizdyaka_db']
+    logger.info(f"Клиенты MongoDB настроены (асинхронный пул {MONGO_MIN_POOL_SIZE}-{MONGO_MAX_POOL_SIZE}).")
+    history_collection = async_db['message_history']
+    last_reply_collection = async_db['last_replies']
+    chat_activity_collection = async_db['chat_activity']
+    user_profiles_collection = async_db['user_profiles']
     # --->>> НОВАЯ КОЛЛЕКЦИЯ ДЛЯ ПИСЕК ПО ЧАТАМ <<<---
-    penis_stats_collection = db['penis_stats_by_chat']
-    # Индексы для быстрого поиска и сортировки
-    penis_stats_collection.create_index([("chat_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)], unique=True) # Уникальная связка юзер-чат
-    penis_stats_collection.create_index([("chat_id", pymongo.ASCENDING), ("penis_size", pymongo.DESCENDING)]) # Для топа по чату
-    logger.info("Коллекция penis_stats_by_chat готова.")
-# --->>> КОНЕЦ <<<---
-    tits_stats_collection = db['tits_stats_by_chat']
-            # Индексы
-    tits_stats_collection.create_index([("chat_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)], unique=True)
-    tits_stats_collection.create_index([("chat_id", pymongo.ASCENDING), ("tits_size", pymongo.DESCENDING)]) # По tits_size
-    logger.info("Коллекция tits_stats_by_chat готова.")
-
-# --->>> НОВАЯ КОЛЛЕКЦИЯ ДЛЯ ИГР "ПРАВДА ИЛИ ВЫСЕР" <<<---
-    active_truth_or_shit_games_collection = db['truth_or_shit_games'] # Изменил имя для ясности
-    active_truth_or_shit_games_collection.create_index([("chat_id", pymongo.ASCENDING), ("message_id_question", pymongo.ASCENDING)], unique=True) # Уникальная игра по чату и ID сообщения
-    active_truth_or_shit_games_collection.create_index([("chat_id", pymongo.ASCENDING), ("revealed", pymongo.ASCENDING)]) # Для поиска активных игр
-    # TTL индекс для автоматического удаления СТАРЫХ РАСКРЫТЫХ или ОЧЕНЬ СТАРЫХ НЕРАСКРЫТЫХ игр (например, через 3 дня)
-# Чтобы не хранить мусор вечно. Время в секундах.
-# Важно: expires_at должно быть полем типа datetime.datetime
-# Мы не будем его явно ставить, MongoDB будет использовать текущее время + expireAfterSeconds для документов без этого поля,
-# если бы мы его добавили. Но лучше использовать created_at и чистить старые игры другим механизмом,
-# либо ставить expires_at явно при раскрытии игры.
-# Для простоты, пока оставим TTL на 'created_at', но он удалит ВСЕ старые игры, даже нераскрытые.
-# Более правильно: добавить поле 'game_over_at' и TTL на него, или чистить периодически.
-# Пока сделаем TTL на created_at для автоочистки очень старых игр (например, 7 дней).
-    TRUTH_OR_SHIT_GAME_TTL_SECONDS = 7 * 24 * 60 * 60 # 7 дней
-    active_truth_or_shit_games_collection.create_index("created_at", expireAfterSeconds=TRUTH_OR_SHIT_GAME_TTL_SECONDS)
-    logger.info("Коллекция truth_or_shit_games готова.")
-# --->>> КОНЕЦ НОВОЙ КОЛЛЕКЦИИ <<<---
-
-# НОВАЯ КОЛЛЕКЦИЯ ДЛЯ БАТТЛОВ
-    tos_battles_collection = db['tos_battles']
-    tos_battles_collection.create_index([("chat_id", pymongo.ASCENDING), ("status", pymongo.ASCENDING)]) # Для поиска активных/набирающихся игр
-    tos_battles_collection.create_index("created_at", expireAfterSeconds=24 * 60 * 60) # Удалять очень старые игры (1 день)
-    logger.info("Коллекция tos_battles готова.")
+    penis_stats_collection = async_db['penis_stats_by_chat']
+    tits_stats_collection = async_db['tits_stats_by_chat']
+    # --->>> НОВАЯ КОЛЛЕКЦИЯ ДЛЯ ИГР "ПРАВДА ИЛИ ВЫСЕР" <<<---
+    active_truth_or_shit_games_collection = async_db['truth_or_shit_games'] # Изменил имя для ясности
+    # НОВАЯ КОЛЛЕКЦИЯ ДЛЯ БАТТЛОВ
+    tos_battles_collection = async_db['tos_battles']
+    tos_statement_pool_collection = async_db['tos_statement_pool'] # Заготовленные утверждения для ПиВ и баттлов
+    chat_summaries_collection = async_db['chat_summaries'] # Скользящие сводки чатов для /analyze
+    bot_status_collection = async_db['bot_status']
+    logger.info("Коллекции MongoDB готовы.")
+except Exception as e:
+    logger.critical(f"ПИЗДЕЦ при настройке MongoDB: {e}", exc_info=True)
+    raise SystemExit(f"Ошибка настройки MongoDB: {e}")
 
 # Константы для Баттла
-    TOS_BATTLE_RECRUITMENT_DURATION_SECONDS = 60  # 1 минута на набор по умолчанию
-    TOS_BATTLE_RECRUITMENT_EXTENSION_SECONDS = 30 # На сколько хост может продлить
-    TOS_BATTLE_MIN_PARTICIPANTS = 2 # Минимально для старта
-    TOS_BATTLE_MAX_PARTICIPANTS = 20 # Максимально (чтобы не перегружать)
-    TOS_BATTLE_NUM_QUESTIONS = 10
-    TOS_BATTLE_COOLDOWN_SECONDS = 5 * 60 # Кулдаун на запуск нового баттла в чате
+TOS_BATTLE_RECRUITMENT_DURATION_SECONDS = 60  # 1 минута на набор по умолчанию
+TOS_BATTLE_RECRUITMENT_EXTENSION_SECONDS = 30 # На сколько хост может продлить
+TOS_BATTLE_MIN_PARTICIPANTS = 2 # Минимально для старта
+TOS_BATTLE_MAX_PARTICIPANTS = 20 # Максимально (чтобы не перегружать)
+TOS_BATTLE_NUM_QUESTIONS = 10
+TOS_BATTLE_QUESTION_GEN_CONCURRENCY = int(os.getenv("TOS_BATTLE_QUESTION_GEN_CONCURRENCY", "3")) # Сколько вопросов генерим параллельно
+TOS_BATTLE_QUESTION_WAIT_SECONDS = 120 # Сколько максимум ждем догенерации следующего вопроса между раундами
+TOS_BATTLE_COOLDOWN_SECONDS = 5 * 60 # Кулдаун на запуск нового баттла в чате
 
 # Призы
-    TOS_BATTLE_PENIS_REWARD_CM = 5
-    TOS_BATTLE_TITS_REWARD_SIZE = 0.2
+TOS_BATTLE_PENIS_REWARD_CM = 5
+TOS_BATTLE_TITS_REWARD_SIZE = 0.2
 
-    logger.info("Коллекция user_profiles готова.")
-    logger.info("Коллекции MongoDB готовы.")
-    bot_status_collection = db['bot_status']
-    logger.info("Коллекция bot_status готова.")
-except Exception as e:
-    logger.critical(f"ПИЗДЕЦ при настройке MongoDB: {e}", exc_info=True)
-    raise SystemExit(f"Ошибка настройки MongoDB: {e}")
+def connect_mongo() -> None:
+    """Старт: пинг, индексы из MONGO_INDEXES и аудит горячих запросов (explain, ищем COLLSCAN). Не вышло - выходим."""
+    try:
+        mongo_client.admin.command('ping')
+        logger.info("Успешное подключение к MongoDB Atlas!")
+        ensure_indexes(db) # Все индексы объявлены в MONGO_INDEXES выше
+    except Exception as e:
+        logger.critical(f"ПИЗДЕЦ при подключении к MongoDB: {e}", exc_info=True)
+        raise SystemExit(f"Ошибка подключения к MongoDB: {e}")
+    if os.getenv("MONGO_INDEX_AUDIT_ON_BOOT", "1") == "1":
+        try: log_index_audit(audit_hot_queries(db))
+        except Exception as e: logger.error(f"Аудит индексов на старте не удался: {e}", exc_info=True)
 
 # --- НАСТРОЙКА КЛИЕНТА AI.IO.NET API ---
+# Один общий httpx-клиент с HTTP/2 и постоянным пулом: TLS-рукопожатие платим один раз, а не на каждый запрос.
+IONET_BASE_URL = "https://api.intelligence.io.solutions/api/v1/" # ПРОВЕРЕННЫЙ URL!
+IONET_HTTP_MAX_CONNECTIONS = int(os.getenv("IONET_HTTP_MAX_CONNECTIONS", "20"))
+IONET_HTTP_MAX_KEEPALIVE = int(os.getenv("IONET_HTTP_MAX_KEEPALIVE", "10"))
+IONET_HTTP_KEEPALIVE_EXPIRY_SECONDS = 120.0
+IONET_CONNECT_TIMEOUT_SECONDS = float(os.getenv("IONET_CONNECT_TIMEOUT_SECONDS", "5"))
+# Таймаут чтения по фичам: хроника и фоновые сводки думают дольше, чем ответ на реплай
+LLM_READ_TIMEOUTS_BY_FEATURE = {
+    "default": 60.0,
+    "analyze": 120.0,
+    "vision": 90.0,
+    "background": 120.0,
+    "reply": 30.0,
+}
+
+def ionet_timeout(feature: str | None) -> httpx.Timeout:
+    read_timeout = LLM_READ_TIMEOUTS_BY_FEATURE.get(feature or "default", LLM_READ_TIMEOUTS_BY_FEATURE["default"])
+    return httpx.Timeout(connect=IONET_CONNECT_TIMEOUT_SECONDS, read=read_timeout, write=30.0, pool=10.0)
+
+def build_ionet_http_client(http2: bool = True) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(max_connections=IONET_HTTP_MAX_CONNECTIONS, max_keepalive_connections=IONET_HTTP_MAX_KEEPALIVE,
+                            keepalive_expiry=IONET_HTTP_KEEPALIVE_EXPIRY_SECONDS),
+        timeout=ionet_timeout(None),
+    )
+
 try:
+    ionet_http_client = build_ionet_http_client()
     ionet_client = AsyncOpenAI(
         api_key=IO_NET_API_KEY,
-        base_url="https://api.intelligence.io.solutions/api/v1/" # ПРОВЕРЕННЫЙ URL!
+        base_url=IONET_BASE_URL,
+        http_client=ionet_http_client,
+        max_retries=0 # Ретраим сами (_ionet_create_with_retries), с джиттером и предохранителем
     )
-    logger.info("Клиент AsyncOpenAI для ai.io.net API настроен.")
+    logger.info(f"Клиент AsyncOpenAI для ai.io.net API настроен (HTTP/2, пул {IONET_HTTP_MAX_CONNECTIONS}/{IONET_HTTP_MAX_KEEPALIVE} keep-alive).")
 except Exception as e:
      logger.critical(f"ПИЗДЕЦ при настройке клиента ai.io.net: {e}", exc_info=True)
      raise SystemExit(f"Не удалось настроить клиента ai.io.net: {e}")
 
+# Пул соединений PTB к Bot API (у него свой HTTPXRequest, наш httpx-клиент он не берет)
+TELEGRAM_HTTP_POOL_SIZE = int(os.getenv("TELEGRAM_HTTP_POOL_SIZE", "32"))
+
+async def warm_up_ionet_connection() -> None:
+    """Прогревает соединение с ai.io.net на старте, чтобы первый юзер не платил за TLS. Заодно сверяет реестр моделей."""
+    started = time.perf_counter()
+    try:
+        models_page = await ionet_client.models.list(timeout=ionet_timeout("reply"))
+        logger.info(f"Соединение с ai.io.net прогрето за {(time.perf_counter() - started) * 1000:.0f} мс.")
+    except Exception as e:
+        logger.warning(f"Прогрев ai.io.net не удался ({type(e).__name__}: {e}), первый запрос откроет соединение сам.")
+        return
+    prune_model_registry({model.id for model in models_page.data})
+
 # --- ВЫБОР МОДЕЛЕЙ AI.IO.NET (ПРОВЕРЬ ДОСТУПНОСТЬ!) ---
 IONET_TEXT_MODEL_ID = "mistralai/Mistral-Large-Instruct-2411" # Твоя модель для текста
 IONET_VISION_MODEL_ID = "Qwen/Qwen2-VL-7B-Instruct" # Для картинок
-logger.info(f"Текстовая модель ai.io.net: {IONET_TEXT_MODEL_ID}")
+IONET_SMALL_TEXT_MODEL_ID = os.getenv("IONET_SMALL_TEXT_MODEL_ID", "mistralai/Ministral-8B-Instruct-2410") # Быстрая для коротких хохм
+logger.info(f"Текстовая модель ai.io.net: {IONET_TEXT_MODEL_ID} (мелкая: {IONET_SMALL_TEXT_MODEL_ID})")
 logger.info(f"Vision модель ai.io.net: {IONET_VISION_MODEL_ID}")
 
+# --->>> СБОРЩИК КОНТЕКСТА ПОД БЮДЖЕТ ТОКЕНОВ <<<---
+# История уходит в промпт не целиком, а сколько влезет в бюджет модели (свежие сообщения в приоритете).
+# Токенайзера Mistral/Qwen локально нет - считаем грубой оценкой: слово ~ 1 токен на 4 латинских / 3 кириллических символа.
+LLM_HISTORY_TOKEN_BUDGETS = {
+    IONET_TEXT_MODEL_ID: int(os.getenv("LLM_HISTORY_TOKEN_BUDGET", "6000")),
+    IONET_VISION_MODEL_ID: 1500,
+    IONET_SMALL_TEXT_MODEL_ID: 3000,
+}
+LLM_HISTORY_DEFAULT_TOKEN_BUDGET = 4000
+LLM_MAX_TOKENS_PER_HISTORY_MESSAGE = 250 # Простыни режем, чтобы одна паста не съела весь бюджет
+_TOKEN_ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_PLACEHOLDER_PATTERN = re.compile(r"^\[(СТИКЕР|КАРТИНКА|ОТПРАВИЛ\(А\) ВИДЕО|ОТПРАВИЛ\(А\) ГОЛОСОВОЕ)[^\]]*\]$")
+context_builder_stats: dict[str, dict] = {} # feature -> сколько токенов сэкономили
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без токенайзера (с запасом в большую сторону)."""
+    tokens = 0
+    for piece in _TOKEN_ESTIMATE_PATTERN.findall(text):
+        if piece.isascii(): tokens += max(1, -(-len(piece) // 4))
+        else: tokens += max(1, -(-len(piece) // 3))
+    return tokens
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст по оценке токенов (по словам), помечая обрезку."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    for match in _TOKEN_ESTIMATE_PATTERN.finditer(text):
+        used += estimate_tokens(match.group(0))
+        if used > max_tokens:
+            return text[:match.start()].rstrip() + "… [обрезано]"
+    return text
+
+def _collapse_placeholder_runs(messages: list[dict]) -> list[dict]:
+    """Подряд идущие стикеры/картинки/голосовые от одного юзера -> одна строка '[СТИКЕР ×5]'. file_id картинок ИИ не нужен."""
+    collapsed: list[dict] = []
+    for msg in messages:
+        text = (msg.get("text") or "").strip()
+        placeholder = _PLACEHOLDER_PATTERN.match(text)
+        if not placeholder:
+            collapsed.append(msg)
+            continue
+        kind = placeholder.group(1)
+        label = text if kind == "СТИКЕР" else f"[{kind}]"
+        previous = collapsed[-1] if collapsed else None
+        if previous and previous.get("_placeholder_kind") == kind and previous.get("user_name") == msg.get("user_name"):
+            previous["_placeholder_count"] += 1
+            previous["text"] = f"[{kind} ×{previous['_placeholder_count']}]"
+        else:
+            collapsed.append({**msg, "text": label, "_placeholder_kind": kind, "_placeholder_count": 1})
+    return collapsed
+
+def build_history_context(messages: list[dict], model_id: str, feature: str,
+                          with_names: bool = True, budget_tokens: int | None = None) -> str:
+    """Склеивает историю (старые -> новые) в текст для промпта, укладываясь в бюджет токенов модели.
+    Идет от свежих к старым, старое, что не влезло, отбрасывает. Экономию пишет в лог и context_builder_stats."""
+    budget = budget_tokens or LLM_HISTORY_TOKEN_BUDGETS.get(model_id, LLM_HISTORY_DEFAULT_TOKEN_BUDGET)
+    raw_tokens = sum(estimate_tokens(f"{msg.get('user_name', '?')}: {msg.get('text') or ''}") for msg in messages)
+
+    kept_lines: list[str] = []
+    used_tokens = 0
+    for msg in reversed(_collapse_placeholder_runs(messages)):
+        text = truncate_to_tokens(msg.get("text") or "", LLM_MAX_TOKENS_PER_HISTORY_MESSAGE)
+        line = f"{msg.get('user_name', '?')}: {text}" if with_names else f"- {text}"
+        line_tokens = estimate_tokens(line)
+        if used_tokens + line_tokens > budget:
+            break
+        kept_lines.append(line); used_tokens += line_tokens
+    kept_lines.reverse()
+
+    saved_tokens = max(0, raw_tokens - used_tokens)
+    stats = context_builder_stats.setdefault(feature, {"calls": 0, "tokens_used": 0, "tokens_saved": 0})
+    stats["calls"] += 1; stats["tokens_used"] += used_tokens; stats["tokens_saved"] += saved_tokens
+    if saved_tokens:
+        logger.info(f"Контекст {feature}: {len(messages)} сообщ. -> {len(kept_lines)} строк, ~{used_tokens} токенов из ~{raw_tokens} (сэкономлено ~{saved_tokens}, бюджет {budget}).")
+    return "\n".join(kept_lines)
+# --->>> КОНЕЦ СБОРЩИКА КОНТЕКСТА <<<---
+
 # --- Хранилище истории в памяти больше не нужно ---
 logger.info(f"Максимальная длина истории для анализа из БД: {MAX_MESSAGES_TO_ANALYZE}")
 
+# --->>> ПЛАНИРОВЩИК ЗАПРОСОВ К ИИ <<<---
+# Все фичи ходят в ai.io.net через один шлюз: приоритетные очереди, общий лимит параллельных запросов,
+# лимит на чат (чтобы один чат с пачкой /roast не сожрал всё) и token bucket против рейт-лимитов провайдера.
+LLM_PRIORITY_INTERACTIVE = 0 # Ответы на реплаи боту - человек ждет прямо сейчас
+LLM_PRIORITY_COMMAND = 1     # Обычные команды (/roast, /analyze, /poem и т.д.)
+LLM_PRIORITY_BACKGROUND = 2  # Фоновый высер по расписанию, подготовка вопросов баттла
+LLM_PRIORITY_NAMES = {LLM_PRIORITY_INTERACTIVE: "interactive", LLM_PRIORITY_COMMAND: "command", LLM_PRIORITY_BACKGROUND: "background"}
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_CONCURRENCY_PER_CHAT = int(os.getenv("LLM_MAX_CONCURRENCY_PER_CHAT", "2"))
+LLM_RATE_PER_SECOND = float(os.getenv("LLM_RATE_PER_SECOND", "2")) # 0 - без ограничения
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "5"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "90"))
+
+llm_waiters: dict[int, deque] = {priority: deque() for priority in LLM_PRIORITY_NAMES}
+llm_active_per_chat: dict = {}
+llm_scheduler_state = {"active": 0, "tokens": float(LLM_RATE_BURST), "refilled_at": time.monotonic(), "wakeup": None}
+llm_scheduler_stats = {
+    name: {"granted": 0, "timeouts": 0, "max_depth": 0, "wait_total": 0.0, "wait_max": 0.0}
+    for name in LLM_PRIORITY_NAMES.values()
+}
+
+def _llm_take_token() -> float:
+    """Берет жетон из ведра. Возвращает 0, если взяли, иначе сколько секунд ждать следующего."""
+    if LLM_RATE_PER_SECOND <= 0:
+        return 0.0
+    now = time.monotonic()
+    state = llm_scheduler_state
+    state["tokens"] = min(float(LLM_RATE_BURST), state["tokens"] + (now - state["refilled_at"]) * LLM_RATE_PER_SECOND)
+    state["refilled_at"] = now
+    if state["tokens"] >= 1.0:
+        state["tokens"] -= 1.0
+        return 0.0
+    return (1.0 - state["tokens"]) / LLM_RATE_PER_SECOND
+
+def _llm_wakeup() -> None:
+    llm_scheduler_state["wakeup"] = None
+    _llm_dispatch()
+
+def _llm_dispatch() -> None:
+    """Раздает свободные слоты ждущим: сначала старший приоритет, внутри - по очереди, пропуская чаты на лимите."""
+    for priority in sorted(llm_waiters):
+        waiters = llm_waiters[priority]
+        for entry in list(waiters):
+            if llm_scheduler_state["active"] >= LLM_MAX_CONCURRENCY:
+                return
+            enqueued_at, chat_id, future = entry
+            if future.done(): # Ждун уже отвалился по таймауту/отмене
+                waiters.remove(entry)
+                continue
+            if chat_id is not None and llm_active_per_chat.get(chat_id, 0) >= LLM_MAX_CONCURRENCY_PER_CHAT:
+                continue
+            token_wait = _llm_take_token()
+            if token_wait > 0:
+                if llm_scheduler_state["wakeup"] is None:
+                    llm_scheduler_state["wakeup"] = asyncio.get_running_loop().call_later(token_wait, _llm_wakeup)
+                return
+            waiters.remove(entry)
+            llm_scheduler_state["active"] += 1
+            if chat_id is not None:
+                llm_active_per_chat[chat_id] = llm_active_per_chat.get(chat_id, 0) + 1
+            waited = time.monotonic() - enqueued_at
+            stats = llm_scheduler_stats[LLM_PRIORITY_NAMES[priority]]
+            stats["granted"] += 1; stats["wait_total"] += waited; stats["wait_max"] = max(stats["wait_max"], waited)
+            future.set_result(waited)
+
+def _llm_release(chat_id: int | None) -> None:
+    llm_scheduler_state["active"] -= 1
+    if chat_id is not None:
+        remaining = llm_active_per_chat.get(chat_id, 1) - 1
+        if remaining > 0: llm_active_per_chat[chat_id] = remaining
+        else: llm_active_per_chat.pop(chat_id, None)
+    _llm_dispatch()
+
+@contextlib.asynccontextmanager
+async def llm_slot(priority: int = LLM_PRIORITY_COMMAND, chat_id: int | None = None):
+    """Ждет своей очереди к ИИ. По таймауту кидает asyncio.TimeoutError."""
+    future = asyncio.get_running_loop().create_future()
+    entry = (time.monotonic(), chat_id, future)
+    waiters = llm_waiters[priority]
+    waiters.append(entry)
+    stats = llm_scheduler_stats[LLM_PRIORITY_NAMES[priority]]
+    stats["max_depth"] = max(stats["max_depth"], len(waiters))
+    _llm_dispatch()
+    try:
+        waited = await asyncio.wait_for(future, LLM_QUEUE_TIMEOUT_SECONDS)
+    except BaseException as e:
+        if future.done() and not future.cancelled():
+            _llm_release(chat_id) # Слот выдали, но нас уже отменили - возвращаем
+        else:
+            try: waiters.remove(entry)
+            except ValueError: pass
+            if isinstance(e, asyncio.TimeoutError): stats["timeouts"] += 1
+        raise
+    if waited > 1.0:
+        logger.info(f"Запрос к ИИ ({LLM_PRIORITY_NAMES[priority]}, чат {chat_id}) простоял в очереди {waited:.1f}с.")
+    try:
+        yield
+    finally:
+        _llm_release(chat_id)
+
+def llm_scheduler_snapshot() -> dict:
+    """Текущее состояние планировщика для /botstats и метрик."""
+    return {
+        "active": llm_scheduler_state["active"],
+        "active_chats": len(llm_active_per_chat),
+        "tokens": round(llm_scheduler_state["tokens"], 2),
+        "queues": {
+            name: {
+                "depth": len(llm_waiters[priority]),
+                **llm_scheduler_stats[name],
+                "wait_avg": (llm_scheduler_stats[name]["wait_total"] / llm_scheduler_stats[name]["granted"]) if llm_scheduler_stats[name]["granted"] else 0.0,
+            }
+            for priority, name in LLM_PRIORITY_NAMES.items()
+        },
+    }
+# --->>> КОНЕЦ ПЛАНИРОВЩИКА <<<---
+
+# --->>> РЕТРАИ, ПРЕДОХРАНИТЕЛЬ И ХЕДЖИРОВАНИЕ ЗАПРОСОВ К ИИ <<<---
+# Ретраим только то, что может пройти со второго раза: таймауты, обрывы, 429 и 5xx. Остальные 4xx - сразу ошибка.
+# Ретраи SDK выключены (max_retries=0), иначе попытки перемножаются.
+LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY_SECONDS = 0.5
+LLM_RETRY_MAX_DELAY_SECONDS = 8.0
+LLM_RETRYABLE_ERRORS = (APITimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+# Предохранитель на модель: после N фейлов подряд не шлем ничего COOLDOWN секунд, потом пропускаем ОДИН пробный запрос,
+# остальные отбиваем, пока проба не вернется (иначе весь накопившийся хвост разом ломится в полуживого провайдера)
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+LLM_BREAKER_PROBE_STALE_SECONDS = LLM_QUEUE_TIMEOUT_SECONDS + 120 # Проба так и не отчиталась (отменили/застряла) - пускаем новую
+LLM_BREAKER_OPEN_TEXT = "🗿 Ошибка API: ИИ сейчас лежит, попробуй через минуту."
+# Хедж: если модель отвечает дольше своего p95, шлем дубль в запасную модель и берем того, кто ответит первым
+LLM_HEDGE_FALLBACK_MODEL_ID = os.getenv("LLM_HEDGE_FALLBACK_MODEL_ID", "") # Пусто - хеджирование выключено
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_HEDGE_MIN_DELAY_SECONDS = 2.0
+
+llm_breakers: dict[str, dict] = {} # model_id -> {"state": closed/open/half_open, "failures", "opened_at", "probe_started_at"}
+llm_latency_samples: dict[str, deque] = {} # model_id -> последние латентности успешных запросов (для p95 хеджа)
+llm_resilience_stats = {"retries": 0, "gave_up": 0, "breaker_opens": 0, "breaker_fast_fails": 0, "hedges": 0, "hedge_wins": 0}
+
+def _llm_breaker_probe_busy(breaker: dict) -> bool:
+    """half_open и пробный запрос еще в полете (и не протух)."""
+    return breaker["state"] == "half_open" and breaker["probe_started_at"] is not None \
+        and time.monotonic() - breaker["probe_started_at"] < LLM_BREAKER_PROBE_STALE_SECONDS
+
+def llm_breaker_allows(model_id: str) -> bool:
+    """Можно ли сейчас слать запрос в модель. После кулдауна пропускает один пробный запрос (half_open), остальных - нет."""
+    breaker = llm_breakers.get(model_id)
+    if not breaker or breaker["state"] == "closed":
+        return True
+    if breaker["state"] == "open" and time.monotonic() - breaker["opened_at"] >= LLM_BREAKER_COOLDOWN_SECONDS:
+        breaker["state"] = "half_open"; breaker["probe_started_at"] = None
+        logger.info(f"Предохранитель {model_id}: кулдаун прошел, пускаю пробный запрос.")
+    if breaker["state"] == "half_open" and not _llm_breaker_probe_busy(breaker):
+        breaker["probe_started_at"] = time.monotonic()
+        return True
+    llm_resilience_stats["breaker_fast_fails"] += 1
+    return False
+
+def _llm_breaker_record(model_id: str, ok: bool, latency: float | None = None, feature: str | None = None) -> None:
+    breaker = llm_breakers.setdefault(model_id, {"state": "closed", "failures": 0, "opened_at": 0.0, "probe_started_at": None})
+    breaker["probe_started_at"] = None # Проба (если была) отчиталась
+    # Фоновые джобы (сводка на 700 токенов, факт) юзер не ждет - их длинные ответы не должны гнать команды в мелкую модель
+    _llm_model_health_record(model_id, ok, latency if feature != "background" else None)
+    if ok:
+        if breaker["state"] != "closed":
+            logger.info(f"Предохранитель {model_id}: модель ожила, закрываю.")
+        breaker["state"] = "closed"; breaker["failures"] = 0
+        if latency is not None:
+            llm_latency_samples.setdefault(model_id, deque(maxlen=200)).append(latency)
+        return
+    breaker["failures"] += 1
+    if breaker["state"] == "half_open" or breaker["failures"] >= LLM_BREAKER_FAILURE_THRESHOLD:
+        if breaker["state"] != "open":
+            llm_resilience_stats["breaker_opens"] += 1
+            logger.warning(f"Предохранитель {model_id} ОТКРЫТ: {breaker['failures']} фейлов подряд, {LLM_BREAKER_COOLDOWN_SECONDS}с не шлем.")
+        breaker["state"] = "open"; breaker["opened_at"] = time.monotonic()
+
+def _llm_retry_delay(attempt: int, error: Exception) -> float:
+    """Экспоненциальная задержка с полным джиттером; Retry-After от провайдера уважаем (в пределах потолка)."""
+    delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if response is not None:
+        try: delay = max(delay, min(float(response.headers.get("retry-after", 0)), LLM_RETRY_MAX_DELAY_SECONDS))
+        except ValueError: pass
+    return delay
+
+async def _ionet_create_with_retries(client: AsyncOpenAI, model_id: str, feature: str | None,
+                                     track_latency: bool = True, **create_kwargs):
+    """chat.completions.create с ретраями временных ошибок. Кормит предохранитель модели; финальную ошибку пробрасывает."""
+    for attempt in range(LLM_RETRY_MAX_ATTEMPTS):
+        started = time.monotonic()
+        try:
+            response = await client.chat.completions.create(model=model_id, timeout=ionet_timeout(feature), **create_kwargs)
+        except LLM_RETRYABLE_ERRORS as e:
+            metric_inc("llm_errors_total", {"model": model_id, "error": type(e).__name__})
+            _llm_breaker_record(model_id, False)
+            if attempt + 1 >= LLM_RETRY_MAX_ATTEMPTS or llm_breakers[model_id]["state"] == "open":
+                llm_resilience_stats["gave_up"] += 1
+                raise
+            delay = _llm_retry_delay(attempt, e)
+            llm_resilience_stats["retries"] += 1
+            logger.warning(f"{model_id} ({feature}): {type(e).__name__}, попытка {attempt + 1}/{LLM_RETRY_MAX_ATTEMPTS}, повтор через {delay:.2f}с.")
+            await asyncio.sleep(delay)
+            continue
+        except Exception as e:
+            metric_inc("llm_errors_total", {"model": model_id, "error": type(e).__name__})
+            if isinstance(e, APIStatusError): # 400/401/404...: не ретраим, но роутер должен знать, что модель не отвечает
+                _llm_model_health_record(model_id, False, None)
+                breaker = llm_breakers.get(model_id)
+                if breaker: breaker["probe_started_at"] = None # Проба отчиталась (хоть и ошибкой)
+            raise
+        _llm_breaker_record(model_id, True, (time.monotonic() - started) if track_latency else None, feature)
+        if track_latency: # Для стрима create возвращается на заголовках - полное время меряет _call_ionet_api_streaming
+            metric_observe("llm_request_duration_seconds", time.monotonic() - started, {"model": model_id, "mode": "complete"})
+            usage = getattr(response, "usage", None)
+            if usage:
+                metric_inc("llm_tokens_total", {"model": model_id, "kind": "prompt"}, usage.prompt_tokens or 0)
+                metric_inc("llm_tokens_total", {"model": model_id, "kind": "completion"}, usage.completion_tokens or 0)
+        return response
+
+def _llm_hedge_delay(model_id: str) -> float | None:
+    """Через сколько секунд слать дубль (p95 модели), или None, если хеджировать нечем/рано."""
+    samples = llm_latency_samples.get(model_id)
+    if not LLM_HEDGE_FALLBACK_MODEL_ID or model_id == LLM_HEDGE_FALLBACK_MODEL_ID or not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return max(LLM_HEDGE_MIN_DELAY_SECONDS, statistics.quantiles(samples, n=20)[18])
+
+async def _ionet_create_hedged(client: AsyncOpenAI, model_id: str, feature: str | None, **create_kwargs):
+    """Как _ionet_create_with_retries, но если основная модель не уложилась в свой p95 - параллельно спрашивает запасную."""
+    hedge_delay = _llm_hedge_delay(model_id)
+    if hedge_delay is None:
+        return await _ionet_create_with_retries(client, model_id, feature, **create_kwargs)
+    primary = asyncio.create_task(_ionet_create_with_retries(client, model_id, feature, **create_kwargs))
+    hedge = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done or not llm_breaker_allows(LLM_HEDGE_FALLBACK_MODEL_ID):
+            return await primary
+        llm_resilience_stats["hedges"] += 1
+        logger.info(f"{model_id} ({feature}) молчит дольше p95 ({hedge_delay:.1f}с), шлю дубль в {LLM_HEDGE_FALLBACK_MODEL_ID}.")
+        hedge = asyncio.create_task(_ionet_create_with_retries(client, LLM_HEDGE_FALLBACK_MODEL_ID, feature, **create_kwargs))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        llm_resilience_stats["hedge_wins"] += 1
+                        logger.info(f"Хедж выиграл: {LLM_HEDGE_FALLBACK_MODEL_ID} ответила раньше {model_id}.")
+                    return task.result()
+        return await primary # Обе упали - отдаем ошибку основной
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done(): task.cancel()
+# --->>> КОНЕЦ РЕТРАЕВ И ПРЕДОХРАНИТЕЛЯ <<<---
+
+# --->>> РЕЕСТР МОДЕЛЕЙ И РОУТЕР <<<---
+# Короткие хохмы (предсказания, подкаты, ники, огрызания, ПиВ) гоняем в мелкую быструю модель, длинные тексты - в большую.
+# Если модель тупит дольше бюджета своего уровня, часто падает или выбита предохранителем - роутер берет следующую по списку.
+LLM_MODEL_REGISTRY = {
+    "large": [m.strip() for m in os.getenv("LLM_LARGE_MODELS", IONET_TEXT_MODEL_ID).split(",") if m.strip()],
+    "small": [m.strip() for m in os.getenv("LLM_SMALL_MODELS", IONET_SMALL_TEXT_MODEL_ID).split(",") if m.strip()],
+}
+LLM_TIER_FALLBACKS = {"large": ["large", "small"], "small": ["small", "large"]} # Порядок деградации
+LLM_FEATURE_TIERS = {
+    "analyze": "large", "roast": "large", "poem": "large", "summary": "large", "fact": "large",
+    "prediction": "small", "pickup": "small", "praise": "small", "nickname": "small",
+    "comeback": "small", "tos_statement": "small", "tos_comment": "small",
+}
+# Латентность для роутера - сколько юзер ждет первого текста: полный ответ для обычных вызовов, первый кусок для стрима.
+# Фоновые вызовы в нее не идут (см. _llm_breaker_record).
+LLM_ROUTER_LATENCY_BUDGET_SECONDS = {"large": 25.0, "small": 8.0} # Средняя латентность выше - модель "тупит"
+LLM_ROUTER_MAX_ERROR_RATE = 0.3
+LLM_ROUTER_MIN_CALLS = 5 # Меньше замеров - не судим
+LLM_ROUTER_HEALTH_TTL_SECONDS = 120 # Замеры старше - протухли, снова пробуем основную модель
+LLM_ROUTER_EWMA_ALPHA = 0.2
+
+llm_model_health: dict[str, dict] = {} # model_id -> {"latency", "error_rate", "calls", "updated_at"} (скользящие средние)
+llm_router_stats: dict[str, dict] = {} # feature -> {model_id: сколько раз выбрана}
+llm_router_degradations = {"count": 0}
+
+def _llm_model_health_record(model_id: str, ok: bool, latency: float | None) -> None:
+    health = llm_model_health.setdefault(model_id, {"latency": 0.0, "error_rate": 0.0, "calls": 0, "updated_at": 0.0})
+    alpha = LLM_ROUTER_EWMA_ALPHA
+    health["error_rate"] = (1 - alpha) * health["error_rate"] + alpha * (0.0 if ok else 1.0)
+    if latency is not None: _llm_model_latency_record(model_id, latency)
+    health["calls"] += 1; health["updated_at"] = time.monotonic()
+
+def _llm_model_latency_record(model_id: str, latency: float) -> None:
+    """Только латентность (без счетчика вызовов) - для стрима, который успех уже записал при установке."""
+    health = llm_model_health.setdefault(model_id, {"latency": 0.0, "error_rate": 0.0, "calls": 0, "updated_at": 0.0})
+    alpha = LLM_ROUTER_EWMA_ALPHA
+    health["latency"] = latency if not health["latency"] else (1 - alpha) * health["latency"] + alpha * latency
+    health["updated_at"] = time.monotonic()
+
+def prune_model_registry(available_model_ids: set[str]) -> None:
+    """Выкидывает из реестра модели, которых у провайдера нет (опечатка, переименовали), чтобы роутер не слал туда всё подряд."""
+    if not available_model_ids: return # Провайдер вернул пустой список - верить ему не будем
+    kept = {tier: [m for m in models if m in available_model_ids] for tier, models in LLM_MODEL_REGISTRY.items()}
+    if not any(kept.values()):
+        logger.error(f"Ни одной модели из реестра нет у ai.io.net: {LLM_MODEL_REGISTRY}. Оставляю как есть.")
+        return
+    for tier, models in LLM_MODEL_REGISTRY.items():
+        missing = [m for m in models if m not in available_model_ids]
+        if missing:
+            logger.error(f"Роутер: у ai.io.net нет моделей {', '.join(missing)} (уровень {tier}) - убираю, "
+                         f"{'остаются ' + ', '.join(kept[tier]) if kept[tier] else 'уровень уходит на соседний по цепочке деградации'}.")
+            models[:] = kept[tier]
+    if LLM_HEDGE_FALLBACK_MODEL_ID and LLM_HEDGE_FALLBACK_MODEL_ID not in available_model_ids:
+        logger.error(f"Модели для хеджа {LLM_HEDGE_FALLBACK_MODEL_ID} у ai.io.net нет - хедж будет только жечь ошибки.")
+
+def _llm_model_usable(model_id: str, latency_budget: float) -> bool:
+    """Годится ли модель прямо сейчас: не выбита предохранителем, не тупит и не сыплет ошибками."""
+    breaker = llm_breakers.get(model_id)
+    if breaker and ((breaker["state"] == "open" and time.monotonic() - breaker["opened_at"] < LLM_BREAKER_COOLDOWN_SECONDS)
+                    or _llm_breaker_probe_busy(breaker)):
+        return False
+    health = llm_model_health.get(model_id)
+    if not health or health["calls"] < LLM_ROUTER_MIN_CALLS or time.monotonic() - health["updated_at"] > LLM_ROUTER_HEALTH_TTL_SECONDS:
+        return True
+    return health["latency"] <= latency_budget and health["error_rate"] <= LLM_ROUTER_MAX_ERROR_RATE
+
+def route_model(feature: str) -> str:
+    """Выбирает текстовую модель под фичу: уровень из LLM_FEATURE_TIERS, дальше первая здоровая по цепочке деградации."""
+    tier = LLM_FEATURE_TIERS.get(feature, "large")
+    candidates = list(dict.fromkeys(m for t in LLM_TIER_FALLBACKS[tier] for m in LLM_MODEL_REGISTRY[t])) # Хоть один уровень не пуст - см. prune_model_registry
+    chosen = next((m for m in candidates if _llm_model_usable(m, LLM_ROUTER_LATENCY_BUDGET_SECONDS[tier])), candidates[0])
+    if chosen != candidates[0]:
+        llm_router_degradations["count"] += 1
+        logger.info(f"Роутер: {feature} -> {chosen} вместо {candidates[0]} (основная тупит/лежит).")
+    feature_stats = llm_router_stats.setdefault(feature, {})
+    feature_stats[chosen] = feature_stats.get(chosen, 0) + 1
+    return chosen
+# --->>> КОНЕЦ РОУТЕРА <<<---
+
 # --- Вспомогательная функция для вызова текстового API ---
-async def _call_ionet_api(messages: list, model_id: str, max_tokens: int, temperature: float) -> str | None:
-    """Вызывает текстовый API ai.io.net и возвращает ответ или текст ошибки."""
+LLM_QUEUE_BUSY_TEXT = "🗿 ИИ сейчас завален запросами, попробуй чуть позже."
+
+def _llm_error_text(e: BaseException, model_id: str, chat_id: int | None, stream: bool = False) -> str:
+    """Единственное место, где ошибка запроса к ИИ превращается в текст для юзера (+ лог). Префиксы - в LLM_ERROR_PREFIXES."""
+    kind = "Стрим-запрос" if stream else "Запрос"
+    if isinstance(e, asyncio.TimeoutError):
+        breaker = llm_breakers.get(model_id)
+        if breaker: breaker["probe_started_at"] = None # Если это была проба - до провайдера она не дошла, пусть пробует следующий
+        logger.warning(f"{kind} к ai.io.net ({model_id}, чат {chat_id}) не дождался очереди за {LLM_QUEUE_TIMEOUT_SECONDS}с.")
+        return LLM_QUEUE_BUSY_TEXT
+    if isinstance(e, BadRequestError):
+        logger.error(f"Ошибка BadRequest от ai.io.net API ({model_id}): {e.status_code} - {e.body}", exc_info=False) # Не пишем весь трейсбек
+        error_detail = str(e.body or e)
+        return f"🗿 API {model_id.split('/')[1].split('-')[0]} вернул ошибку: `{error_detail[:100]}`"
+    logger.error(f"ПИЗДЕЦ при вызове ai.io.net API ({model_id}{', стрим' if stream else ''}): {e}", exc_info=e)
+    return f"🗿 Ошибка API: `{type(e).__name__}`"
+
+async def _call_ionet_api(messages: list, model_id: str, max_tokens: int, temperature: float,
+                          priority: int = LLM_PRIORITY_COMMAND, chat_id: int | None = None, feature: str | None = None,
+                          client: AsyncOpenAI | None = None, scheduled: bool = True) -> str | None:
+    """Вызывает текстовый API ai.io.net (через планировщик) и возвращает ответ или текст ошибки.
+    client/scheduled=False - только для /llmbench (свой клиент на заглушку, мимо очереди)."""
+    if feature is None: # Таймаут чтения подбираем по типу запроса
+        if model_id == IONET_VISION_MODEL_ID: feature = "vision"
+        elif priority == LLM_PRIORITY_BACKGROUND: feature = "background"
+        elif priority == LLM_PRIORITY_INTERACTIVE: feature = "reply"
+    if not llm_breaker_allows(model_id): # Провайдер лежит - не ждем таймаута, сразу отказ
+        logger.warning(f"Предохранитель {model_id} открыт, запрос (чат {chat_id}) не шлем.")
+        return LLM_BREAKER_OPEN_TEXT
     try:
-        logger.info(f"Отправка запроса к ai.io.net API ({model_id})...")
-        response = await ionet_client.chat.completions.create(
-            model=model_id, messages=messages, max_tokens=max_tokens, temperature=temperature
-        )
+        async with (llm_slot(priority, chat_id) if scheduled else contextlib.nullcontext()):
+            logger.info(f"Отправка запроса к ai.io.net API ({model_id})...")
+            response = await _ionet_create_hedged(
+                client or ionet_client, model_id, feature,
+                messages=messages, max_tokens=max_tokens, temperature=temperature
+            )
         logger.info(f"Получен ответ от {model_id}.")
         if response.choices and response.choices[0].message and response.choices[0].message.content:
             return response.choices[0].message.content.strip()
         else: logger.warning(f"Ответ от {model_id} пуст/некорректен: {response}"); return None
-    except BadRequestError as e:
-        logger.error(f"Ошибка BadRequest от ai.io.net API ({model_id}): {e.status_code} - {e.body}", exc_info=False) # Не пишем весь трейсбек
-        error_detail = str(e.body or e)
-        return f"🗿 API {model_id.split('/')[1].split('-')[0]} вернул ошибку: `{error_detail[:100]}`"
     except Exception as e:
-        logger.error(f"ПИЗДЕЦ при вызове ai.io.net API ({model_id}): {e}", exc_info=True)
-        return f"🗿 Ошибка API: `{type(e).__name__}`"
+        return _llm_error_text(e, model_id, chat_id)
+
+# --->>> СТРИМИНГ ОТВЕТОВ ИИ С ПРАВКОЙ СООБЩЕНИЯ <<<---
+# Длинные ответы (/analyze, /roast, /poem) тянем с stream=True и по ходу правим сообщение-заглушку "думаю...".
+# Правки троттлим: Телега в группах режет примерно 20 правок в минуту на чат.
+LLM_STREAMING_ENABLED = os.getenv("LLM_STREAMING_ENABLED", "1") == "1"
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "3.0"))
+STREAM_EDIT_MIN_NEW_CHARS = 40 # Не дергаем правку ради пары букв
+STREAM_CURSOR = " ▌"
+_THINK_BLOCK_PATTERN = re.compile(r"^\s*<think>.*?</think>\s*", re.DOTALL | re.IGNORECASE)
+llm_stream_stats: dict[str, dict] = {} # feature -> счетчики, время до первого видимого токена (TTFT)
+
+def _visible_stream_text(raw_text: str) -> str:
+    """То, что можно показать юзеру прямо сейчас: без <think>-блока (а пока он не закрыт - ничего)."""
+    stripped = raw_text.lstrip()
+    if stripped[:7].lower() == "<think>":
+        if "</think>" not in stripped.lower():
+            return ""
+        stripped = _THINK_BLOCK_PATTERN.sub("", stripped)
+    return stripped.strip()
+
+def _record_stream_stats(feature: str, ttft: float | None, total: float, edits: int) -> None:
+    stats = llm_stream_stats.setdefault(feature, {"calls": 0, "ttft_total": 0.0, "ttft_max": 0.0, "no_preview": 0, "total_time": 0.0, "edits": 0})
+    stats["calls"] += 1; stats["total_time"] += total; stats["edits"] += edits
+    if ttft is None: stats["no_preview"] += 1 # Ответ пришел раньше первой правки (или ошибка)
+    else: stats["ttft_total"] += ttft; stats["ttft_max"] = max(stats["ttft_max"], ttft)
+
+async def _call_ionet_api_streaming(messages: list, model_id: str, max_tokens: int, temperature: float,
+                                    bot: Bot, placeholder_message, feature: str,
+                                    priority: int = LLM_PRIORITY_COMMAND, chat_id: int | None = None) -> str | None:
+    """Как _call_ionet_api, но со stream=True: по мере генерации правит placeholder_message (троттлинг по времени).
+    Итоговую правку делает вызывающий (replace_thinking_message) - ему еще надо приклеить префиксы/разметку."""
+    if not LLM_STREAMING_ENABLED or placeholder_message is None:
+        return await _call_ionet_api(messages, model_id, max_tokens, temperature, priority=priority, chat_id=chat_id)
+
+    if not llm_breaker_allows(model_id):
+        logger.warning(f"Предохранитель {model_id} открыт, стрим-запрос (чат {chat_id}) не шлем.")
+        return LLM_BREAKER_OPEN_TEXT
+
+    started_at = time.monotonic()
+    ttft = None; edits = 0
+    parts: list[str] = []
+    shown_text = ""
+    next_edit_at = started_at # Первый кусок показываем сразу
+    try:
+        async with llm_slot(priority, chat_id):
+            logger.info(f"Отправка стрим-запроса к ai.io.net API ({model_id}, {feature})...")
+            requested_at = time.monotonic() # Без ожидания слота - роутеру нужна скорость модели, а не нашей очереди
+            # Ретраим только установку стрима: после первых кусков повтор задублировал бы текст
+            stream = await _ionet_create_with_retries(
+                ionet_client, model_id, feature, track_latency=False,
+                messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta or not chunk.choices[0].delta.content:
+                    continue
+                if not parts and priority != LLM_PRIORITY_BACKGROUND: # Первый кусок - латентность для роутера
+                    _llm_model_latency_record(model_id, time.monotonic() - requested_at)
+                parts.append(chunk.choices[0].delta.content)
+                now = time.monotonic()
+                if now < next_edit_at:
+                    continue
+                visible = _visible_stream_text("".join(parts))
+                if not visible or len(visible) - len(shown_text) < STREAM_EDIT_MIN_NEW_CHARS:
+                    continue
+                if not outbound_limiter.has_free_token(): # Превью не ждет жетона - пропускаем, следующий кусок попробует снова
+                    telegram_coalesce_stats["stream_edits_skipped"] += 1
+                    continue
+                preview = visible[:MAX_TELEGRAM_MESSAGE_LENGTH - len(STREAM_CURSOR)] + STREAM_CURSOR
+                try:
+                    await bot.edit_message_text(chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, text=preview,
+                                                rate_limit_args=0) # Превью не ретраим - следующая правка все равно догонит
+                    shown_text = visible; edits += 1
+                    if ttft is None:
+                        ttft = time.monotonic() - started_at
+                        logger.info(f"{feature}: первый видимый текст через {ttft:.2f}с.")
+                    next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL_SECONDS
+                except telegram.error.RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                    logger.warning(f"{feature}: Телега просит притормозить правки на {retry_after}с.")
+                    next_edit_at = time.monotonic() + retry_after
+                except telegram.error.BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        logger.warning(f"{feature}: не удалось поправить сообщение при стриме: {e}")
+                    next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL_SECONDS
+        full_text = "".join(parts).strip()
+        logger.info(f"Получен стрим-ответ от {model_id} ({feature}), {len(full_text)} симв., правок {edits}.")
+        return full_text or None
+    except Exception as e:
+        partial_text = "".join(parts).strip()
+        if partial_text and not isinstance(e, (asyncio.TimeoutError, BadRequestError)): # Оборвалось на середине - лучше обрубок, чем ничего
+            logger.error(f"ПИЗДЕЦ при стриме из ai.io.net API ({model_id}): {e}. Получено {len(partial_text)} симв.", exc_info=True)
+            return partial_text
+        return _llm_error_text(e, model_id, chat_id, stream=True)
+    finally:
+        _record_stream_stats(feature, ttft, time.monotonic() - started_at, edits)
+        metric_observe("llm_request_duration_seconds", time.monotonic() - started_at, {"model": model_id, "mode": "stream"})
+
+# --->>> КОНЕЦ СТРИМИНГА <<<---
+
+# --->>> КЭШ ОТВЕТОВ ИИ (ПО ОТПЕЧАТКУ ПРОМПТА) <<<---
+# Ключ: (модель, хэш промпта, message_id последнего сообщения в истории). Пока чат не сдвинулся - /analyze отдает
+# тот же ответ мгновенно, а /retry - следующий заготовленный вариант. В API идем, только когда варианты кончились.
+# Запасные варианты заготавливаем лениво: только после первого /retry по ключу (кто ретраит раз - ретраит и дальше).
+LLM_RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("LLM_RESPONSE_CACHE_TTL_SECONDS", "1800"))
+LLM_RESPONSE_CACHE_MAX_SIZE = int(os.getenv("LLM_RESPONSE_CACHE_MAX_SIZE", "256"))
+LLM_RESPONSE_CACHE_MAX_VARIANTS = int(os.getenv("LLM_RESPONSE_CACHE_MAX_VARIANTS", "3"))
+LLM_RESPONSE_CACHE_PREFETCH_VARIANTS = int(os.getenv("LLM_RESPONSE_CACHE_PREFETCH_VARIANTS", "1")) # Сколько запасных держать под /retry (после первого /retry)
+LLM_ERROR_PREFIXES = ("🗿 Ошибка API", "🗿 API ", LLM_QUEUE_BUSY_TEXT) # Так начинаются ответы _llm_error_text - их не кэшируем
+llm_response_cache = TTLCache(maxsize=LLM_RESPONSE_CACHE_MAX_SIZE, ttl=LLM_RESPONSE_CACHE_TTL_SECONDS)
+llm_response_cache_stats = {"hits": 0, "retry_hits": 0, "misses": 0, "stored": 0, "prefetched": 0}
+
+def llm_response_cache_key(model_id: str, messages: list, high_water_message_id: int | None) -> tuple:
+    prompt_hash = hashlib.sha256(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+    return (model_id, prompt_hash, high_water_message_id)
+
+def _llm_response_cache_pick(key: tuple, want_new_variant: bool) -> str | None:
+    """Без /retry - тот вариант, что показывали последним. С /retry - следующий непоказанный (или None)."""
+    entry = llm_response_cache.get(key)
+    if not entry:
+        return None
+    if not want_new_variant:
+        llm_response_cache_stats["hits"] += 1
+        return entry["variants"][entry["shown"]]
+    if entry["shown"] + 1 < len(entry["variants"]):
+        entry["shown"] += 1
+        llm_response_cache_stats["retry_hits"] += 1
+        return entry["variants"][entry["shown"]]
+    return None
+
+def _llm_response_cache_store(key: tuple, text: str, shown: bool) -> None:
+    entry = llm_response_cache.get(key) or {"variants": [], "shown": -1, "prefetching": False}
+    if shown:
+        entry["variants"].append(text)
+        if len(entry["variants"]) > LLM_RESPONSE_CACHE_MAX_VARIANTS: entry["variants"].pop(0) # Выкидываем самый старый
+        entry["shown"] = len(entry["variants"]) - 1
+        llm_response_cache_stats["stored"] += 1
+    elif len(entry["variants"]) < LLM_RESPONSE_CACHE_MAX_VARIANTS and entry["shown"] >= 0:
+        entry["variants"].append(text)
+        llm_response_cache_stats["prefetched"] += 1
+    llm_response_cache[key] = entry
+
+def _kick_llm_variant_prefetch(key: tuple, messages: list, model_id: str, max_tokens: int, temperature: float, chat_id: int | None) -> None:
+    """Фоном догенерирует запасные варианты под /retry (низкий приоритет, без стрима)."""
+    entry = llm_response_cache.get(key)
+    if not entry or entry["prefetching"] or LLM_RESPONSE_CACHE_PREFETCH_VARIANTS <= 0:
+        return
+    spare = len(entry["variants"]) - 1 - entry["shown"]
+    missing = min(LLM_RESPONSE_CACHE_PREFETCH_VARIANTS - spare, LLM_RESPONSE_CACHE_MAX_VARIANTS - len(entry["variants"]))
+    if missing <= 0:
+        return
+    entry["prefetching"] = True
+
+    async def prefetch() -> None:
+        try:
+            for _ in range(missing):
+                text = await _call_ionet_api(messages, model_id, max_tokens, temperature, priority=LLM_PRIORITY_BACKGROUND, chat_id=chat_id)
+                if not text or text.startswith(LLM_ERROR_PREFIXES):
+                    break
+                _llm_response_cache_store(key, text, shown=False)
+        except Exception as e:
+            logger.warning(f"Не удалось заготовить запасной вариант ответа: {e}")
+        finally:
+            current = llm_response_cache.get(key)
+            if current: current["prefetching"] = False
+
+    asyncio.create_task(prefetch(), name="LlmVariantPrefetch")
+
+async def cached_ionet_completion(messages: list, model_id: str, max_tokens: int, temperature: float,
+                                  high_water_message_id: int | None, is_retry: bool,
+                                  bot: Bot, placeholder_message, feature: str, chat_id: int | None = None) -> str | None:
+    """Ответ ИИ через кэш: попадание - сразу, промах - стримом в заглушку. На /retry - еще и фоном заготовка следующего варианта."""
+    key = llm_response_cache_key(model_id, messages, high_water_message_id)
+    cached_text = _llm_response_cache_pick(key, want_new_variant=is_retry)
+    if cached_text is not None:
+        logger.info(f"{feature}: ответ из кэша (чат {chat_id}, история до msg {high_water_message_id}, retry={is_retry}).")
+    else:
+        llm_response_cache_stats["misses"] += 1
+        cached_text = await _call_ionet_api_streaming(
+            messages, model_id, max_tokens, temperature,
+            bot=bot, placeholder_message=placeholder_message, feature=feature, chat_id=chat_id
+        )
+        if not cached_text or cached_text.startswith(LLM_ERROR_PREFIXES):
+            return cached_text
+        _llm_response_cache_store(key, cached_text, shown=True)
+    if is_retry: # Обычный /analyze и /roast лишний запрос в API не порождают
+        _kick_llm_variant_prefetch(key, messages, model_id, max_tokens, temperature, chat_id)
+    return cached_text
+# --->>> КОНЕЦ КЭША ОТВЕТОВ <<<---
     
     ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
     if ADMIN_USER_ID == 0: logger.warning("ADMIN_USER_ID не задан!")
 
-# --->>> ВОТ ЭТИ ДВЕ ФУНКЦИИ НУЖНЫ ЗДЕСЬ <<<---
-async def is_maintenance_mode(loop: asyncio.AbstractEventLoop) -> bool:
-    """Проверяет в MongoDB, активен ли режим техработ."""
+# --->>> РЕЖИМ ТЕХРАБОТ: ФЛАГ В ПАМЯТИ + CHANGE STREAM <<<---
+# Флаг меняется раз в год, а читается каждой командой - поэтому держим его в памяти.
+# Обновляется change stream'ом на bot_status (на Атласе это реплика-сет), если стримы недоступны - опросом.
+MAINTENANCE_POLL_INTERVAL_SECONDS = int(os.getenv("MAINTENANCE_POLL_INTERVAL_SECONDS", "15"))
+MAINTENANCE_REFUSAL_TEXT = "🔧 Сорян, у меня сейчас технические работы. Попробуй позже."
+maintenance_state = {"active": False, "source": "не загружен", "updated_at": None}
+
+def _apply_maintenance_doc(status_doc: dict | None, source: str) -> None:
+    """Переносит документ maintenance_status из Монги во флаг в памяти (нет документа - техработ нет)."""
+    active = bool(status_doc.get("active", False)) if status_doc else False
+    if active != maintenance_state["active"]:
+        logger.info(f"Режим техработ {'ВКЛЮЧЕН' if active else 'ВЫКЛЮЧЕН'} (источник: {source}).")
+    maintenance_state.update({"active": active, "source": source, "updated_at": datetime.datetime.now(datetime.timezone.utc)})
+
+async def refresh_maintenance_flag(source: str = "опрос") -> None:
+    """Перечитывает флаг из Монги."""
     try:
-        status_doc = await loop.run_in_executor(None, lambda: bot_status_collection.find_one({"_id": "maintenance_status"}))
-        return status_doc.get("active", False) if status_doc else False
+        _apply_maintenance_doc(await bot_status_collection.find_one({"_id": "maintenance_status"}), source)
     except Exception as e:
         logger.error(f"Ошибка чтения статуса техработ из MongoDB: {e}")
-        return False
 
-async def set_maintenance_mode(active: bool, loop: asyncio.AbstractEventLoop) -> bool:
-    """Включает или выключает режим техработ в MongoDB."""
+async def maintenance_flag_watcher() -> None:
+    """Фоновая задача: держит флаг техработ свежим через change stream, при недоступности стримов - опросом."""
+    while True:
+        try:
+            pipeline = [{"$match": {"documentKey._id": "maintenance_status"}}]
+            async with await bot_status_collection.watch(pipeline, full_document="updateLookup") as stream:
+                await refresh_maintenance_flag("change stream") # Закрываем дырку между первым чтением и стартом стрима
+                logger.info("Флаг техработ слушает change stream.")
+                async for change in stream:
+                    _apply_maintenance_doc(change.get("fullDocument"), "change stream") # delete -> fullDocument нет -> выкл
+        except asyncio.CancelledError:
+            raise
+        except pymongo.errors.OperationFailure as e:
+            # Standalone-монга или нет прав на стримы - до рестарта живем на опросе
+            logger.warning(f"Change stream для флага техработ недоступен ({e}). Перехожу на опрос раз в {MAINTENANCE_POLL_INTERVAL_SECONDS}с.")
+            while True:
+                await asyncio.sleep(MAINTENANCE_POLL_INTERVAL_SECONDS)
+                await refresh_maintenance_flag()
+        except Exception as e:
+            logger.error(f"Change stream флага техработ упал: {e}. Переподключусь через {MAINTENANCE_POLL_INTERVAL_SECONDS}с.")
+            await asyncio.sleep(MAINTENANCE_POLL_INTERVAL_SECONDS)
+            await refresh_maintenance_flag()
+
+async def is_maintenance_mode(loop: asyncio.AbstractEventLoop | None = None) -> bool:
+    """Активен ли режим техработ (флаг в памяти, без похода в БД)."""
+    return maintenance_state["active"]
+
+async def set_maintenance_mode(active: bool, loop: asyncio.AbstractEventLoop | None = None) -> bool:
+    """Включает или выключает режим техработ в MongoDB и сразу в памяти."""
     try:
-        await loop.run_in_executor(None, lambda: bot_status_collection.update_one({"_id": "maintenance_status"},{"$set": {"active": active, "updated_at": datetime.datetime.now(datetime.timezone.utc)} }, upsert=True))
-        logger.info(f"Режим техработ {'ВКЛЮЧЕН' if active else 'ВЫКЛЮЧЕН'}.")
+        await bot_status_collection.update_one({"_id": "maintenance_status"},{"$set": {"active": active, "updated_at": datetime.datetime.now(datetime.timezone.utc)} }, upsert=True)
+        _apply_maintenance_doc({"active": active}, "админ")
         return True
     except Exception as e:
         logger.error(f"Ошибка записи статуса техработ в MongoDB: {e}")
         return False
+
+def maintenance_gate(refusal_text: str = MAINTENANCE_REFUSAL_TEXT, delete_command: bool = True):
+    """Декоратор для команд: во время техработ отвечает отказом всем, кроме админа в ЛС.
+    Прямые вызовы без update (например, из /retry) пропускает - их уже проверил вызывающий."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def gated_handler(update: Update | None, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+            if update is not None:
+                message = update.message
+                if not message or not message.from_user or not message.chat:
+                    return # Без сообщения проверять нечего (и команде делать нечего)
+                if maintenance_state["active"] and (message.from_user.id != ADMIN_USER_ID or message.chat.type != 'private'):
+                    logger.info(f"Команда {handler.__name__} отклонена из-за режима техработ в чате {message.chat.id}")
+                    try:
+                        if delete_command:
+                            await context.bot.send_message(chat_id=message.chat.id, text=refusal_text)
+                            await context.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+                        else:
+                            await message.reply_text(refusal_text)
+                    except Exception as e:
+                        logger.warning(f"Не удалось ответить/удалить сообщение о техработах ({handler.__name__}): {e}")
+                    return
+            return await handler(update, context, *args, **kwargs)
+        return gated_handler
+    return decorator
 # --->>> КОНЕЦ ФУНКЦИЙ ДЛЯ ТЕХРАБОТ <<<---
 
-# --- ПОЛНОСТЬЮ ПЕРЕПИСАННАЯ store_message (v3, с профилями и званиями) ---
+# --->>> КЭШ ПРОФИЛЕЙ (cachetools.TTLCache) <<<---
+# Имя/ник нужны почти каждой команде, а раньше каждый раз был find_one в user_profiles.
+# Кэш read-through: промах -> один запрос в Монгу (параллельные промахи по одному юзеру склеиваются).
+# Писатели профиля (write-behind, звания, set_nickname, generate_and_set_nickname) обновляют или сбрасывают запись.
+PROFILE_CACHE_TTL_SECONDS = int(os.getenv("PROFILE_CACHE_TTL_SECONDS", "300"))  # 5 минут
+PROFILE_CACHE_MAX_SIZE = int(os.getenv("PROFILE_CACHE_MAX_SIZE", "10000"))
+
+profile_cache = TTLCache(maxsize=PROFILE_CACHE_MAX_SIZE, ttl=PROFILE_CACHE_TTL_SECONDS) # user_id -> документ профиля или None
+_profile_cache_inflight: dict = {} # user_id -> Future запроса, который уже летит в Монгу
+_profile_cache_generations: dict = {} # user_id -> сколько раз профиль меняли, пока летел запрос (живет только на время запроса)
+profile_cache_stats = {"hits": 0, "misses": 0, "updates": 0, "invalidations": 0, "stale_reads": 0}
+
+def _profile_cache_bump_generation(user_id: int) -> None:
+    """Профиль поменялся - ответ уже летящего find_one устарел и в кэш попасть не должен."""
+    if user_id in _profile_cache_inflight:
+        _profile_cache_generations[user_id] = _profile_cache_generations.get(user_id, 0) + 1
+
+async def get_cached_profile_doc(user_id: int) -> dict | None:
+    """Документ профиля из кэша или из Монги (None - профиля нет). Возвращает копию, чтобы никто не испортил кэш."""
+    if user_id in profile_cache:
+        profile_cache_stats["hits"] += 1
+        doc = profile_cache[user_id]
+        return dict(doc) if doc else None
+    profile_cache_stats["misses"] += 1
+    inflight = _profile_cache_inflight.get(user_id)
+    if inflight is None:
+        inflight = asyncio.ensure_future(user_profiles_collection.find_one({"user_id": user_id}))
+        _profile_cache_inflight[user_id] = inflight
+        generation = _profile_cache_generations.get(user_id, 0)
+        try:
+            doc = await inflight
+            if _profile_cache_generations.get(user_id, 0) == generation: profile_cache[user_id] = doc
+            else: profile_cache_stats["stale_reads"] += 1 # Пока ждали, профиль поменяли - не кэшируем старое
+        finally:
+            _profile_cache_inflight.pop(user_id, None)
+            _profile_cache_generations.pop(user_id, None)
+    else:
+        doc = await asyncio.shield(inflight)
+    return dict(doc) if doc else None
+
+def profile_cache_update(user_id: int, fields: dict) -> None:
+    """Вливает свежие поля в закэшированный профиль (если он там есть). Несуществующий профиль просто сбрасываем."""
+    _profile_cache_bump_generation(user_id)
+    cached_doc = profile_cache.get(user_id)
+    if cached_doc is None:
+        if user_id in profile_cache: profile_cache_invalidate(user_id) # Был закэширован "профиля нет", а он появился
+        return
+    cached_doc.update(fields)
+    profile_cache_stats["updates"] += 1
+
+def profile_cache_invalidate(user_id: int) -> None:
+    """Выкидывает профиль из кэша - следующий запрос сходит в Монгу."""
+    _profile_cache_bump_generation(user_id)
+    if user_id in profile_cache:
+        del profile_cache[user_id]; profile_cache_stats["invalidations"] += 1
+# --->>> КОНЕЦ КЭША ПРОФИЛЕЙ <<<---
+
+# --->>> WRITE-BEHIND БУФЕР ДЛЯ store_message <<<---
+# Раньше каждое сообщение делало 3 похода в Монгу подряд (профиль, история, активность) и забивало пул потоков.
+# Теперь store_message только кидает сообщение в очередь, а фоновый воркер пачками пишет всё через
+# bulk_write/insert_many: один профильный bulk_write, один find за счетчиками, один insert_many, один bulk_write активности.
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "5000"))       # Максимум сообщений в очереди
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))       # Сбрасываем, когда набралось столько
+WRITE_BEHIND_FLUSH_INTERVAL_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_SECONDS", "1.0")) # ...или прошло столько
+WRITE_BEHIND_PUT_TIMEOUT_SECONDS = 5.0 # Сколько ждем места в очереди, прежде чем выкинуть сообщение
+
+write_behind_queue: asyncio.Queue | None = None
+write_behind_task: asyncio.Task | None = None
+write_behind_stats = {
+    "enqueued": 0, "flushed": 0, "batches": 0, "dropped": 0, "errors": 0,
+    "backpressure_waits": 0, "backpressure_wait_seconds": 0.0,
+    "max_depth": 0, "last_batch_size": 0, "last_flush_seconds": 0.0,
+}
+
+async def _write_behind_flush(batch: list[dict]) -> dict:
+    """Пишет пачку сообщений в Монгу четырьмя запросами. Возвращает профили {user_id: doc}."""
+    profiles = {}
+    # 1. Профили: схлопываем все сообщения юзера в один $inc
+    per_user = {}
+    for item in batch:
+        entry = per_user.setdefault(item["user"].id, {"count": 0, "user": item["user"]})
+        entry["count"] += 1; entry["user"] = item["user"] # Берем самое свежее имя
+    try:
+        profile_ops = [
+            pymongo.UpdateOne(
+                {"user_id": user_id},
+                {
+                    "$inc": {"message_count": entry["count"]},
+                    "$set": {"tg_first_name": entry["user"].first_name, "tg_username": entry["user"].username},
+                    "$setOnInsert": {"user_id": user_id, "custom_nickname": None, "current_title": None,
+                                     "penis_size": 0, "last_penis_growth": datetime.datetime.fromtimestamp(0, datetime.timezone.utc), "current_penis_title": None}
+                },
+                upsert=True
+            ) for user_id, entry in per_user.items()
+        ]
+        await user_profiles_collection.bulk_write(profile_ops, ordered=False)
+        async for doc in user_profiles_collection.find({"user_id": {"$in": list(per_user.keys())}},
+                                                       {"user_id": 1, "message_count": 1, "custom_nickname": 1, "current_title": 1}):
+            profiles[doc["user_id"]] = doc
+        for user_id, entry in per_user.items(): # Кэш профилей должен видеть свежий счетчик и имя из ТГ
+            fresh_fields = {"tg_first_name": entry["user"].first_name, "tg_username": entry["user"].username}
+            if user_id in profiles: fresh_fields.update({key: value for key, value in profiles[user_id].items() if key != "_id"})
+            profile_cache_update(user_id, fresh_fields)
+    except Exception as e:
+        write_behind_stats["errors"] += 1
+        logger.error(f"Write-behind: ошибка bulk_write профилей ({len(per_user)} юзеров): {e}", exc_info=True)
+
+    # 2. История: одним insert_many (ник берем из свежих профилей)
+    history_docs = []
+    for item in batch:
+        user = item["user"]
+        display_name = (profiles.get(user.id) or {}).get("custom_nickname") or user.first_name or "Аноним"
+        history_docs.append({
+            "chat_id": item["chat_id"], "user_name": display_name, "text": item["text"],
+            "timestamp": item["timestamp"], "message_id": item["message_id"], "user_id": user.id
+        })
+    try:
+        await history_collection.insert_many(history_docs, ordered=False)
+        ring_buffer_append_batch(history_docs) # В память - только то, что реально легло в БД
+    except Exception as e:
+        write_behind_stats["errors"] += 1
+        logger.error(f"Write-behind: ошибка insert_many в history_collection ({len(history_docs)} шт.): {e}")
+
+    # 3. Активность чатов: одно обновление на чат, время самого свежего сообщения
+    last_time_by_chat = {}
+    for item in batch:
+        if item["chat_id"] not in last_time_by_chat or item["timestamp"] > last_time_by_chat[item["chat_id"]]:
+            last_time_by_chat[item["chat_id"]] = item["timestamp"]
+    try:
+        activity_ops = [
+            pymongo.UpdateOne(
+                {"chat_id": chat_id},
+                {"$max": {"last_message_time": last_time},
+                 "$setOnInsert": {"last_bot_shitpost_time": datetime.datetime.fromtimestamp(0, datetime.timezone.utc), "chat_id": chat_id}},
+                upsert=True
+            ) for chat_id, last_time in last_time_by_chat.items()
+        ]
+        await chat_activity_collection.bulk_write(activity_ops, ordered=False)
+    except Exception as e:
+        write_behind_stats["errors"] += 1
+        logger.error(f"Write-behind: ошибка bulk_write активности ({len(last_time_by_chat)} чатов): {e}")
+
+    return profiles
+
+async def _announce_new_titles(batch: list[dict], profiles: dict) -> None:
+    """Проверяет звания по свежим счетчикам и ставит поздравления в очередь склейки (по одному разу на юзера+чат за пачку)."""
+    latest_by_user_chat = {}
+    for item in batch: latest_by_user_chat[(item["user"].id, item["chat_id"])] = item
+    announced_users = set()
+    for (user_id, chat_id), item in latest_by_user_chat.items():
+        profile = profiles.get(user_id)
+        if not profile or user_id in announced_users: continue
+        current_message_count = profile.get("message_count", 1)
+        current_title = profile.get("current_title")
+        new_title_achieved = None
+        new_title_message = ""
+        # Ищем самое высокое звание, которого достиг пользователь
+        for count_threshold, (title_name, achievement_message) in sorted(TITLES_BY_COUNT.items()):
+            if current_message_count >= count_threshold:
+                new_title_achieved = title_name
+                new_title_message = achievement_message
+            else:
+                break
+        if not new_title_achieved or new_title_achieved == current_title: continue
+        announced_users.add(user_id)
+        user = item["user"]
+        display_name = profile.get("custom_nickname") or user.first_name or "Аноним"
+        logger.info(f"Пользователь {display_name} ({user_id}) достиг нового звания: {new_title_achieved} ({current_message_count} сообщений)")
+        try:
+            await user_profiles_collection.update_one({"user_id": user_id}, {"$set": {"current_title": new_title_achieved}})
+            profile_cache_update(user_id, {"current_title": new_title_achieved})
+            achievement_text = new_title_message.format(mention=user.mention_html())
+            queue_title_announcement(item["bot"], chat_id, achievement_text) # Пачка званий в чате уйдет одним сообщением
+        except Exception as e:
+            logger.error(f"Ошибка обновления звания или отправки сообщения о звании для user_id {user_id}: {e}", exc_info=True)
+
+async def _flush_write_behind_batch(batch: list[dict]) -> None:
+    """Сбрасывает пачку в Монгу и раздает звания."""
+    if not batch: return
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    profiles = await _write_behind_flush(batch)
+    write_behind_stats["flushed"] += len(batch); write_behind_stats["batches"] += 1
+    write_behind_stats["last_batch_size"] = len(batch); write_behind_stats["last_flush_seconds"] = round(loop.time() - started, 4)
+    await _announce_new_titles(batch, profiles)
+
+async def _write_behind_worker() -> None:
+    """Фоновый воркер: копит сообщения до WRITE_BEHIND_BATCH_SIZE или WRITE_BEHIND_FLUSH_INTERVAL_SECONDS и сбрасывает."""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        first_item = await write_behind_queue.get()
+        if first_item is None: break # Сигнал остановки, а пачка пустая
+        batch = [first_item]
+        deadline = loop.time() + WRITE_BEHIND_FLUSH_INTERVAL_SECONDS
+        while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0: break
+            try: item = await asyncio.wait_for(write_behind_queue.get(), timeout)
+            except asyncio.TimeoutError: break
+            if item is None: stopping = True; break
+            batch.append(item)
+        try:
+            await _flush_write_behind_batch(batch)
+        except Exception as e:
+            write_behind_stats["errors"] += 1
+            logger.error(f"Write-behind: пачка из {len(batch)} сообщений не записалась: {e}", exc_info=True)
+    # Дочищаем всё, что успело прилететь после сигнала остановки
+    leftovers = []
+    while not write_behind_queue.empty():
+        item = write_behind_queue.get_nowait()
+        if item is not None: leftovers.append(item)
+    for i in range(0, len(leftovers), WRITE_BEHIND_BATCH_SIZE):
+        try: await _flush_write_behind_batch(leftovers[i:i + WRITE_BEHIND_BATCH_SIZE])
+        except Exception as e: logger.error(f"Write-behind: не удалось дописать хвост при остановке: {e}", exc_info=True)
+
+async def enqueue_message_write(item: dict) -> None:
+    """Кладет сообщение в write-behind очередь. Если очередь забита - ждем (backpressure), потом выкидываем."""
+    if write_behind_queue is None or write_behind_task is None or write_behind_task.done():
+        await _flush_write_behind_batch([item]) # Воркер не запущен - пишем сразу, как раньше
+        return
+    try:
+        write_behind_queue.put_nowait(item)
+    except asyncio.QueueFull:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        write_behind_stats["backpressure_waits"] += 1
+        try:
+            await asyncio.wait_for(write_behind_queue.put(item), WRITE_BEHIND_PUT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            write_behind_stats["dropped"] += 1
+            logger.error(f"Write-behind: очередь забита ({write_behind_queue.qsize()}), сообщение {item['message_id']} из чата {item['chat_id']} выкинуто!")
+            return
+        finally:
+            write_behind_stats["backpressure_wait_seconds"] += loop.time() - started
+    write_behind_stats["enqueued"] += 1
+    write_behind_stats["max_depth"] = max(write_behind_stats["max_depth"], write_behind_queue.qsize())
+
+def start_write_behind() -> None:
+    """Создает очередь и запускает воркер (вызывать из main(), когда луп уже крутится)."""
+    global write_behind_queue, write_behind_task
+    write_behind_queue = asyncio.Queue(maxsize=WRITE_BEHIND_MAX_QUEUE)
+    write_behind_task = asyncio.create_task(_write_behind_worker(), name="WriteBehindTask")
+    logger.info(f"Write-behind запущен (очередь {WRITE_BEHIND_MAX_QUEUE}, пачка {WRITE_BEHIND_BATCH_SIZE}, интервал {WRITE_BEHIND_FLUSH_INTERVAL_SECONDS}с).")
+
+async def stop_write_behind() -> None:
+    """Гарантированно сбрасывает всё, что осталось в очереди, и останавливает воркер."""
+    if write_behind_queue is None or write_behind_task is None: return
+    if not write_behind_task.done():
+        await write_behind_queue.put(None) # Сигнал остановки встает в конец очереди
+        try: await write_behind_task
+        except Exception as e: logger.error(f"Write-behind: воркер упал при остановке: {e}", exc_info=True)
+    logger.info(f"Write-behind остановлен. Статистика: {write_behind_stats}")
+# --->>> КОНЕЦ WRITE-BEHIND БУФЕРА <<<---
+
+# --->>> КОЛЬЦЕВЫЕ БУФЕРЫ СВЕЖЕЙ ИСТОРИИ В ПАМЯТИ <<<---
+# /analyze, /retry, roast, praise, pickup и ответы боту читают последние сообщения отсюда, без похода в Монгу.
+# Буфер чата/юзера прогревается из Монги при первом обращении, дальше его кормит write-behind после записи пачки.
+# Холодные буферы не пополняются - прогрев всё равно прочитает свежие сообщения из БД.
+RING_BUFFER_CHAT_SIZE = MAX_MESSAGES_TO_ANALYZE                                    # Сообщений на чат
+RING_BUFFER_USER_SIZE = int(os.getenv("RING_BUFFER_USER_SIZE", "20"))              # Сообщений на юзера в чате
+RING_BUFFER_MAX_BYTES = int(os.getenv("RING_BUFFER_MAX_BYTES", str(64 * 1024 * 1024))) # Общий бюджет памяти (64 МБ)
+RING_BUFFER_IDLE_SECONDS = int(os.getenv("RING_BUFFER_IDLE_SECONDS", str(6 * 60 * 60))) # Выкидываем чаты, молчащие 6 часов
+RING_BUFFER_ENTRY_OVERHEAD_BYTES = 400 # Примерный вес словаря записи без строк
+
+# Ключ -> {"messages": deque, "bytes": int, "last_access": float}. OrderedDict = LRU (в начале - самые старые).
+chat_ring_buffers: OrderedDict = OrderedDict()
+user_ring_buffers: OrderedDict = OrderedDict()
+_ring_warmup_locks: dict = {}
+_ring_pending_pushes: dict = {} # Ключ прогреваемого буфера -> записи, долетевшие из write-behind, пока ждали Монгу
+ring_buffer_stats = {"hits": 0, "warmups": 0, "db_fallbacks": 0, "evictions": 0, "bytes": 0}
+
+def _ring_entry_size(entry: dict) -> int:
+    """Грубая оценка веса записи в байтах."""
+    return RING_BUFFER_ENTRY_OVERHEAD_BYTES + sys.getsizeof(entry.get("text") or "") + sys.getsizeof(entry.get("user_name") or "")
+
+def _ring_make_entry(doc: dict) -> dict:
+    """Оставляем только те поля истории, которые реально читают хендлеры."""
+    return {key: doc.get(key) for key in ("chat_id", "user_id", "user_name", "text", "timestamp", "message_id")}
+
+def _ring_push(buffers: OrderedDict, key, entry: dict) -> None:
+    """Дописывает запись в теплый буфер (вытесненная старая запись вычитается из учета памяти)."""
+    ring = buffers.get(key)
+    if ring is None:
+        pending = _ring_pending_pushes.get(key) # Ключи чатов (int) и юзеров (tuple) не пересекаются
+        if pending is not None: pending.append(entry)
+        return
+    messages = ring["messages"]
+    if len(messages) == messages.maxlen:
+        old_size = _ring_entry_size(messages[0]); ring["bytes"] -= old_size; ring_buffer_stats["bytes"] -= old_size
+    messages.append(entry)
+    new_size = _ring_entry_size(entry); ring["bytes"] += new_size; ring_buffer_stats["bytes"] += new_size
+
+def _ring_evict_key(buffers: OrderedDict, key) -> None:
+    ring = buffers.pop(key, None)
+    if ring: ring_buffer_stats["bytes"] -= ring["bytes"]; ring_buffer_stats["evictions"] += 1
+
+def _ring_enforce_memory_budget() -> None:
+    """LRU: пока не влезаем в бюджет, выкидываем самый давно читанный буфер из обоих (при равенстве - юзерский, он дешевле)."""
+    while ring_buffer_stats["bytes"] > RING_BUFFER_MAX_BYTES and (user_ring_buffers or chat_ring_buffers):
+        oldest_user = next(iter(user_ring_buffers), None)
+        oldest_chat = next(iter(chat_ring_buffers), None)
+        if oldest_chat is None or (oldest_user is not None and
+                                   user_ring_buffers[oldest_user]["last_access"] <= chat_ring_buffers[oldest_chat]["last_access"]):
+            _ring_evict_key(user_ring_buffers, oldest_user)
+        else:
+            _ring_evict_key(chat_ring_buffers, oldest_chat)
+
+def ring_buffer_append_batch(history_docs: list[dict]) -> None:
+    """Вызывается write-behind'ом после записи пачки в Монгу."""
+    for doc in history_docs:
+        entry = _ring_make_entry(doc)
+        _ring_push(chat_ring_buffers, doc["chat_id"], entry)
+        _ring_push(user_ring_buffers, (doc["chat_id"], doc["user_id"]), entry)
+    _ring_enforce_memory_budget()
+
+def ring_buffer_rename_user(user_id: int, new_name: str) -> None:
+    """Меняет ник юзера во всех буферах (вслед за update_history_with_new_name)."""
+    for ring in list(chat_ring_buffers.values()) + [r for (_, uid), r in user_ring_buffers.items() if uid == user_id]:
+        for entry in ring["messages"]:
+            if entry.get("user_id") == user_id: entry["user_name"] = new_name
+
+async def _ring_get(buffers: OrderedDict, key, max_size: int, query: dict, limit: int) -> list[dict]:
+    """Отдает последние limit записей (в хронологическом порядке), при необходимости прогревая буфер из Монги."""
+    if limit > max_size: # Столько в буфере не держим - идем в БД напрямую
+        ring_buffer_stats["db_fallbacks"] += 1
+        docs = await history_collection.find(query).sort("timestamp", pymongo.DESCENDING).limit(limit).to_list()
+        return [_ring_make_entry(doc) for doc in reversed(docs)]
+    if key not in buffers:
+        lock = _ring_warmup_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in buffers:
+                _ring_pending_pushes[key] = [] # Пачка write-behind, записанная пока ждем find, не должна потеряться
+                try:
+                    docs = await history_collection.find(query).sort("timestamp", pymongo.DESCENDING).limit(max_size).to_list()
+                finally:
+                    pending = _ring_pending_pushes.pop(key)
+                buffers[key] = {"messages": deque(maxlen=max_size), "bytes": 0, "last_access": time.monotonic()}
+                for doc in reversed(docs): _ring_push(buffers, key, _ring_make_entry(doc))
+                seen_ids = {doc.get("message_id") for doc in docs}
+                for entry in pending: # find мог их уже увидеть - склеиваем по message_id
+                    if entry.get("message_id") not in seen_ids: _ring_push(buffers, key, entry)
+                ring_buffer_stats["warmups"] += 1
+        _ring_warmup_locks.pop(key, None)
+        _ring_enforce_memory_budget()
+    else:
+        ring_buffer_stats["hits"] += 1
+    ring = buffers.get(key)
+    if ring is None: return [] # Вытеснили прямо во время прогрева - бывает только при крошечном бюджете
+    ring["last_access"] = time.monotonic()
+    buffers.move_to_end(key)
+    messages = list(ring["messages"])
+    return messages[-limit:] if limit else messages
+
+async def get_recent_chat_messages(chat_id: int, limit: int = MAX_MESSAGES_TO_ANALYZE) -> list[dict]:
+    """Последние сообщения чата (старые -> новые)."""
+    return await _ring_get(chat_ring_buffers, chat_id, RING_BUFFER_CHAT_SIZE, {"chat_id": chat_id}, limit)
+
+async def get_recent_user_messages(chat_id: int, user_id: int, limit: int) -> list[dict]:
+    """Последние сообщения юзера в чате (старые -> новые)."""
+    return await _ring_get(user_ring_buffers, (chat_id, user_id), RING_BUFFER_USER_SIZE, {"chat_id": chat_id, "user_id": user_id}, limit)
+
+async def evict_idle_ring_buffers(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновая задача: выкидывает буферы, которые давно никто не читал, и пишет учет памяти в лог."""
+    idle_before = time.monotonic() - RING_BUFFER_IDLE_SECONDS
+    for buffers in (chat_ring_buffers, user_ring_buffers):
+        while buffers:
+            oldest_key = next(iter(buffers))
+            if buffers[oldest_key]["last_access"] >= idle_before: break # Дальше только более свежие
+            _ring_evict_key(buffers, oldest_key)
+    logger.info(f"Кольцевые буферы: чатов {len(chat_ring_buffers)}, юзеров {len(user_ring_buffers)}, "
+                f"~{ring_buffer_stats['bytes'] / 1024:.0f} КБ. Статистика: {ring_buffer_stats}")
+# --->>> КОНЕЦ КОЛЬЦЕВЫХ БУФЕРОВ <<<---
+
+# --- ПОЛНОСТЬЮ ПЕРЕПИСАННАЯ store_message (v4, через write-behind очередь) ---
 async def store_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # 1. Проверяем базовые вещи
     if not update.message or not update.message.from_user or not update.message.chat:
@@ -299,133 +1698,387 @@ async def store_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     # Если не смогли определить текст/заглушку - выходим
     if not message_text: return
 
-    # 3. Работаем с профилем пользователя в MongoDB
-    profile = None
-    current_message_count = 0
-    current_title = None
-    custom_nickname = None
-    display_name = user.first_name or "Аноним" # Имя по умолчанию
-    profile_update_result = None
-    loop = asyncio.get_running_loop()
-
-    try:
-        # Атомарно увеличиваем счетчик сообщений и получаем обновленный профиль
-        # $inc увеличивает поле на 1
-        # $set устанавливает/обновляет поля
-        # $setOnInsert устанавливает поля только при создании нового документа
-        # return_document=pymongo.ReturnDocument.AFTER возвращает документ ПОСЛЕ обновления
-        profile_update_result = await loop.run_in_executor(
-            None,
-            lambda: user_profiles_collection.find_one_and_update(
-                {"user_id": user.id}, # Ищем по ID
-                {
-                    "$inc": {"message_count": 1},
-                    "$set": {"tg_first_name": user.first_name, "tg_username": user.username},
-                    # --->>> УБИРАЕМ message_count ОТСЮДА <<<---
-                    "$setOnInsert": {"user_id": user.id, "custom_nickname": None, "current_title": None,
-                                     "penis_size": 0, "last_penis_growth": datetime.datetime.fromtimestamp(0, datetime.timezone.utc), "current_penis_title": None}
-                    # --->>> КОНЕЦ ИСПРАВЛЕНИЯ <<<---
-                },
-                projection={"message_count": 1, "custom_nickname": 1, "current_title": 1}, # Возвращаем нужные поля
-                upsert=True, # Создаем, если нет
-                return_document=pymongo.ReturnDocument.AFTER # Возвращаем обновленный
-            )
-        )
+    # 3. Профиль, история, активность и звания - всё пишется пачками в фоне (см. write-behind выше)
+    await enqueue_message_write({
+        "chat_id": chat_id, "user": user, "text": message_text,
+        "timestamp": timestamp, "message_id": update.message.message_id, "bot": context.bot
+    })
 
-        if profile_update_result:
-            profile = profile_update_result # Сохраняем результат
-            current_message_count = profile.get("message_count", 1) # Получаем новый счетчик
-            current_title = profile.get("current_title") # Текущее записанное звание
-            custom_nickname = profile.get("custom_nickname") # Кастомный ник
-            if custom_nickname:
-                 display_name = custom_nickname # Используем кастомный ник для логов/истории
-             # logger.debug(f"Обновлен счетчик для {display_name} ({user.id}): {current_message_count}")
+# Конец функции store_message
 
-    except Exception as e:
-        logger.error(f"Ошибка обновления профиля/счетчика для user_id {user.id} в MongoDB: {e}", exc_info=True)
-        # Продолжаем выполнение, но без обновления званий
+# --->>> ПАРАЛЛЕЛЬНЫЕ АПДЕЙТЫ С ПОРЯДКОМ ВНУТРИ ЧАТА <<<---
+# Свой BaseUpdateProcessor: апдейты раскладываются по полосам - чат, а кнопки чата отдельной полосой (чтобы баттл
+# не ждал, пока в том же чате допишется /analyze). Внутри полосы строго по очереди, разные полосы - параллельно
+# до UPDATE_CONCURRENCY. Ждущие своей очереди апдейты НЕ занимают общие слоты: заспамленный чат не съест всю параллельность.
+# Сохранение истории (группа STORE_MESSAGE_HANDLER_GROUP) процессор запускает сам ДО очереди полосы:
+# долгий /analyze задерживает только следующие команды своего чата, но не запись сообщений.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+UPDATE_MAX_IN_FLIGHT = int(os.getenv("UPDATE_MAX_IN_FLIGHT", "10000")) # Предохранитель: апдейтов в работе + в очередях полос
+STORE_MESSAGE_HANDLER_GROUP = -1
+
+def update_ordering_key(update: object) -> tuple | None:
+    """Полоса апдейта: ("chat"|"callback", chat_id). Без чата (инлайн и т.п.) - None, порядок не держим."""
+    if not isinstance(update, Update) or update.effective_chat is None:
+        return None
+    return ("callback" if update.callback_query else "chat", update.effective_chat.id)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Порядок внутри полосы чата. process_update базового класса (@final) держит только семафор-предохранитель
+    на UPDATE_MAX_IN_FLIGHT, а полоса и настоящий лимит параллельности (self.slots) - в do_process_update."""
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(UPDATE_MAX_IN_FLIGHT)
+        self.slots = asyncio.Semaphore(max_concurrent_updates) # Берется уже ПОСЛЕ очереди полосы
+        self.lanes: dict[tuple, list] = {} # ключ полосы -> [замок, апдейтов в полосе (в работе + ждут)]
+        self.unordered_handlers: list = [] # Хендлеры, которые запускаем до очереди полосы (сохранение истории)
+        self.application: Application | None = None
+        self.stats = {"processed": 0, "waited": 0, "max_lane_depth": 0}
+
+    def take_unordered_group(self, application: Application, group: int) -> None:
+        """Забирает хендлеры группы из Application: дальше их запускает процессор, не дожидаясь полосы.
+        Только для block=False - они уходят отдельными задачами (вызывать в main после instrument_handlers)."""
+        self.application = application
+        for handler in list(application.handlers.get(group, [])):
+            application.remove_handler(handler, group)
+            self.unordered_handlers.append(handler)
+
+    async def _start_unordered_handlers(self, update: object) -> None:
+        for handler in self.unordered_handlers:
+            try:
+                check = handler.check_update(update)
+                if check is None or check is False: continue
+                context = self.application.context_types.context.from_update(update, self.application)
+                await context.refresh_data()
+                self.application.create_task(handler.handle_update(update, self.application, check, context),
+                                             update=update, name=f"Unordered:{getattr(update, 'update_id', '?')}")
+            except Exception as e:
+                logger.error(f"Не смог запустить {handler.callback.__name__} до очереди чата: {e}", exc_info=True)
 
-    # 4. Записываем сообщение в историю (используя display_name)
-    message_doc = {
-        "chat_id": chat_id, "user_name": display_name, "text": message_text,
-        "timestamp": timestamp, "message_id": update.message.message_id, "user_id": user.id # Добавили user_id в историю
-    }
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await self._start_unordered_handlers(update)
+        key = update_ordering_key(update)
+        if key is None:
+            async with self.slots: await coroutine
+            return
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        if lane[1] > 1: self.stats["waited"] += 1
+        self.stats["max_lane_depth"] = max(self.stats["max_lane_depth"], lane[1])
+        try:
+            async with lane[0]: # asyncio.Lock будит ждущих по очереди прихода
+                async with self.slots: # Общий слот - только когда подошла очередь
+                    await coroutine
+        finally:
+            lane[1] -= 1
+            if not lane[1]: self.lanes.pop(key, None) # Пустые полосы не копим
+            self.stats["processed"] += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def deepest_lanes(self, limit: int = 10) -> list[tuple[tuple, int]]:
+        """Самые длинные очереди по полосам (для /botstats и /metrics)."""
+        return sorted(((key, lane[1]) for key, lane in list(self.lanes.items())), key=lambda item: item[1], reverse=True)[:limit]
+
+update_processor = ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY)
+
+# --->>> ИСХОДЯЩИЕ В ТЕЛЕГУ: ЛИМИТЫ, RetryAfter И СКЛЕЙКА <<<---
+# Свой BaseRateLimiter: через него идут ВСЕ запросы бота к Bot API (send/edit/delete из любых хендлеров и джоб).
+# Ведро жетонов на чат (в группах Телега режет ~20 сообщений в минуту, в личке ~1 в секунду) + общее ведро (~30/с).
+# Внутри чата запросы получают жетоны по очереди прихода. На RetryAfter чат (или весь бот) замораживается
+# на сколько сказали, и запрос повторяется сам. get*-запросы не троттлим - это чтение, а не флуд в чат.
+TELEGRAM_GLOBAL_RATE_PER_SECOND = float(os.getenv("TELEGRAM_GLOBAL_RATE_PER_SECOND", "30")) # 0 - без ограничения
+TELEGRAM_GLOBAL_BURST = int(os.getenv("TELEGRAM_GLOBAL_BURST", "30"))
+TELEGRAM_PRIVATE_RATE_PER_SECOND = float(os.getenv("TELEGRAM_PRIVATE_RATE_PER_SECOND", "1"))
+TELEGRAM_PRIVATE_BURST = int(os.getenv("TELEGRAM_PRIVATE_BURST", "3"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+TELEGRAM_GROUP_BURST = int(os.getenv("TELEGRAM_GROUP_BURST", "5"))
+TELEGRAM_RETRY_AFTER_MAX_RETRIES = int(os.getenv("TELEGRAM_RETRY_AFTER_MAX_RETRIES", "3"))
+TELEGRAM_CHAT_BUCKETS_SWEEP_AT = 1000 # Больше стольких ведер чатов - выкидываем простаивающие полные
+TITLE_ANNOUNCE_COALESCE_SECONDS = float(os.getenv("TITLE_ANNOUNCE_COALESCE_SECONDS", "5")) # Окно склейки поздравлений со званиями
+pending_title_announcements: dict[int, list[str]] = {} # chat_id -> тексты поздравлений, ждущие отправки одним сообщением
+title_announcement_tasks: set[asyncio.Task] = set() # Спящие задачи склейки - держим ссылки, чтобы GC не съел, и сбрасываем при остановке
+TELEGRAM_CHAT_BUCKET_ENDPOINTS = ("send", "copy", "forward") # Лимит Телеги "N сообщений в чат" - только про новые сообщения
+telegram_coalesce_stats = {"thinking_edits": 0, "thinking_fallbacks": 0, "title_messages": 0, "titles_coalesced": 0, "stream_edits_skipped": 0}
+
+def _bucket_wait(bucket: dict, now: float) -> float:
+    """Доливает ведро и говорит, сколько ждать жетона (0 - можно брать). Заморозка после RetryAfter - главнее."""
+    if now < bucket["blocked_until"]:
+        return bucket["blocked_until"] - now
+    if bucket["rate"] <= 0:
+        bucket["tokens"] = float(bucket["burst"])
+        return 0.0
+    bucket["tokens"] = min(float(bucket["burst"]), bucket["tokens"] + (now - bucket["refilled_at"]) * bucket["rate"])
+    bucket["refilled_at"] = now
+    if bucket["tokens"] >= 1.0:
+        return 0.0
+    return (1.0 - bucket["tokens"]) / bucket["rate"]
+
+def _new_bucket(rate: float, burst: int) -> dict:
+    return {"rate": rate, "burst": burst, "tokens": float(burst), "refilled_at": time.monotonic(), "blocked_until": 0.0}
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    """Троттлинг исходящих запросов. rate_limit_args - сколько раз повторять после RetryAfter (0 - сразу отдать ошибку).
+    Ведро чата - только для send*/copy*/forward*, правки/удаления идут по общему ведру."""
+    def __init__(self, max_retries: int = TELEGRAM_RETRY_AFTER_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.global_bucket = _new_bucket(TELEGRAM_GLOBAL_RATE_PER_SECOND, TELEGRAM_GLOBAL_BURST)
+        self.chats: dict = {} # chat_id -> ведро чата + замок очереди + сколько запросов сейчас с ним работают
+        self.waiting = 0
+        self.stats = {"requests": 0, "throttled": 0, "wait_total": 0.0, "wait_max": 0.0, "retry_after": 0, "gave_up": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> dict:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            is_group = not isinstance(chat_id, int) or chat_id < 0 # Отрицательные ID и @username - группы/каналы
+            bucket = _new_bucket(TELEGRAM_GROUP_RATE_PER_MINUTE / 60, TELEGRAM_GROUP_BURST) if is_group \
+                else _new_bucket(TELEGRAM_PRIVATE_RATE_PER_SECOND, TELEGRAM_PRIVATE_BURST)
+            bucket["lock"] = asyncio.Lock(); bucket["users"] = 0
+            self.chats[chat_id] = bucket
+        return bucket
+
+    def _sweep_idle_chats(self) -> None:
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chats.items()):
+            if not bucket["users"] and _bucket_wait(bucket, now) == 0 and bucket["tokens"] >= bucket["burst"]:
+                del self.chats[chat_id]
+
+    def has_free_token(self) -> bool:
+        """Можно ли прямо сейчас пройти без ожидания (для необязательных запросов вроде превью стрима)."""
+        return self.waiting == 0 and _bucket_wait(self.global_bucket, time.monotonic()) <= 0
+
+    async def _take_tokens(self, chat_bucket: dict | None) -> float:
+        """Ждет, пока жетон есть и в общем ведре, и в ведре чата, и берет оба разом. Возвращает, сколько прождали."""
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            wait = max(_bucket_wait(self.global_bucket, now), _bucket_wait(chat_bucket, now) if chat_bucket else 0.0)
+            if wait <= 0:
+                self.global_bucket["tokens"] -= 1.0
+                if chat_bucket: chat_bucket["tokens"] -= 1.0
+                return waited
+            await asyncio.sleep(wait)
+            waited += time.monotonic() - now
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: dict, rate_limit_args: int | None):
+        throttled = not endpoint.startswith("get")
+        chat_id = data.get("chat_id")
+        chat_bucket = self._chat_bucket(chat_id) if throttled and chat_id is not None and endpoint.startswith(TELEGRAM_CHAT_BUCKET_ENDPOINTS) else None
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        if chat_bucket: chat_bucket["users"] += 1
+        try:
+            for attempt in range(max_retries + 1):
+                if throttled:
+                    self.waiting += 1
+                    try:
+                        if chat_bucket:
+                            async with chat_bucket["lock"]: # asyncio.Lock будит по очереди прихода - порядок внутри чата
+                                waited = await self._take_tokens(chat_bucket)
+                        else:
+                            waited = await self._take_tokens(None)
+                    finally:
+                        self.waiting -= 1
+                    self.stats["requests"] += 1
+                    if waited > 0:
+                        self.stats["throttled"] += 1; self.stats["wait_total"] += waited; self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+                        metric_observe("telegram_outbound_wait_seconds", waited, {"endpoint": endpoint})
+                try:
+                    return await callback(*args, **kwargs)
+                except telegram.error.RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                    # Правка в одном чате не должна морозить всех - общее ведро морозим только для запросов без чата
+                    frozen = chat_bucket or (self.global_bucket if chat_id is None else None)
+                    if frozen: frozen["blocked_until"] = max(frozen["blocked_until"], time.monotonic() + retry_after)
+                    self.stats["retry_after"] += 1
+                    metric_inc("telegram_retry_after_total", {"endpoint": endpoint})
+                    if attempt >= max_retries:
+                        self.stats["gave_up"] += 1
+                        raise
+                    logger.warning(f"Телега просит притормозить {endpoint} (чат {chat_id}) на {retry_after}с, повтор {attempt + 1}/{max_retries}.")
+                    if not throttled or frozen is None: await asyncio.sleep(retry_after) # Остальные дождутся заморозки в _take_tokens
+        finally:
+            if chat_bucket:
+                chat_bucket["users"] -= 1
+                if len(self.chats) > TELEGRAM_CHAT_BUCKETS_SWEEP_AT: self._sweep_idle_chats()
+
+outbound_limiter = OutboundRateLimiter()
+
+async def replace_thinking_message(bot: Bot, chat_id: int, thinking_message, text: str, parse_mode: str | None = None):
+    """Вместо "удалить заглушку + отправить новое" - одна правка заглушки. Не вышло (или заглушки нет) - по-старому."""
+    if thinking_message is not None:
+        try:
+            sent_message = await bot.edit_message_text(chat_id=chat_id, message_id=thinking_message.message_id, text=text, parse_mode=parse_mode)
+            telegram_coalesce_stats["thinking_edits"] += 1
+            return sent_message
+        except Exception as e:
+            telegram_coalesce_stats["thinking_fallbacks"] += 1
+            logger.warning(f"Не удалось поправить заглушку {thinking_message.message_id} финальным текстом: {e}. Отправляю новым сообщением.")
+            try: await bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
+            except Exception: pass
+    return await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+
+def queue_title_announcement(bot: Bot, chat_id: int, text: str) -> None:
+    """Копит поздравления со званиями по чату TITLE_ANNOUNCE_COALESCE_SECONDS и шлет их одним сообщением."""
+    pending = pending_title_announcements.get(chat_id)
+    if pending is not None:
+        pending.append(text)
+        telegram_coalesce_stats["titles_coalesced"] += 1
+        return
+    pending_title_announcements[chat_id] = [text]
+    task = asyncio.create_task(_send_title_announcements(bot, chat_id), name=f"TitleAnnouncements-{chat_id}")
+    title_announcement_tasks.add(task)
+    task.add_done_callback(title_announcement_tasks.discard)
+
+async def _send_title_announcements(bot: Bot, chat_id: int) -> None:
+    await asyncio.sleep(TITLE_ANNOUNCE_COALESCE_SECONDS)
+    await _deliver_title_announcements(bot, chat_id)
+
+async def flush_title_announcements(bot: Bot) -> None:
+    """При остановке: не ждем окна склейки, отправляем все накопленное сразу."""
+    for task in list(title_announcement_tasks): task.cancel()
+    await asyncio.gather(*title_announcement_tasks, return_exceptions=True)
+    if not pending_title_announcements: return
+    logger.info(f"Отправляю отложенные поздравления со званиями в {len(pending_title_announcements)} чат(ов)...")
     try:
-        await loop.run_in_executor(None, lambda: history_collection.insert_one(message_doc))
+        await bot.initialize() # Приложение уже закрыло HTTP-клиент бота - поднимаем на время сброса
+        for chat_id in list(pending_title_announcements): await _deliver_title_announcements(bot, chat_id)
     except Exception as e:
-        logger.error(f"Ошибка записи в history_collection: {e}")
+        logger.error(f"Не удалось сбросить поздравления со званиями при остановке: {e}")
+    finally:
+        await bot.shutdown()
+
+async def _deliver_title_announcements(bot: Bot, chat_id: int) -> None:
+    texts = pending_title_announcements.pop(chat_id, [])
+    parts = [] # Склеиваем, пока влезает в одно сообщение
+    for text in texts:
+        if parts and len(parts[-1]) + 2 + len(text) <= MAX_TELEGRAM_MESSAGE_LENGTH: parts[-1] += "\n\n" + text
+        else: parts.append(text)
+    for part in parts:
+        try:
+            await bot.send_message(chat_id=chat_id, text=part, parse_mode='HTML')
+            telegram_coalesce_stats["title_messages"] += 1
+        except Exception as e:
+            logger.error(f"Не удалось отправить поздравления со званиями ({len(texts)} шт.) в чат {chat_id}: {e}")
+# --->>> КОНЕЦ ИСХОДЯЩИХ В ТЕЛЕГУ <<<---
 
-    # 5. Обновляем активность чата (как было)
-    try:
-        activity_update_doc = {"$set": {"last_message_time": timestamp}, "$setOnInsert": {"last_bot_shitpost_time": datetime.datetime.fromtimestamp(0, datetime.timezone.utc), "chat_id": chat_id}}
-        await loop.run_in_executor(None, lambda: chat_activity_collection.update_one({"chat_id": chat_id}, activity_update_doc, upsert=True))
-    except Exception as e:
-         logger.error(f"Ошибка обновления активности чата {chat_id}: {e}")
-
-    # 6. Проверяем достижение нового звания (только если смогли обновить профиль)
-    if profile:
-         new_title_achieved = None
-         new_title_message = ""
-         # Ищем самое высокое звание, которого достиг пользователь
-         for count_threshold, (title_name, achievement_message) in sorted(TITLES_BY_COUNT.items()):
-             if current_message_count >= count_threshold:
-                 new_title_achieved = title_name
-                 new_title_message = achievement_message # Запоминаем сообщение для этого звания
-             else:
-                 break # Дальше пороги выше
 
-         # Если достигнутое звание НОВОЕ (не совпадает с тем, что записано в профиле)
-         if new_title_achieved and new_title_achieved != current_title:
-             logger.info(f"Пользователь {display_name} ({user.id}) достиг нового звания: {new_title_achieved} ({current_message_count} сообщений)")
-             # Обновляем звание в БД
-             try:
-                 await loop.run_in_executor(
-                     None,
-                     lambda: user_profiles_collection.update_one(
-                         {"user_id": user.id},
-                         {"$set": {"current_title": new_title_achieved}}
-                     )
-                 )
-                 # Отправляем поздравительно-уничижительное сообщение
-                 # Используем mention_html для кликабельности
-                 mention = user.mention_html()
-                 achievement_text = new_title_message.format(mention=mention) # Подставляем упоминание в шаблон
-                 await context.bot.send_message(chat_id=chat_id, text=achievement_text, parse_mode='HTML')
-             except Exception as e:
-                 logger.error(f"Ошибка обновления звания или отправки сообщения о звании для user_id {user.id}: {e}", exc_info=True)
 
-# Конец функции store_message
+# --->>> СКОЛЬЗЯЩАЯ СВОДКА ЧАТА ДЛЯ /analyze <<<---
+# Фоновая джоба сворачивает старые сообщения каждого активного чата в короткую сводку (chat_summaries),
+# оставляя несвернутым свежий хвост. /analyze шлет в ИИ сводку + хвост, а не 200 сырых сообщений.
+ROLLING_SUMMARY_TAIL_MESSAGES = int(os.getenv("ROLLING_SUMMARY_TAIL_MESSAGES", "40"))        # Свежак, который не сворачиваем
+ROLLING_SUMMARY_MIN_NEW_MESSAGES = int(os.getenv("ROLLING_SUMMARY_MIN_NEW_MESSAGES", "60"))  # Меньше - не дергаем ИИ ради сводки
+ROLLING_SUMMARY_MAX_FOLD_MESSAGES = 300 # Сколько максимум сворачиваем за один заход (остальное - в следующий)
+ROLLING_SUMMARY_MAX_CHARS = 2500
+ROLLING_SUMMARY_ACTIVE_WINDOW_HOURS = 24 # Сворачиваем только чаты, где писали за это время
+ROLLING_SUMMARY_MAX_CHATS_PER_RUN = 20
+ROLLING_SUMMARY_INTERVAL_SECONDS = int(os.getenv("ROLLING_SUMMARY_INTERVAL_SECONDS", "900"))
+rolling_summary_lock = asyncio.Lock()
+rolling_summary_stats = {"folds": 0, "folded_messages": 0, "failed": 0, "used_in_analyze": 0, "skipped_gaps": 0, "stale_in_analyze": 0}
 
+async def get_rolling_summary(chat_id: int) -> dict | None:
+    try:
+        return await chat_summaries_collection.find_one({"chat_id": chat_id})
+    except Exception as e:
+        logger.error(f"Ошибка чтения сводки чата {chat_id}: {e}")
+        return None
+
+async def _fold_chat_summary(chat_id: int) -> bool:
+    """Сворачивает новые сообщения чата (кроме хвоста) в сводку. True - сводку обновили."""
+    summary_doc = await get_rolling_summary(chat_id) or {}
+    query = {"chat_id": chat_id}
+    # Водяной знак - message_id (в чате растет строго), а не время: у message.date точность в секунду,
+    # и сообщения из недосвернутой секунды при "$gt timestamp" терялись бы и из сводки, и из /analyze
+    covered_message_id = summary_doc.get("covered_until_message_id")
+    if covered_message_id:
+        query["message_id"] = {"$gt": covered_message_id}
+    # Берем САМЫЕ СВЕЖИЕ несвернутые (с конца): первая сводка стартует рядом с окном /analyze, а не с начала истории,
+    # и шумный чат не отстает навсегда - если за заход набежало больше лимита, середину пропускаем
+    new_messages = (await history_collection.find(
+        query, {"_id": 0, "user_name": 1, "text": 1, "timestamp": 1, "message_id": 1}
+    ).sort("message_id", pymongo.DESCENDING).limit(ROLLING_SUMMARY_MAX_FOLD_MESSAGES + ROLLING_SUMMARY_TAIL_MESSAGES).to_list())[::-1]
+
+    to_fold = new_messages[:-ROLLING_SUMMARY_TAIL_MESSAGES] if ROLLING_SUMMARY_TAIL_MESSAGES else new_messages
+    if len(to_fold) < ROLLING_SUMMARY_MIN_NEW_MESSAGES:
+        return False
+    skipped_gap = bool(covered_message_id) and await history_collection.find_one(
+        {"chat_id": chat_id, "message_id": {"$gt": covered_message_id, "$lt": to_fold[0]["message_id"]}}, {"_id": 1}
+    ) is not None
+    if skipped_gap:
+        rolling_summary_stats["skipped_gaps"] += 1
+        logger.info(f"Сводка чата {chat_id}: не успеваем за чатом, часть сообщений после прошлой сводки пропущена.")
+
+    previous_summary = summary_doc.get("summary") or "[Сводки еще нет - это самое начало летописи]"
+    if skipped_gap: previous_summary += "\n[...дальше был кусок переписки, который не попал в летопись...]"
+    new_lines = "\n".join(f"{msg.get('user_name', '?')}: {msg.get('text', '')}" for msg in to_fold)
+    fold_prompt = (
+        f"Ты ведешь сжатую летопись ебанутого Telegram-чата. Ниже ТЕКУЩАЯ СВОДКА всего, что было раньше, и НОВЫЕ СООБЩЕНИЯ после нее.\n"
+        f"Обнови сводку: добавь новые сюжеты, кто что говорил и делал (ОБЯЗАТЕЛЬНО с именами/никами), срачи, шутки, темы. "
+        f"Старое и мелкое сжимай сильнее, самое яркое сохраняй. Пиши сухо, по пунктам, без оценок - это заготовка для хроники, а не сама хроника.\n"
+        f"Без вступлений, только текст сводки, НЕ ДЛИННЕЕ {ROLLING_SUMMARY_MAX_CHARS} символов.\n\n"
+        f"ТЕКУЩАЯ СВОДКА:\n{previous_summary}\n\n"
+        f"НОВЫЕ СООБЩЕНИЯ:\n```\n{new_lines}\n```"
+    )
+    new_summary = await _call_ionet_api(
+        [{"role": "user", "content": fold_prompt}], route_model("summary"), 700, 0.3,
+        priority=LLM_PRIORITY_BACKGROUND, chat_id=chat_id
+    )
+    if not new_summary or new_summary.startswith(LLM_ERROR_PREFIXES):
+        rolling_summary_stats["failed"] += 1
+        logger.warning(f"Сводка чата {chat_id} не обновлена: ИИ ответил '{(new_summary or '')[:60]}'")
+        return False
 
+    new_summary = _THINK_BLOCK_PATTERN.sub("", new_summary).strip()[:ROLLING_SUMMARY_MAX_CHARS]
+    last_folded = to_fold[-1]
+    await chat_summaries_collection.update_one(
+        {"chat_id": chat_id},
+        {"$set": {
+            "summary": new_summary,
+            "covered_until_ts": last_folded["timestamp"],
+            "covered_until_message_id": last_folded.get("message_id"),
+            "updated_at": datetime.datetime.now(datetime.timezone.utc),
+        }, "$inc": {"covered_messages": len(to_fold)}},
+        upsert=True
+    )
+    rolling_summary_stats["folds"] += 1; rolling_summary_stats["folded_messages"] += len(to_fold)
+    logger.info(f"Сводка чата {chat_id} обновлена: свернуто {len(to_fold)} сообщ., {len(new_summary)} симв.")
+    return True
+
+async def fold_rolling_summaries(context: ContextTypes.DEFAULT_TYPE | None = None) -> None:
+    """Джоба: обновляет сводки недавно активных чатов."""
+    if maintenance_state["active"] or rolling_summary_lock.locked():
+        return
+    async with rolling_summary_lock:
+        active_since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=ROLLING_SUMMARY_ACTIVE_WINDOW_HOURS)
+        try:
+            active_chats = await chat_activity_collection.find(
+                {"last_message_time": {"$gte": active_since}}, {"chat_id": 1, "_id": 0}
+            ).sort("last_message_time", pymongo.DESCENDING).limit(ROLLING_SUMMARY_MAX_CHATS_PER_RUN).to_list()
+        except Exception as e:
+            logger.error(f"Не удалось получить активные чаты для сводок: {e}")
+            return
+        for chat_doc in active_chats:
+            try:
+                await _fold_chat_summary(chat_doc["chat_id"])
+            except Exception as e:
+                rolling_summary_stats["failed"] += 1
+                logger.error(f"Ошибка сворачивания сводки чата {chat_doc.get('chat_id')}: {e}", exc_info=True)
+# --->>> КОНЕЦ СКОЛЬЗЯЩЕЙ СВОДКИ <<<---
 
 # --- ПОЛНАЯ ФУНКЦИЯ analyze_chat (С УЛУЧШЕННЫМ УДАЛЕНИЕМ <think>) ---
+@maintenance_gate()
 async def analyze_chat(update: Update | None, context: ContextTypes.DEFAULT_TYPE, direct_chat_id: int | None = None, direct_user: User | None = None) -> None:
     #MAX_MESSAGE_LENGTH = 4096 # Стандартный лимит Telegram
-     # --->>> НАЧАЛО НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
-# Проверяем наличие update и message - без них проверка невозможна
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-        logger.warning(f"Не могу проверить техработы - нет данных в update ({__name__})") # Логгируем имя текущей функции
-        # Если это важная команда, можно тут вернуть ошибку пользователю
-        # await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка проверки данных.")
-        return # Или просто выйти
-
-    real_chat_id = update.message.chat.id
-    real_user_id = update.message.from_user.id
-    real_chat_type = update.message.chat.type
-
-    loop = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop) # Вызываем функцию проверки
-
-    # Блокируем, если техработы ВКЛЮЧЕНЫ и это НЕ админ в ЛС
-    if maintenance_active and (real_user_id != ADMIN_USER_ID or real_chat_type != 'private'):
-        logger.info(f"Команда отклонена из-за режима техработ в чате {real_chat_id}")
-        try: # Пытаемся ответить и удалить команду
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось ответить/удалить сообщение о техработах: {e}")
-        return # ВЫХОДИМ ИЗ ФУНКЦИИ
-# --->>> КОНЕЦ НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
     # Получаем chat_id и user либо из Update, либо из прямых аргументов
     if update and update.message:
         chat_id = update.message.chat_id
@@ -439,22 +2092,15 @@ async def analyze_chat(update: Update | None, context: ContextTypes.DEFAULT_TYPE
         logger.error("analyze_chat вызвана некорректно!")
         return
 
-    logger.info(f"Пользователь '{user_name}' запросил анализ текста в чате {chat_id} через {IONET_TEXT_MODEL_ID}")
+    analyze_model_id = route_model("analyze")
+    logger.info(f"Пользователь '{user_name}' запросил анализ текста в чате {chat_id} через {analyze_model_id}")
 
-    # --- ЧТЕНИЕ ИСТОРИИ ИЗ MONGODB ---
+    # --- ЧТЕНИЕ ИСТОРИИ (КОЛЬЦЕВОЙ БУФЕР, ПРИ ПЕРВОМ ОБРАЩЕНИИ - ИЗ MONGODB) ---
     messages_from_db = []
     try:
-        logger.debug(f"Запрос истории для чата {chat_id} из MongoDB...")
-        limit = MAX_MESSAGES_TO_ANALYZE
-        query = {"chat_id": chat_id}
-        sort_order = [("timestamp", pymongo.DESCENDING)]
-        loop = asyncio.get_running_loop()
-        history_cursor = await loop.run_in_executor(
-            None, lambda: history_collection.find(query).sort(sort_order).limit(limit)
-        )
-        messages_from_db = list(history_cursor)[::-1] # Переворачиваем
+        messages_from_db = await get_recent_chat_messages(chat_id, MAX_MESSAGES_TO_ANALYZE) # Уже в хронологическом порядке
         history_len = len(messages_from_db)
-        logger.info(f"Из MongoDB для чата {chat_id} загружено {history_len} сообщений.")
+        logger.info(f"Для чата {chat_id} загружено {history_len} сообщений.")
     except Exception as e:
         logger.error(f"Ошибка чтения истории MongoDB: {e}")
         await context.bot.send_message(chat_id=chat_id, text="Бля, не смог прочитать историю из БД.")
@@ -467,10 +2113,24 @@ async def analyze_chat(update: Update | None, context: ContextTypes.DEFAULT_TYPE
         await context.bot.send_message(chat_id=chat_id, text=f"Слышь, {user_name}, надо {min_msgs} сообщений, а в БД {history_len}.")
         return
 
+    # Всё, что старше хвоста, фоновая джоба уже свернула в сводку - шлем сводку + несвернутый хвост
+    history_high_water_message_id = messages_from_db[-1].get("message_id") # Для кэша ответов
+    rolling_summary = await get_rolling_summary(chat_id)
+    summary_block = ""
+    covered_message_id = (rolling_summary or {}).get("covered_until_message_id") or 0
+    oldest_message_id = messages_from_db[0].get("message_id") or 0
+    if rolling_summary and rolling_summary.get("summary") and covered_message_id < oldest_message_id:
+        # Сводка кончается раньше нашего окна - между ней и хвостом была бы дыра, лучше без сводки
+        rolling_summary_stats["stale_in_analyze"] += 1
+        logger.info(f"Сводка чата {chat_id} отстала (до {covered_message_id}, окно с {oldest_message_id}) - анализирую без нее.")
+    elif rolling_summary and rolling_summary.get("summary"):
+        messages_from_db = [msg for msg in messages_from_db if (msg.get("message_id") or 0) > covered_message_id]
+        summary_block = f"Сводка того, что было в чате раньше (~{rolling_summary.get('covered_messages', 0)} сообщений):\n{rolling_summary['summary']}\n\n"
+        rolling_summary_stats["used_in_analyze"] += 1
+
     # Формируем текст для ИИ
-    conversation_lines = [f"{msg.get('user_name', '?')}: {msg.get('text', '')}" for msg in messages_from_db]
-    conversation_text = "\n".join(conversation_lines)
-    logger.info(f"Начинаю анализ {len(messages_from_db)} сообщений через {IONET_TEXT_MODEL_ID}...")
+    conversation_text = build_history_context(messages_from_db, analyze_model_id, "analyze")
+    logger.info(f"Начинаю анализ {len(messages_from_db)} сообщений{' + сводка' if summary_block else ''} через {analyze_model_id}...")
 
     # Вызов ИИ
     try:
@@ -500,13 +2160,18 @@ async def analyze_chat(update: Update | None, context: ContextTypes.DEFAULT_TYPE
         messages_for_api = [
             {"role": "system", "content": system_prompt},
             # Передаем сам диалог как сообщение пользователя
-            {"role": "user", "content": f"Проанализируй этот диалог:\n```\n{conversation_text}\n```"}
+            {"role": "user", "content": f"{summary_block}Проанализируй этот диалог{' (самые свежие сообщения)' if summary_block else ''}:\n```\n{conversation_text}\n```"}
         ]
 
-        thinking_message = await context.bot.send_message(chat_id=chat_id, text=f"Так, блядь, щас подключу мозги {IONET_TEXT_MODEL_ID.split('/')[1].split('-')[0]}...")
+        thinking_message = await context.bot.send_message(chat_id=chat_id, text=f"Так, блядь, щас подключу мозги {analyze_model_id.split('/')[1].split('-')[0]}...")
 
         # Вызываем вспомогательную функцию
-        sarcastic_summary = await _call_ionet_api(messages_for_api, IONET_TEXT_MODEL_ID, 600, 0.7) or "[Хроника не составлена]" # Увеличили до 600
+        # Пока в чат ничего не написали - хроника та же (из кэша), /retry берет следующий заготовленный вариант
+        sarcastic_summary = await cached_ionet_completion(
+            messages_for_api, analyze_model_id, 600, 0.7, # Увеличили до 600
+            high_water_message_id=history_high_water_message_id, is_retry=update is None,
+            bot=context.bot, placeholder_message=thinking_message, feature="analyze", chat_id=chat_id
+        ) or "[Хроника не составлена]"
 
         # --->>> УЛУЧШЕННОЕ УДАЛЕНИЕ <think> ТЕГОВ <<<---
         # Компилируем регулярку один раз для эффективности (хотя тут не критично)
@@ -522,62 +2187,84 @@ async def analyze_chat(update: Update | None, context: ContextTypes.DEFAULT_TYPE
         if not sarcastic_summary.startswith("🗿") and not sarcastic_summary.startswith("["):
             sarcastic_summary = "🗿 " + sarcastic_summary
 
-        # Удаляем "Думаю..."
-        try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
-
-        # Страховочная обрезка и отправка
+        # Страховочная обрезка и финальная правка "Думаю..." (по ней уже шел стрим)
         #MAX_MESSAGE_LENGTH = 4096;
         if len(sarcastic_summary) > MAX_TELEGRAM_MESSAGE_LENGTH: sarcastic_summary = sarcastic_summary[:MAX_TELEGRAM_MESSAGE_LENGTH - 3] + "..."
-        sent_message = await context.bot.send_message(chat_id=chat_id, text=sarcastic_summary)
+        sent_message = await replace_thinking_message(context.bot, chat_id, thinking_message, sarcastic_summary)
         logger.info(f"Отправил результат анализа ai.io.net '{sarcastic_summary[:50]}...'")
 
         # Запись для /retry
         if sent_message:
              reply_doc = { "chat_id": chat_id, "message_id": sent_message.message_id, "analysis_type": "text", "timestamp": datetime.datetime.now(datetime.timezone.utc) }
              try:
-                 loop = asyncio.get_running_loop(); await loop.run_in_executor(None, lambda: last_reply_collection.update_one({"chat_id": chat_id}, {"$set": reply_doc}, upsert=True))
+                 loop = asyncio.get_running_loop(); await last_reply_collection.update_one({"chat_id": chat_id}, {"$set": reply_doc}, upsert=True)
                  logger.debug(f"Сохранен/обновлен ID ({sent_message.message_id}, text) для /retry чата {chat_id}.")
              except Exception as e: logger.error(f"Ошибка записи /retry (text) в MongoDB: {e}")
 
     except Exception as e: # Общая ошибка самого analyze_chat
         logger.error(f"ПИЗДЕЦ в analyze_chat (после чтения БД): {e}", exc_info=True)
-        try:
-            if 'thinking_message' in locals(): await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
-        await context.bot.send_message(chat_id=chat_id, text=f"Бля, {user_name}, я обосрался при анализе чата. Ошибка: `{type(e).__name__}`.")
+        await replace_thinking_message(context.bot, chat_id, locals().get('thinking_message'), f"Бля, {user_name}, я обосрался при анализе чата. Ошибка: `{type(e).__name__}`.")
 
 # --- КОНЕЦ ПОЛНОЙ ФУНКЦИИ analyze_chat ---
 
+# --->>> ПОДГОТОВКА КАРТИНОК ДЛЯ VISION-МОДЕЛИ <<<---
+# Телега уже хранит фотку в нескольких размерах (JPEG без EXIF), так что вместо своего ресайза берем
+# самый маленький размер, которого хватает модели, и кэшируем готовый data URI по file_unique_id - /retry не качает заново.
+VISION_TARGET_EDGE = int(os.getenv("VISION_TARGET_EDGE", "800"))             # Меньшая сторона, которой модели достаточно по длинной стороне
+VISION_MAX_BYTES = int(os.getenv("VISION_MAX_BYTES", str(400 * 1024)))       # Бюджет на одну картинку
+VISION_IMAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+VISION_IMAGE_CACHE_TTL_SECONDS = 6 * 60 * 60
+vision_image_cache = TTLCache(maxsize=VISION_IMAGE_CACHE_MAX_BYTES, ttl=VISION_IMAGE_CACHE_TTL_SECONDS, getsizeof=len) # file_unique_id -> data URI
+vision_file_id_aliases = TTLCache(maxsize=4096, ttl=VISION_IMAGE_CACHE_TTL_SECONDS) # file_id -> file_unique_id (для /retry)
+vision_image_stats = {"hits": 0, "downloads": 0, "bytes_downloaded": 0, "bytes_saved": 0}
+
+def pick_vision_photo_size(photo_sizes) -> "telegram.PhotoSize":
+    """Самый маленький PhotoSize, у которого длинная сторона >= VISION_TARGET_EDGE и который влезает в VISION_MAX_BYTES.
+    Если таких нет - самый крупный из влезающих в бюджет, а если в бюджет не влезает ничего - самый маленький."""
+    by_area = sorted(photo_sizes, key=lambda size: size.width * size.height)
+    within_budget = [size for size in by_area if not size.file_size or size.file_size <= VISION_MAX_BYTES]
+    for size in within_budget:
+        if max(size.width, size.height) >= VISION_TARGET_EDGE:
+            return size
+    return within_budget[-1] if within_budget else by_area[0]
+
+async def prepare_vision_image(bot: Bot, file_id: str, file_unique_id: str | None = None, full_size_bytes: int | None = None) -> str:
+    """data URI картинки для vision-модели: из кэша, а при промахе - скачать и закодировать."""
+    file_unique_id = file_unique_id or vision_file_id_aliases.get(file_id)
+    if file_unique_id and file_unique_id in vision_image_cache:
+        vision_image_stats["hits"] += 1
+        logger.info(f"Картинка {file_unique_id} взята из кэша, без скачивания.")
+        return vision_image_cache[file_unique_id]
+
+    logger.info(f"Скачивание картинки {file_id}...")
+    photo_file = await bot.get_file(file_id, read_timeout=60)
+    file_unique_id = photo_file.file_unique_id
+    if file_unique_id in vision_image_cache: # /retry со старым file_id, но сама картинка уже закэширована
+        vision_file_id_aliases[file_id] = file_unique_id
+        vision_image_stats["hits"] += 1
+        return vision_image_cache[file_unique_id]
+    photo_bytes = bytes(await photo_file.download_as_bytearray(read_timeout=60))
+    if not photo_bytes: raise ValueError("Скачаны пустые байты картинки")
+    vision_image_stats["downloads"] += 1; vision_image_stats["bytes_downloaded"] += len(photo_bytes)
+    if full_size_bytes and full_size_bytes > len(photo_bytes):
+        vision_image_stats["bytes_saved"] += full_size_bytes - len(photo_bytes)
+    logger.info(f"Картинка скачана, размер: {len(photo_bytes)} байт" + (f" (оригинал {full_size_bytes})." if full_size_bytes else "."))
+    if len(photo_bytes) > VISION_MAX_BYTES:
+        logger.warning(f"Картинка {file_unique_id} ({len(photo_bytes)} байт) больше бюджета {VISION_MAX_BYTES} - меньшего размера у Телеги нет.")
+
+    base64_image = await asyncio.to_thread(lambda: base64.b64encode(photo_bytes).decode('utf-8')) # Большие картинки кодируем мимо event loop
+    data_uri = f"data:image/jpeg;base64,{base64_image}"
+    if len(data_uri) <= VISION_IMAGE_CACHE_MAX_BYTES:
+        vision_image_cache[file_unique_id] = data_uri
+    vision_file_id_aliases[file_id] = file_unique_id
+    return data_uri
+# --->>> КОНЕЦ ПОДГОТОВКИ КАРТИНОК <<<---
+
 # --- ОБРАБОТЧИК КОМАНДЫ /analyze_pic (ПЕРЕПИСАН ПОД VISION МОДЕЛЬ) ---
+@maintenance_gate()
 async def analyze_pic(update: Update | None, context: ContextTypes.DEFAULT_TYPE, direct_chat_id: int | None = None, direct_user: User | None = None, direct_file_id: str | None = None) -> None:
-     # --->>> НАЧАЛО НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
-# Проверяем наличие update и message - без них проверка невозможна
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-        logger.warning(f"Не могу проверить техработы - нет данных в update ({__name__})") # Логгируем имя текущей функции
-        # Если это важная команда, можно тут вернуть ошибку пользователю
-        # await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка проверки данных.")
-        return # Или просто выйти
-
-    real_chat_id = update.message.chat.id
-    real_user_id = update.message.from_user.id
-    real_chat_type = update.message.chat.type
-
-    loop = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop) # Вызываем функцию проверки
-
-    # Блокируем, если техработы ВКЛЮЧЕНЫ и это НЕ админ в ЛС
-    if maintenance_active and (real_user_id != ADMIN_USER_ID or real_chat_type != 'private'):
-        logger.info(f"Команда отклонена из-за режима техработ в чате {real_chat_id}")
-        try: # Пытаемся ответить и удалить команду
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось ответить/удалить сообщение о техработах: {e}")
-        return # ВЫХОДИМ ИЗ ФУНКЦИИ
-# --->>> КОНЕЦ НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
     # Получаем chat_id, user, user_name, image_file_id (из update или аргументов)
-    image_file_id = None; chat_id = None; user = None; user_name = "Фотограф хуев"
+    image_file_id = None; image_file_unique_id = None; original_file_size = None; chat_id = None; user = None; user_name = "Фотограф хуев"
     retry_key = f'retry_pic_{direct_chat_id or (update.message.chat_id if update and update.message else None)}'
     if direct_chat_id and direct_user and direct_file_id: # Вызов из retry
         chat_id = direct_chat_id; user = direct_user; image_file_id = direct_file_id
@@ -587,8 +2274,11 @@ async def analyze_pic(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
     elif update and update.message and update.message.reply_to_message and update.message.reply_to_message.photo: # Обычный вызов
         chat_id = update.message.chat_id; user = update.message.from_user
         user_name = user.first_name if user else user_name
-        reply_msg = update.message.reply_to_message; photo_large = reply_msg.photo[-1]; image_file_id = photo_large.file_id
-        logger.info(f"Получен file_id {image_file_id} из reply_to_message.")
+        reply_msg = update.message.reply_to_message
+        photo_for_vision = pick_vision_photo_size(reply_msg.photo) # Не обязательно самый большой - модели хватает меньшего
+        image_file_id = photo_for_vision.file_id; image_file_unique_id = photo_for_vision.file_unique_id
+        original_file_size = reply_msg.photo[-1].file_size
+        logger.info(f"Получен file_id {image_file_id} ({photo_for_vision.width}x{photo_for_vision.height}) из reply_to_message.")
     else:
         error_chat_id = update.message.chat_id if update and update.message else None
         if error_chat_id: await context.bot.send_message(chat_id=error_chat_id, text="Ответь этой командой на КАРТИНКУ!")
@@ -597,12 +2287,7 @@ async def analyze_pic(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
     if not image_file_id: logger.error("Не удалось получить file_id!"); await context.bot.send_message(chat_id=chat_id, text="Не нашел ID картинки."); return
     logger.info(f"Пользователь '{user_name}' запросил анализ картинки (ID: {image_file_id}) через {IONET_VISION_MODEL_ID}")
     try: # Скачивание и вызов ИИ
-        logger.info(f"Скачивание картинки {image_file_id}...")
-        photo_file = await context.bot.get_file(image_file_id, read_timeout=60)
-        photo_bytes_io = await photo_file.download_as_bytearray(read_timeout=60)
-        photo_bytes = bytes(photo_bytes_io)
-        if not photo_bytes: raise ValueError("Скачаны пустые байты картинки")
-        logger.info(f"Картинка скачана, размер: {len(photo_bytes)} байт.")
+        image_data_uri = await prepare_vision_image(context.bot, image_file_id, image_file_unique_id, original_file_size)
         image_prompt_text = (
             f"Слышь ты, железяка ебаная с глазами ({IONET_VISION_MODEL_ID.split('/')[0]})! Я – Попиздяка, главный критик и тролль всея интернетов. Мне подсунули эту картинку, и твоя задача – помочь мне ее обосрать так, чтобы автор пошел вешаться от стыда (но втайне восхитился моим остроумием).\n\n"
             f"ЗАБУДЬ НАХУЙ про композицию, свет, качество фото и прочую техническую поебень. Меня интересует только **СУТЬ ПРОИСХОДЯЩЕЙ ХУЙНИ, НЕПОТРЕБСТВА или ТУПОСТИ на этой картинке.**\n\n"
@@ -625,60 +2310,30 @@ async def analyze_pic(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
         )
         # --->>> КОНЕЦ НОВОГО ПРОМПТА <<<---
 
-        base64_image = base64.b64encode(photo_bytes).decode('utf-8')
-        messages_for_api = [{"role": "user","content": [ {"type": "text", "text": image_prompt_text}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}} ]}]
+        messages_for_api = [{"role": "user","content": [ {"type": "text", "text": image_prompt_text}, {"type": "image_url", "image_url": {"url": image_data_uri}} ]}]
 
         thinking_message = await context.bot.send_message(chat_id=chat_id, text=f"Так-так, блядь, ща посмотрим ({IONET_VISION_MODEL_ID.split('/')[0]} видит!)...") # Заменили имя модели
-        sarcastic_comment = await _call_ionet_api(messages_for_api, IONET_VISION_MODEL_ID, 300, 0.75) or "[Попиздяка промолчал]" # Уменьшили max_tokens и температуру
+        sarcastic_comment = await _call_ionet_api(messages_for_api, IONET_VISION_MODEL_ID, 300, 0.75, chat_id=chat_id) or "[Попиздяка промолчал]" # Уменьшили max_tokens и температуру
         if not sarcastic_comment.startswith("🗿") and not sarcastic_comment.startswith("["): sarcastic_comment = "🗿 " + sarcastic_comment
-        try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
 
         #MAX_MESSAGE_LENGTH = 4096;
         if len(sarcastic_comment) > MAX_TELEGRAM_MESSAGE_LENGTH: sarcastic_comment = sarcastic_comment[:MAX_TELEGRAM_MESSAGE_LENGTH - 3] + "..."
 
-        sent_message = await context.bot.send_message(chat_id=chat_id, text=sarcastic_comment)
+        sent_message = await replace_thinking_message(context.bot, chat_id, thinking_message, sarcastic_comment)
         logger.info(f"Отправлен коммент к картинке ai.io.net '{sarcastic_comment[:50]}...'")
         if sent_message: # Запись для /retry
              reply_doc = {"chat_id": chat_id, "message_id": sent_message.message_id, "analysis_type": "pic", "source_file_id": image_file_id, "timestamp": datetime.datetime.now(datetime.timezone.utc)}
-             try: loop = asyncio.get_running_loop(); await loop.run_in_executor(None, lambda: last_reply_collection.update_one({"chat_id": chat_id}, {"$set": reply_doc}, upsert=True))
+             try: loop = asyncio.get_running_loop(); await last_reply_collection.update_one({"chat_id": chat_id}, {"$set": reply_doc}, upsert=True)
              except Exception as e: logger.error(f"Ошибка записи /retry (pic) в MongoDB: {e}")
     except Exception as e: # Общая ошибка
         logger.error(f"ПИЗДЕЦ в analyze_pic: {e}", exc_info=True)
-        try:
-            if 'thinking_message' in locals(): await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
-        await context.bot.send_message(chat_id=chat_id, text=f"Бля, {user_name}, я обосрался при анализе картинки. Ошибка: `{type(e).__name__}`.")
+        await replace_thinking_message(context.bot, chat_id, locals().get('thinking_message'), f"Бля, {user_name}, я обосрался при анализе картинки. Ошибка: `{type(e).__name__}`.")
 
 # --- ОСТАЛЬНЫЕ ФУНКЦИИ С ВЫЗОВОМ ИИ (ПЕРЕПИСАНЫ) ---
 
 # --- ПОЛНАЯ ФУНКЦИЯ ДЛЯ КОМАНДЫ /retry (ВЕРСИЯ ДЛЯ БД, БЕЗ FAKE UPDATE) ---
+@maintenance_gate()
 async def retry_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-         # --->>> НАЧАЛО НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
-# Проверяем наличие update и message - без них проверка невозможна
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-        logger.warning(f"Не могу проверить техработы - нет данных в update ({__name__})") # Логгируем имя текущей функции
-        # Если это важная команда, можно тут вернуть ошибку пользователю
-        # await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка проверки данных.")
-        return # Или просто выйти
-
-    real_chat_id = update.message.chat.id
-    real_user_id = update.message.from_user.id
-    real_chat_type = update.message.chat.type
-
-    loop = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop) # Вызываем функцию проверки
-
-    # Блокируем, если техработы ВКЛЮЧЕНЫ и это НЕ админ в ЛС
-    if maintenance_active and (real_user_id != ADMIN_USER_ID or real_chat_type != 'private'):
-        logger.info(f"Команда отклонена из-за режима техработ в чате {real_chat_id}")
-        try: # Пытаемся ответить и удалить команду
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось ответить/удалить сообщение о техработах: {e}")
-        return # ВЫХОДИМ ИЗ ФУНКЦИИ
-# --->>> КОНЕЦ НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
     """Повторяет последний анализ (текста, картинки, стиха и т.д.), читая данные из MongoDB и вызывая нужную функцию напрямую."""
     if not update.message or not update.message.reply_to_message:
         await context.bot.send_message(chat_id=update.message.chat_id, text="Надо ответить этой командой на тот МОЙ высер, который ты хочешь переделать.")
@@ -702,8 +2357,7 @@ async def retry_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     last_reply_data = None
     try:
-        loop = asyncio.get_running_loop()
-        last_reply_data = await loop.run_in_executor(None, lambda: last_reply_collection.find_one({"chat_id": chat_id}))
+        last_reply_data = await last_reply_collection.find_one({"chat_id": chat_id})
     except Exception as e:
         logger.error(f"Ошибка чтения /retry из MongoDB для чата {chat_id}: {e}", exc_info=True)
         await context.bot.send_message(chat_id=chat_id, text="Бля, не смог залезть в свою память (БД).")
@@ -793,32 +2447,8 @@ async def retry_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # --- КОНЕЦ ПОЛНОЙ ФУНКЦИИ /retry ---
 
+@maintenance_gate()
 async def generate_poem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-         # --->>> НАЧАЛО НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
-# Проверяем наличие update и message - без них проверка невозможна
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-        logger.warning(f"Не могу проверить техработы - нет данных в update ({__name__})") # Логгируем имя текущей функции
-        # Если это важная команда, можно тут вернуть ошибку пользователю
-        # await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка проверки данных.")
-        return # Или просто выйти
-
-    real_chat_id = update.message.chat.id
-    real_user_id = update.message.from_user.id
-    real_chat_type = update.message.chat.type
-
-    loop = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop) # Вызываем функцию проверки
-
-    # Блокируем, если техработы ВКЛЮЧЕНЫ и это НЕ админ в ЛС
-    if maintenance_active and (real_user_id != ADMIN_USER_ID or real_chat_type != 'private'):
-        logger.info(f"Команда отклонена из-за режима техработ в чате {real_chat_id}")
-        try: # Пытаемся ответить и удалить команду
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось ответить/удалить сообщение о техработах: {e}")
-        return # ВЫХОДИМ ИЗ ФУНКЦИИ
-# --->>> КОНЕЦ НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
     """Генерирует саркастичный стишок про указанное имя."""
     # --->>> ЗАМЕНЯЕМ КОММЕНТАРИЙ НА РЕАЛЬНЫЙ КОД <<<---
     chat_id = None
@@ -908,46 +2538,23 @@ async def generate_poem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
     try:
         thinking_message = await context.bot.send_message(chat_id=chat_id, text=f"Так, блядь, ща рифму подберу для '{target_name}'...")
-        poem_text = await _call_ionet_api([{"role": "user", "content": poem_prompt}], IONET_TEXT_MODEL_ID, 150, 0.9) or f"[Стих про {target_name} не родился]"
+        poem_text = await _call_ionet_api_streaming(
+            [{"role": "user", "content": poem_prompt}], route_model("poem"), 150, 0.9,
+            bot=context.bot, placeholder_message=thinking_message, feature="poem", chat_id=chat_id
+        ) or f"[Стих про {target_name} не родился]"
         if not poem_text.startswith("🗿") and not poem_text.startswith("["): poem_text = "🗿 " + poem_text
-        try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
         # = 4096; # Обрезка
         if len(poem_text) > MAX_TELEGRAM_MESSAGE_LENGTH: poem_text = poem_text[:MAX_TELEGRAM_MESSAGE_LENGTH - 3] + "..."
-        sent_message = await context.bot.send_message(chat_id=chat_id, text=poem_text)
+        sent_message = await replace_thinking_message(context.bot, chat_id, thinking_message, poem_text)
         logger.info(f"Отправлен стих про {target_name}.")
         if sent_message: # Запись для /retry
             reply_doc = { "chat_id": chat_id, "message_id": sent_message.message_id, "analysis_type": "poem", "target_name": target_name, "timestamp": datetime.datetime.now(datetime.timezone.utc) }
-            try: loop = asyncio.get_running_loop(); await loop.run_in_executor(None, lambda: last_reply_collection.update_one({"chat_id": chat_id}, {"$set": reply_doc}, upsert=True))
+            try: await last_reply_collection.update_one({"chat_id": chat_id}, {"$set": reply_doc}, upsert=True)
             except Exception as e: logger.error(f"Ошибка записи /retry (poem) в MongoDB: {e}")
     except Exception as e: logger.error(f"ПИЗДЕЦ при генерации стиха про {target_name}: {e}", exc_info=True); await context.bot.send_message(chat_id=chat_id, text=f"Бля, {user_name}, не могу сочинить про '{target_name}'. Ошибка: `{type(e).__name__}`.")
 
+@maintenance_gate()
 async def get_prediction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-         # --->>> НАЧАЛО НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
-# Проверяем наличие update и message - без них проверка невозможна
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-        logger.warning(f"Не могу проверить техработы - нет данных в update ({__name__})") # Логгируем имя текущей функции
-        # Если это важная команда, можно тут вернуть ошибку пользователю
-        # await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка проверки данных.")
-        return # Или просто выйти
-
-    real_chat_id = update.message.chat.id
-    real_user_id = update.message.from_user.id
-    real_chat_type = update.message.chat.type
-
-    loop = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop) # Вызываем функцию проверки
-
-    # Блокируем, если техработы ВКЛЮЧЕНЫ и это НЕ админ в ЛС
-    if maintenance_active and (real_user_id != ADMIN_USER_ID or real_chat_type != 'private'):
-        logger.info(f"Команда отклонена из-за режима техработ в чате {real_chat_id}")
-        try: # Пытаемся ответить и удалить команду
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось ответить/удалить сообщение о техработах: {e}")
-        return # ВЫХОДИМ ИЗ ФУНКЦИИ
-# --->>> КОНЕЦ НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
     if not update.message or not update.message.from_user: return
     chat_id = update.message.chat_id; user = update.message.from_user; user_name = user.first_name or "Любопытная Варвара"
     logger.info(f"Пользователь '{user_name}' запросил предсказание в чате {chat_id}")
@@ -968,39 +2575,20 @@ async def get_prediction(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         thinking_message = await context.bot.send_message(chat_id=chat_id, text=thinking_text)
         messages_for_api = [{"role": "user", "content": prediction_prompt}]
-        prediction_text = await _call_ionet_api(messages_for_api, IONET_TEXT_MODEL_ID, 100, (0.6 if is_positive else 0.9)) or "[Предсказание потерялось]"
+        prediction_text = await _call_ionet_api(messages_for_api, route_model("prediction"), 100, (0.6 if is_positive else 0.9), chat_id=chat_id) or "[Предсказание потерялось]"
         if not prediction_text.startswith(("🗿", "✨", "[")): prediction_text = final_prefix + prediction_text
-        try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
         #MAX_MESSAGE_LENGTH = 4096;
         if len(prediction_text) > MAX_TELEGRAM_MESSAGE_LENGTH: prediction_text = prediction_text[:MAX_TELEGRAM_MESSAGE_LENGTH - 3] + "..."
-        await context.bot.send_message(chat_id=chat_id, text=prediction_text)
+        await replace_thinking_message(context.bot, chat_id, thinking_message, prediction_text)
         logger.info(f"Отправлено предсказание для {user_name}.")
         # Запись для /retry не делаем для предсказаний, т.к. оно рандомное
     except Exception as e: logger.error(f"ПИЗДЕЦ при генерации предсказания для {user_name}: {e}", exc_info=True); await context.bot.send_message(chat_id=chat_id, text=f"Бля, {user_name}, мой шар треснул. Ошибка: `{type(e).__name__}`.")
 
 # --- ПЕРЕДЕЛАННАЯ get_pickup_line (С КОНТЕКСТОМ И ОТВЕТОМ НА СООБЩЕНИЕ) ---
+@maintenance_gate("🔧 Техработы. Не до подкатов сейчас.")
 async def get_pickup_line(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Генерирует кринжовый подкат к пользователю, на сообщение которого ответили, с учетом контекста."""
 
-    # 1. Проверка техработ (ОБЯЗАТЕЛЬНО!)
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-         logger.warning("get_pickup_line: нет данных для проверки техработ")
-         return
-    real_chat_id = update.message.chat.id; real_user_id = update.message.from_user.id; real_chat_type = update.message.chat.type
-    try: admin_id = int(os.getenv("ADMIN_USER_ID", "0"))
-    except ValueError: admin_id = 0
-    if admin_id == 0: logger.warning("ADMIN_USER_ID не задан!")
-    loop = asyncio.get_running_loop(); maintenance_active = await is_maintenance_mode(loop)
-    if maintenance_active and (real_user_id != admin_id or real_chat_type != 'private'):
-        logger.info(f"Команда pickup отклонена из-за техработ в чате {real_chat_id}")
-        try: await context.bot.send_message(chat_id=real_chat_id, text="🔧 Техработы. Не до подкатов сейчас.")
-        except Exception: pass
-        # Удалим команду, если можем
-        try: await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception: pass
-        return
-
     # 2. Проверка, что это ответ на сообщение и не на бота
     if (not update.message.reply_to_message or
             not update.message.reply_to_message.from_user or
@@ -1021,10 +2609,7 @@ async def get_pickup_line(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_context = "[Недавно ничего не писал(а)]"
     USER_CONTEXT_LIMIT_PICKUP = 3 # Достаточно пары последних фраз
     try:
-        query = {"chat_id": chat_id, "user_id": target_user.id}
-        sort_order = [("timestamp", pymongo.DESCENDING)]
-        user_hist_cursor = await loop.run_in_executor(None, lambda: history_collection.find(query).sort(sort_order).limit(USER_CONTEXT_LIMIT_PICKUP))
-        user_messages = list(user_hist_cursor)[::-1]
+        user_messages = await get_recent_user_messages(chat_id, target_user.id, USER_CONTEXT_LIMIT_PICKUP)
         if user_messages:
             context_lines = [msg.get('text', '[...]') for msg in user_messages]
             user_context = "\n".join(context_lines)
@@ -1053,11 +2638,9 @@ async def get_pickup_line(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         messages_for_api = [{"role": "user", "content": pickup_prompt}]
         # Вызов ИИ (_call_ionet_api или model.generate_content_async)
         pickup_line_text = await _call_ionet_api( # ИЛИ model.generate_content_async
-            messages=messages_for_api, model_id=IONET_TEXT_MODEL_ID, max_tokens=100, temperature=1.0 # Высокая температура для креатива
+            messages=messages_for_api, model_id=route_model("pickup"), max_tokens=100, temperature=1.0, chat_id=chat_id # Высокая температура для креатива
         ) or f"[Подкат к {target_name} провалился]"
         if not pickup_line_text.startswith(("🗿", "[")): pickup_line_text = "🗿 " + pickup_line_text
-        try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
 
         #MAX_MESSAGE_LENGTH = 4096; # Обрезка
         if len(pickup_line_text) > MAX_TELEGRAM_MESSAGE_LENGTH: pickup_line_text = pickup_line_text[:MAX_TELEGRAM_MESSAGE_LENGTH - 3] + "..."
@@ -1065,22 +2648,20 @@ async def get_pickup_line(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Отправляем подкат (НЕ как ответ, а просто в чат, упоминая цель)
         target_mention = target_user.mention_html() if target_user.username else f"<b>{target_name}</b>"
         final_text = f"Подкат для {target_mention} от {user.mention_html()}:\n\n{pickup_line_text}"
-        await context.bot.send_message(chat_id=chat_id, text=final_text, parse_mode='HTML')
+        await replace_thinking_message(context.bot, chat_id, thinking_message, final_text, parse_mode='HTML')
         logger.info(f"Отправлен подкат к {target_name}.")
         # Запись для /retry (если нужна, с type='pickup', target_id, target_name)
         # ...
 
     except Exception as e:
         logger.error(f"ПИЗДЕЦ при генерации подката к {target_name}: {e}", exc_info=True)
-        try:
-            if 'thinking_message' in locals(): await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
-        await context.bot.send_message(chat_id=chat_id, text=f"Бля, {user_name}, не смог подкатить к '{target_name}'. Видимо, он(а) слишком хорош(а) для такого говна, как я. Ошибка: `{type(e).__name__}`.")
+        await replace_thinking_message(context.bot, chat_id, locals().get('thinking_message'), f"Бля, {user_name}, не смог подкатить к '{target_name}'. Видимо, он(а) слишком хорош(а) для такого говна, как я. Ошибка: `{type(e).__name__}`.")
 
 # --- КОНЕЦ ПЕРЕДЕЛАННОЙ get_pickup_line ---
 
 
 # --- ПЕРЕПИСАННАЯ roast_user (С КОНТЕКСТОМ ИЗ БД И ИСПРАВЛЕНИЕМ ОШИБКИ ID) ---
+@maintenance_gate("🔧 Сорян, у меня сейчас технические работы. Не до прожарок.")
 async def roast_user(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
                      direct_chat_id: int | None = None,
                      direct_user: User | None = None, # Кто заказывает (для /roastme или /retry)
@@ -1148,22 +2729,6 @@ async def roast_user(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
         logger.error("Roast: Не удалось определить chat_id.")
         return
 
-    # --->>> 2. ПРОВЕРКА ТЕХРАБОТ (после определения chat_id и user_who_requested) <<<---
-    if user_who_requested: # Нужен user_who_requested для проверки админа
-        loop_for_maint = asyncio.get_running_loop()
-        maintenance_active = await is_maintenance_mode(loop_for_maint)
-        current_chat_type = update.message.chat.type if update and update.message else 'private' # Предполагаем private для direct вызовов
-
-        if maintenance_active and (user_who_requested.id != ADMIN_USER_ID or current_chat_type != 'private'):
-            logger.info(f"Команда roast отклонена из-за режима техработ в чате {chat_id}")
-            try:
-                await context.bot.send_message(chat_id=chat_id, text="🔧 Сорян, у меня сейчас технические работы. Не до прожарок.")
-                if update and update.message: # Удаляем команду, если она была
-                     await context.bot.delete_message(chat_id=chat_id, message_id=update.message.message_id)
-            except Exception as e:
-                logger.warning(f"Не удалось ответить/удалить сообщение о техработах (roast): {e}")
-            return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
 
 
     # --->>> 3. Дополнительные проверки после определения target_user/target_name <<<---
@@ -1196,18 +2761,14 @@ async def roast_user(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
     # --->>> 5. ЧТЕНИЕ КОНТЕКСТА (ПОСЛЕДНИХ СООБЩЕНИЙ ЦЕЛИ) ИЗ БД <<<---
     user_context = "[Недавних сообщений не найдено или цель не имеет ID]"
     USER_CONTEXT_LIMIT = 20
+    context_high_water_message_id = None # Для кэша ответов: последнее сообщение цели, попавшее в контекст
     if target_user: # Контекст ищем только если есть ID цели
         try:
-            loop_for_context = asyncio.get_running_loop()
-            query = {"chat_id": chat_id, "user_id": target_user.id}
-            sort_order = [("timestamp", pymongo.DESCENDING)]
-            user_hist_cursor = await loop_for_context.run_in_executor(
-                None, lambda: history_collection.find(query).sort(sort_order).limit(USER_CONTEXT_LIMIT)
-            )
-            user_messages = list(user_hist_cursor)[::-1]
+            user_messages = await get_recent_user_messages(chat_id, target_user.id, USER_CONTEXT_LIMIT)
             if user_messages:
                 context_lines = [msg.get('text', '[пустое сообщение]') for msg in user_messages]
                 user_context = "\n".join(context_lines)
+                context_high_water_message_id = user_messages[-1].get("message_id")
                 logger.info(f"Найден контекст ({len(user_messages)} сообщ.) для {target_name} (ID: {target_user.id}).")
             else:
                  logger.info(f"Контекст для {target_name} (ID: {target_user.id}) не найден.")
@@ -1242,14 +2803,13 @@ async def roast_user(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
     try:
         thinking_message = await context.bot.send_message(chat_id=chat_id, text=f"🗿 Изучаю под микроскопом высеры '{target_name}'... Ща будет прожарка.")
         messages_for_api = [{"role": "user", "content": roast_prompt}]
-        roast_text = await _call_ionet_api(
-            messages=messages_for_api, model_id=IONET_TEXT_MODEL_ID, max_tokens=200, temperature=0.85
+        roast_text = await cached_ionet_completion(
+            messages=messages_for_api, model_id=route_model("roast"), max_tokens=200, temperature=0.85,
+            high_water_message_id=context_high_water_message_id, is_retry=is_retry_call,
+            bot=context.bot, placeholder_message=thinking_message, feature="roast", chat_id=chat_id
         ) or f"[Роаст для {target_name} не удался]"
 
         if not roast_text.startswith(("🗿", "[")): roast_text = "🗿 " + roast_text
-        if thinking_message:
-            try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-            except Exception: pass
 
         # --->>> 7. ОТПРАВКА И ЗАПИСЬ ДЛЯ /RETRY <<<---
         target_mention_html = target_name # По умолчанию просто имя
@@ -1266,7 +2826,8 @@ async def roast_user(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
         final_text = f"Прожарка для {target_mention_html}:\n\n{roast_text}"
         if len(final_text) > MAX_TELEGRAM_MESSAGE_LENGTH: # MAX_MESSAGE_LENGTH должен быть определен глобально
             final_text = final_text[:MAX_TELEGRAM_MESSAGE_LENGTH-20] + "... (слишком длинно)"
-        sent_message = await context.bot.send_message(chat_id=chat_id, text=final_text, parse_mode='HTML')
+        sent_message = await replace_thinking_message(context.bot, chat_id, thinking_message, final_text, parse_mode='HTML')
+        thinking_message = None # Заглушка теперь и есть роаст - в except ее удалять нельзя
         logger.info(f"Отправлен роаст для {target_name}.")
 
         if sent_message and user_who_requested: # user_who_requested нужен для /retry
@@ -1283,18 +2844,14 @@ async def roast_user(update: Update | None, context: ContextTypes.DEFAULT_TYPE,
                 "requester_first_name_for_retry": user_who_requested.first_name,
                 "requester_username_for_retry": user_who_requested.username
             }
-            loop_for_retry_save = asyncio.get_running_loop()
-            await loop_for_retry_save.run_in_executor(None, lambda: last_reply_collection.update_one(
+            await last_reply_collection.update_one(
                 {"chat_id": chat_id}, {"$set": reply_doc}, upsert=True
-            ))
+            )
             logger.debug(f"Сохранены данные для /retry (roast) в чате {chat_id}")
 
     except Exception as e:
         logger.error(f"ПИЗДЕЦ при генерации роаста для {target_name}: {e}", exc_info=True)
-        if thinking_message:
-            try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-            except Exception: pass
-        await context.bot.send_message(chat_id=chat_id, text=f"Бля, {user_name_who_requested}, не смог прожарить '{target_name}'. Ошибка: `{type(e).__name__}`.")
+        await replace_thinking_message(context.bot, chat_id, thinking_message, f"Бля, {user_name_who_requested}, не смог прожарить '{target_name}'. Ошибка: `{type(e).__name__}`.")
 # --- КОНЕЦ ПЕРЕПИСАННОЙ roast_user ---
 
 # --- НОВАЯ reply_to_bot_handler (УЗНАЕТ АДМИНА И РЕАГИРУЕТ ЧЕРЕЗ ИИ) ---
@@ -1309,7 +2866,7 @@ async def reply_to_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     chat_id = update.message.chat.id
     user_who_replied = update.message.from_user
-    user_text_input = update.message.text.strip()
+    user_text_input = truncate_to_tokens(update.message.text.strip(), 300) # Вставляется в промпт несколько раз - простыню режем
     user_name = user_who_replied.first_name or "Остряк Самоучка"
 
     # Текст оригинального сообщения бота, на которое ответили
@@ -1347,9 +2904,9 @@ async def reply_to_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
             admin_response_text = await _call_ionet_api(
                 messages=[{"role": "user", "content": admin_reply_prompt}],
-                model_id=IONET_TEXT_MODEL_ID, # Твоя текстовая модель
+                model_id=route_model("comeback"), # Короткий ответ - мелкой модели хватит
                 max_tokens=150, # Для короткого ответа
-                temperature=0.7 # Не слишком креативно, но и не совсем сухо
+                temperature=0.7, priority=LLM_PRIORITY_INTERACTIVE, chat_id=chat_id # Не слишком креативно, но и не совсем сухо
             ) or f"🗿 Да, мой Повелитель {user_name}?" # Заглушка на случай ошибки API
 
             if not admin_response_text.startswith(("🗿", "[")):
@@ -1382,7 +2939,7 @@ async def reply_to_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     # --->>> Детектор спама/байта (как был) <<<---
     last_user_reply_doc = None; is_spam = False # Переименовал last_user_reply для ясности
     try:
-        activity_doc = await loop.run_in_executor(None, lambda: chat_activity_collection.find_one({"chat_id": chat_id}))
+        activity_doc = await chat_activity_collection.find_one({"chat_id": chat_id})
         if activity_doc and "last_user_replies" in activity_doc and str(user_who_replied.id) in activity_doc["last_user_replies"]:
              last_user_reply_doc = activity_doc["last_user_replies"][str(user_who_replied.id)] # Это уже сам текст прошлого ответа
         # Сравниваем текущий короткий ввод с предыдущим полным (если он был)
@@ -1394,7 +2951,7 @@ async def reply_to_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             is_spam = True; logger.info(f"Обнаружен спам/байт от {user_name}.")
         
         update_field = f"last_user_replies.{user_who_replied.id}"
-        await loop.run_in_executor( None, lambda: chat_activity_collection.update_one( {"chat_id": chat_id}, {"$set": {update_field: user_text_input}}, upsert=True ) )
+        await chat_activity_collection.update_one( {"chat_id": chat_id}, {"$set": {update_field: user_text_input}}, upsert=True )
     except Exception as e:
         logger.error(f"Ошибка MongoDB в spam check (reply_to_bot_handler): {e}")
 
@@ -1406,15 +2963,10 @@ async def reply_to_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     # --->>> Получение контекста юзера (как было) <<<---
     user_context_for_reply = "[Нет контекста сообщений от этого пользователя]" # Переименовал
     try:
-        query_reply = {"chat_id": chat_id, "user_id": user_who_replied.id}
-        sort_order_reply = [("timestamp", pymongo.DESCENDING)]
-        # USER_CONTEXT_LIMIT_REPLY - должна быть определена, например 5
         USER_CONTEXT_LIMIT_REPLY = 5 
-        user_hist_cursor_reply = await loop.run_in_executor(None, lambda: history_collection.find(query_reply).sort(sort_order_reply).limit(USER_CONTEXT_LIMIT_REPLY))
-        user_messages_reply = list(user_hist_cursor_reply)[::-1]
+        user_messages_reply = await get_recent_user_messages(chat_id, user_who_replied.id, USER_CONTEXT_LIMIT_REPLY)
         if user_messages_reply:
-            context_lines_reply = [f"- {msg.get('text', '[...]')}" for msg in user_messages_reply]
-            user_context_for_reply = "\n".join(context_lines_reply)
+            user_context_for_reply = build_history_context(user_messages_reply, IONET_TEXT_MODEL_ID, "reply", with_names=False, budget_tokens=800)
     except Exception as db_e_reply:
         logger.error(f"Ошибка чтения контекста юзера для ответа на ответ: {db_e_reply}")
     # --->>> КОНЕЦ ПОЛУЧЕНИЯ КОНТЕКСТА <<<---
@@ -1439,7 +2991,7 @@ async def reply_to_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await asyncio.sleep(random.uniform(0.5, 1.2)) # Небольшая задержка перед ответом
         messages_for_api_comeback = [{"role": "user", "content": comeback_prompt}]
         response_text_comeback = await _call_ionet_api(
-            messages=messages_for_api_comeback, model_id=IONET_TEXT_MODEL_ID, max_tokens=150, temperature=0.85
+            messages=messages_for_api_comeback, model_id=route_model("comeback"), max_tokens=150, temperature=0.85, priority=LLM_PRIORITY_INTERACTIVE, chat_id=chat_id
         ) or f"[Не смог придумать огрызание для {user_name}]"
 
         if not response_text_comeback.startswith(("🗿", "[")):
@@ -1459,21 +3011,31 @@ async def reply_to_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 # --- КОНЕЦ НОВОЙ reply_to_bot_handler ---
 
 # --- НОВАЯ ФУНКЦИЯ ДЛЯ HEARTBEAT ---
+# Сердце бьется в памяти: /healthz читает его без похода в базу. В Монгу пишем редко и только если
+# HEARTBEAT_PERSIST_INTERVAL_SECONDS > 0 (несколько инстансов, внешний мониторинг смотрит в bot_status).
+HEARTBEAT_INTERVAL_SECONDS = 30
+HEARTBEAT_PERSIST_INTERVAL_SECONDS = int(os.getenv("HEARTBEAT_PERSIST_INTERVAL_SECONDS", "0")) # 0 - не писать в БД
+HEARTBEAT_INSTANCE_ID = os.getenv("RENDER_INSTANCE_ID") or os.getenv("HOSTNAME") or "main"
+heartbeat_state = {"last_beat": None, "last_beat_utc": None, "persisted_at": None, "application": None}
+
 async def update_heartbeat(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Просто обновляет временную метку в БД, чтобы показать, что бот жив."""
+    """Отмечает в памяти, что JobQueue жив; раз в HEARTBEAT_PERSIST_INTERVAL_SECONDS дублирует метку в БД."""
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    heartbeat_state["last_beat"] = time.monotonic(); heartbeat_state["last_beat_utc"] = now_utc
+    if HEARTBEAT_PERSIST_INTERVAL_SECONDS <= 0:
+        return
+    if heartbeat_state["persisted_at"] and time.monotonic() - heartbeat_state["persisted_at"] < HEARTBEAT_PERSIST_INTERVAL_SECONDS:
+        return
     try:
-        # Используем существующую коллекцию bot_status
-        await asyncio.get_running_loop().run_in_executor(
-            None,
-            lambda: bot_status_collection.update_one(
-                {"_id": "heartbeat_status"},
-                {"$set": {"last_heartbeat_utc": datetime.datetime.now(datetime.timezone.utc)}},
+        # Используем существующую коллекцию bot_status, по документу на инстанс
+        await bot_status_collection.update_one(
+                {"_id": f"heartbeat_status:{HEARTBEAT_INSTANCE_ID}"},
+                {"$set": {"last_heartbeat_utc": now_utc, "instance": HEARTBEAT_INSTANCE_ID}},
                 upsert=True
             )
-        )
-        # logger.debug("Heartbeat updated.") # Можно раскомментировать для отладки
+        heartbeat_state["persisted_at"] = time.monotonic()
     except Exception as e:
-        logger.error(f"CRITICAL: Не удалось обновить Heartbeat в MongoDB: {e}")
+        logger.error(f"Не удалось сохранить Heartbeat в MongoDB (в памяти он свежий): {e}")
 # --- КОНЕЦ НОВОЙ ФУНКЦИИ ---
 
 # --- ПОЛНАЯ ИСПРАВЛЕННАЯ ФУНКЦИЯ ДЛЯ ФОНОВОЙ ЗАДАЧИ (ГЕНЕРАЦИЯ ФАКТОВ) ---
@@ -1490,17 +3052,13 @@ async def check_inactivity_and_shitpost(context: ContextTypes.DEFAULT_TYPE) -> N
 
     # --->>> ВЕСЬ КОД ДОЛЖЕН БЫТЬ ВНУТРИ ЭТОГО TRY <<<---
     try:
-        loop = asyncio.get_running_loop()
         # Ищем чаты, где последнее сообщение было давно И последний высер бота был еще давнее
         query = {
             "last_message_time": {"$lt": inactive_threshold_time},
             "last_bot_shitpost_time": {"$lt": shitpost_threshold_time}
         }
         # Получаем список ID таких чатов
-        inactive_chat_docs = await loop.run_in_executor(
-            None,
-            lambda: list(chat_activity_collection.find(query, {"chat_id": 1, "_id": 0}))
-        )
+        inactive_chat_docs = await chat_activity_collection.find(query, {"chat_id": 1, "_id": 0}).to_list()
         # --->>> ОПРЕДЕЛЯЕМ ПЕРЕМЕННУЮ ЗДЕСЬ <<<---
         inactive_chat_ids = [doc["chat_id"] for doc in inactive_chat_docs]
 
@@ -1532,9 +3090,9 @@ async def check_inactivity_and_shitpost(context: ContextTypes.DEFAULT_TYPE) -> N
         # ВАЖНО: Убедись, что переменная IONET_TEXT_MODEL_ID определена, если используешь _call_ionet_api
         fact_text = await _call_ionet_api( # Или await model.generate_content_async(...) для Gemini
             messages=[{"role": "user", "content": fact_prompt}],
-            model_id=IONET_TEXT_MODEL_ID, # ИЛИ НЕ ИСПОЛЬЗУЙ ЭТОТ ПАРАМЕТР ДЛЯ GEMINI
+            model_id=route_model("fact"), # ИЛИ НЕ ИСПОЛЬЗУЙ ЭТОТ ПАРАМЕТР ДЛЯ GEMINI
             max_tokens=150,
-            temperature=1.1
+            temperature=1.1, priority=LLM_PRIORITY_BACKGROUND, chat_id=target_chat_id
         ) or "[Генератор бреда сломался]"
 
         # Добавляем префикс и обрабатываем ошибки API (если _call_ionet_api их возвращает как строки)
@@ -1558,7 +3116,7 @@ async def check_inactivity_and_shitpost(context: ContextTypes.DEFAULT_TYPE) -> N
             logger.info(f"Отправлен рандомный факт в НЕАКТИВНЫЙ чат {target_chat_id}")
 
             # ОБНОВЛЯЕМ ВРЕМЯ ПОСЛЕДНЕГО ВЫСЕРА БОТА в БД ТОЛЬКО ЕСЛИ ОТПРАВКА УСПЕШНА
-            await loop.run_in_executor( None, lambda: chat_activity_collection.update_one( {"chat_id": target_chat_id}, {"$set": {"last_bot_shitpost_time": now}} ) )
+            await chat_activity_collection.update_one( {"chat_id": target_chat_id}, {"$set": {"last_bot_shitpost_time": now}} )
             logger.info(f"Обновлено время последнего высера для чата {target_chat_id}")
 
         except (telegram.error.Forbidden, telegram.error.BadRequest) as e:
@@ -1574,32 +3132,8 @@ async def check_inactivity_and_shitpost(context: ContextTypes.DEFAULT_TYPE) -> N
 # --- КОНЕЦ ПОЛНОЙ ИСПРАВЛЕННОЙ ФУНКЦИИ ---
 
 # --- ФУНКЦИЯ ДЛЯ /help ---
+@maintenance_gate()
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-         # --->>> НАЧАЛО НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
-# Проверяем наличие update и message - без них проверка невозможна
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-        logger.warning(f"Не могу проверить техработы - нет данных в update ({__name__})") # Логгируем имя текущей функции
-        # Если это важная команда, можно тут вернуть ошибку пользователю
-        # await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка проверки данных.")
-        return # Или просто выйти
-
-    real_chat_id = update.message.chat.id
-    real_user_id = update.message.from_user.id
-    real_chat_type = update.message.chat.type
-
-    loop = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop) # Вызываем функцию проверки
-
-    # Блокируем, если техработы ВКЛЮЧЕНЫ и это НЕ админ в ЛС
-    if maintenance_active and (real_user_id != ADMIN_USER_ID or real_chat_type != 'private'):
-        logger.info(f"Команда отклонена из-за режима техработ в чате {real_chat_id}")
-        try: # Пытаемся ответить и удалить команду
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось ответить/удалить сообщение о техработах: {e}")
-        return # ВЫХОДИМ ИЗ ФУНКЦИИ
-# --->>> КОНЕЦ НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
     """Отправляет сообщение со справкой о возможностях бота и реквизитами для доната."""
     user_name = update.message.from_user.first_name or "щедрый ты мой"
     logger.info(f"Пользователь '{user_name}' запросил справку (/help)")
@@ -1713,82 +3247,521 @@ def index():
     """Простая страница, чтобы видеть, что веб-сервер работает."""
     return "Popizdyaka web server is running. Use /healthz for bot status.", 200
 
-@app.route('/healthz')
-def health_check():
-    """
-    Умная проверка состояния.
-    Возвращает 200 OK, если бот "бьет сердцем".
-    Возвращает 503 Service Unavailable, если "сердце" остановилось.
-    """
-    HEARTBEAT_TOLERANCE_SECONDS = 90  # Допуск (3 интервала по 30 сек)
+def _collect_state_gauges() -> list:
+    """Текущее состояние очередей и кэшей для /metrics (читаем только скаляры - это поток Flask)."""
+    return [
+        ("bot_write_behind_queue_depth", "Сообщений в очереди write-behind", [({}, write_behind_queue.qsize() if write_behind_queue else 0)]),
+        ("bot_llm_active_requests", "Запросов к ИИ в работе", [({}, llm_scheduler_state["active"])]),
+        ("bot_llm_queue_depth", "Ждут слота к ИИ по приоритетам",
+         [({"priority": name}, len(llm_waiters[priority])) for priority, name in LLM_PRIORITY_NAMES.items()]),
+        ("bot_llm_breakers_open", "Моделей с открытым предохранителем",
+         [({}, sum(1 for breaker in list(llm_breakers.values()) if breaker["state"] == "open"))]),
+        ("bot_profile_cache_size", "Профилей в кэше", [({}, len(profile_cache))]),
+        ("bot_event_loop_lag_last_seconds", "Последний замер лага event loop", [({}, event_loop_lag_state["last"])]),
+        ("bot_maintenance_active", "Режим техработ", [({}, int(maintenance_state["active"]))]),
+        ("bot_update_lanes", "Полос апдейтов (чат/кнопки чата) с работой", [({}, len(update_processor.lanes))]),
+        ("bot_update_lane_depth", "Апдейтов в полосе (в работе + ждут), 10 самых длинных",
+         [({"kind": kind, "chat_id": lane_chat_id}, depth) for (kind, lane_chat_id), depth in update_processor.deepest_lanes(10)]),
+        ("bot_telegram_outbound_waiting", "Исходящих запросов ждут жетона", [({}, outbound_limiter.waiting)]),
+        ("bot_telegram_chat_buckets", "Ведер жетонов по чатам в памяти", [({}, len(outbound_limiter.chats))]),
+    ]
 
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus."""
+    return Response(render_metrics(_collect_state_gauges()), status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --->>> /healthz БЕЗ ПОХОДА В БАЗУ (ASGI) <<<---
+# /healthz отвечает прямо из лупа по состоянию в памяти: сердцебиение, лаг лупа, очередь апдейтов, зависимости.
+# Остальные роуты - старый Flask через WSGI-обертку Hypercorn (в потоке, луп не блокирует).
+HEALTH_HEARTBEAT_TOLERANCE_SECONDS = 3 * HEARTBEAT_INTERVAL_SECONDS # Допуск (3 пропущенных удара)
+HEALTH_MAX_EVENT_LOOP_LAG_SECONDS = float(os.getenv("HEALTH_MAX_EVENT_LOOP_LAG_SECONDS", "10"))
+HEALTH_DEPENDENCY_ERROR_WINDOW_SECONDS = 60 # Ошибка Монги свежее последнего успеха и моложе минуты - "degraded"
+
+def build_health_report() -> tuple[int, dict]:
+    """Собирает статус бота из памяти. 503 - только если перезапуск реально поможет (сердце/луп/поллинг)."""
+    now = time.monotonic()
+    problems = []
+    last_beat = heartbeat_state["last_beat"]
+    heartbeat_age = (now - last_beat) if last_beat else None
+    if heartbeat_age is None: problems.append("no heartbeat yet")
+    elif heartbeat_age > HEALTH_HEARTBEAT_TOLERANCE_SECONDS: problems.append(f"heartbeat stale by {heartbeat_age:.1f}s")
+    if event_loop_lag_state["last"] > HEALTH_MAX_EVENT_LOOP_LAG_SECONDS: problems.append(f"event loop lag {event_loop_lag_state['last']:.1f}s")
+
+    application = heartbeat_state["application"]
+    pending_updates = application.update_queue.qsize() if application else None
+    telegram_running = bool(application and application.running and (WEBHOOK_MODE or (application.updater and application.updater.running)))
+    if application and not telegram_running: problems.append("telegram update intake is not running")
+
+    mongo_status = "ok"
+    if mongo_health_state["last_error"] and (mongo_health_state["last_ok"] or 0) < mongo_health_state["last_error"] \
+            and now - mongo_health_state["last_error"] < HEALTH_DEPENDENCY_ERROR_WINDOW_SECONDS:
+        mongo_status = "degraded"
+    open_breakers = [model_id for model_id, breaker in list(llm_breakers.items()) if breaker["state"] == "open"]
+    dependencies = {
+        "mongo": {"status": mongo_status, "last_error": mongo_health_state["last_error_text"] if mongo_status != "ok" else None},
+        "llm": {"status": "degraded" if open_breakers else "ok", "open_breakers": open_breakers},
+        "write_behind": {"queue": write_behind_queue.qsize() if write_behind_queue else 0, "max": WRITE_BEHIND_MAX_QUEUE},
+    }
+    degraded = any(dep.get("status") == "degraded" for dep in dependencies.values())
+    report = {
+        "status": "unhealthy" if problems else ("degraded" if degraded else "healthy"),
+        "problems": problems,
+        "heartbeat_age_seconds": round(heartbeat_age, 1) if heartbeat_age is not None else None,
+        "event_loop_lag_seconds": round(event_loop_lag_state["last"], 4),
+        "event_loop_lag_max_seconds": round(event_loop_lag_state["max"], 4),
+        "pending_updates": pending_updates,
+        "intake": {"mode": "webhook", "received": webhook_state["received"], "rejected": webhook_state["rejected"]} if WEBHOOK_MODE else {"mode": "polling"},
+        "updates_in_lanes": sum(lane[1] for lane in list(update_processor.lanes.values())),
+        "maintenance": maintenance_state["active"],
+        "dependencies": dependencies,
+    }
+    if problems: logger.critical(f"HEALTH CHECK FAILED: {'; '.join(problems)}")
+    return (503 if problems else 200), report
+
+async def _asgi_health_check(send) -> None:
+    status_code, report = build_health_report()
+    body = json.dumps(report, ensure_ascii=False).encode()
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"application/json; charset=utf-8"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+# --->>> ПРИЕМ АПДЕЙТОВ ВЕБХУКОМ <<<---
+# Если задан TELEGRAM_WEBHOOK_URL - вместо long polling Телега сама шлет апдейты POST'ом на тот же Hypercorn.
+# Подлинность - по заголовку X-Telegram-Bot-Api-Secret-Token (секрет задаем сами в setWebhook).
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/") # Публичный адрес сервиса, например https://bot.onrender.com
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32) # Без env - новый на каждый старт, setWebhook его обновит
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40")) # 1-100, сколько параллельных POST'ов шлет Телега
+TELEGRAM_WEBHOOK_MAX_BODY_BYTES = 1024 * 1024
+WEBHOOK_MODE = bool(TELEGRAM_WEBHOOK_URL)
+webhook_state = {"application": None, "received": 0, "rejected": 0, "last_update_at": None}
+
+async def _asgi_simple_response(send, status_code: int, body: bytes = b"") -> None:
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _asgi_telegram_webhook(scope, receive, send) -> None:
+    """Принимает апдейт от Телеги: проверка секрета, разбор JSON, сразу в application.update_queue."""
+    if scope["method"] != "POST":
+        await _asgi_simple_response(send, 405); return
+    headers = dict(scope["headers"])
+    if not hmac.compare_digest(headers.get(b"x-telegram-bot-api-secret-token", b""), TELEGRAM_WEBHOOK_SECRET.encode()):
+        webhook_state["rejected"] += 1; metric_inc("bot_webhook_requests_total", {"outcome": "bad_secret"})
+        logger.warning(f"Вебхук: запрос с неверным секретом от {scope.get('client')}")
+        await _asgi_simple_response(send, 403); return
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get("body", b""))
+        if len(body) > TELEGRAM_WEBHOOK_MAX_BODY_BYTES:
+            metric_inc("bot_webhook_requests_total", {"outcome": "too_large"})
+            await _asgi_simple_response(send, 413); return
+        if not message.get("more_body"): break
+    application = webhook_state["application"]
+    if application is None or not application.running: # Телега повторит позже
+        metric_inc("bot_webhook_requests_total", {"outcome": "not_ready"})
+        await _asgi_simple_response(send, 503); return
     try:
-        # Напрямую обращаемся к коллекции, т.к. Flask работает синхронно
-        status_doc = bot_status_collection.find_one({"_id": "heartbeat_status"})
-        if not status_doc or "last_heartbeat_utc" not in status_doc:
-            logger.warning("HEALTH CHECK FAILED: Документ heartbeat не найден в БД.")
-            return Response("Bot status unknown (no heartbeat record).", status=503, mimetype='text/plain')
-
-        last_heartbeat = status_doc["last_heartbeat_utc"]
-        if last_heartbeat.tzinfo is None:
-            # pytz.utc.localize(last_heartbeat) может не сработать в синхронном коде flask
-            # поэтому используем datetime.timezone.utc
-            last_heartbeat = last_heartbeat.replace(tzinfo=datetime.timezone.utc)
+        update = Update.de_json(json.loads(body), application.bot)
+    except Exception as e:
+        logger.error(f"Вебхук: не смог разобрать апдейт: {e}")
+        metric_inc("bot_webhook_requests_total", {"outcome": "bad_json"})
+        await _asgi_simple_response(send, 400); return
+    if update is None: # Тело "null" - de_json вернул None, в очередь такое не кладем
+        metric_inc("bot_webhook_requests_total", {"outcome": "bad_update"})
+        await _asgi_simple_response(send, 400); return
+    await application.update_queue.put(update)
+    webhook_state["received"] += 1; webhook_state["last_update_at"] = time.monotonic()
+    metric_inc("bot_webhook_requests_total", {"outcome": "ok"})
+    await _asgi_simple_response(send, 200)
+# --->>> КОНЕЦ ВЕБХУКА <<<---
+
+flask_asgi_app = AsyncioWSGIMiddleware(app)
+
+async def web_app(scope, receive, send) -> None:
+    """ASGI-вход для Hypercorn: /healthz и вебхук Телеги обслуживаем сами, остальное отдаем Flask."""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup": await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown": await send({"type": "lifespan.shutdown.complete"}); return
+    if scope["type"] == "http" and scope["path"] == "/healthz":
+        await _asgi_health_check(send)
+        return
+    if WEBHOOK_MODE and scope["type"] == "http" and scope["path"] == TELEGRAM_WEBHOOK_PATH:
+        await _asgi_telegram_webhook(scope, receive, send)
+        return
+    await flask_asgi_app(scope, receive, send)
+# --->>> КОНЕЦ /healthz <<<---
 
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
-        time_diff = (now_utc - last_heartbeat).total_seconds()
 
-        if time_diff > HEARTBEAT_TOLERANCE_SECONDS:
-            logger.critical(f"HEALTH CHECK FAILED: Heartbeat устарел на {time_diff:.1f} секунд!")
-            return Response(f"Bot is unhealthy! Heartbeat is stale by {time_diff:.1f} seconds.", status=503, mimetype='text/plain')
+async def run_bot_async(application: Application) -> None: # Запускает и корректно останавливает бота
+    try:
+        logger.info("Init TG App..."); await application.initialize()
+        if WEBHOOK_MODE: # Апдейты придут POST'ом на Hypercorn (см. _asgi_telegram_webhook)
+            webhook_url = f"{TELEGRAM_WEBHOOK_URL}{TELEGRAM_WEBHOOK_PATH}"
+            logger.info(f"Set webhook {webhook_url} (max_connections={TELEGRAM_WEBHOOK_MAX_CONNECTIONS})...")
+            await application.bot.set_webhook(
+                url=webhook_url, secret_token=TELEGRAM_WEBHOOK_SECRET,
+                max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES
+            )
         else:
-            # logger.info("HEALTH CHECK PASSED: Bot is alive.") # Закомментируем, чтобы не спамить в логах
-            return Response(f"Bot is healthy. Heartbeat fresh ({time_diff:.1f}s ago).", status=200, mimetype='text/plain')
+            if not application.updater: logger.critical("No updater!"); return
+            logger.info("Start polling..."); await application.updater.start_polling(allowed_updates=Update.ALL_TYPES) # Сам снимет вебхук
+        logger.info("Start TG App..."); await application.start()
+        logger.info("Bot started (idle)..."); await asyncio.Future() # Ожидаем вечно
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError): logger.info("Stop signal received.")
+    except Exception as e: logger.critical(f"ERROR in run_bot_async: {e}", exc_info=True)
+    finally: # Shutdown
+        logger.info("Stopping bot...");
+        if application.running: await application.stop(); logger.info("App stopped.")
+        if application.updater and application.updater.is_running: await application.updater.stop(); logger.info("Updater stopped.")
+        await application.shutdown(); logger.info("Bot stopped.")
 
+# --- ФУНКЦИИ ДЛЯ УПРАВЛЕНИЯ ТЕХРАБОТАМИ (ТОЛЬКО АДМИН В ЛС) ---
+async def maintenance_on(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Включает режим техработ (только админ в ЛС)."""
+    user_id = update.message.from_user.id
+    chat_type = update.message.chat.type
+    if user_id == ADMIN_USER_ID and chat_type == 'private':
+        loop = asyncio.get_running_loop()
+        success = await set_maintenance_mode(True, loop)
+        await update.message.reply_text(f"🔧 Режим техработ {'УСПЕШНО ВКЛЮЧЕН' if success else 'НЕ УДАЛОСЬ ВКЛЮЧИТЬ (ошибка БД)'}.")
+    else:
+        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+
+async def maintenance_off(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выключает режим техработ (только админ в ЛС)."""
+    user_id = update.message.from_user.id
+    chat_type = update.message.chat.type
+    if user_id == ADMIN_USER_ID and chat_type == 'private':
+        loop = asyncio.get_running_loop()
+        success = await set_maintenance_mode(False, loop)
+        await update.message.reply_text(f"✅ Режим техработ {'УСПЕШНО ВЫКЛЮЧЕН' if success else 'НЕ УДАЛОСЬ ВЫКЛЮЧИТЬ (ошибка БД)'}.")
+    else:
+        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+
+# --- КОНЕЦ ФУНКЦИЙ ТЕХРАБОТ ---
+
+# --- ДИАГНОСТИКА ИНДЕКСОВ (ТОЛЬКО АДМИН В ЛС) ---
+async def show_indexes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает индексы всех коллекций и прогоняет explain() по горячим запросам (только админ в ЛС)."""
+    if not update.message or not update.message.from_user: return
+    if not (update.message.from_user.id == ADMIN_USER_ID and update.message.chat.type == 'private'):
+        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        index_info = await loop.run_in_executor(
+            None, lambda: {name: list(db[name].index_information().keys()) for name in MONGO_INDEXES}
+        )
+        audit_report = await loop.run_in_executor(None, lambda: audit_hot_queries(db))
+    except Exception as e:
+        logger.error(f"/indexes: ошибка диагностики: {e}", exc_info=True)
+        await update.message.reply_text(f"🗿 Не смог собрать инфу по индексам: {type(e).__name__}")
+        return
+    lines = ["<b>🗂 Индексы коллекций:</b>"]
+    for collection_name, index_names in index_info.items():
+        lines.append(f"<code>{collection_name}</code>: {', '.join(index_names) or 'нихуя'}")
+    lines.append("\n<b>🔍 Горячие запросы (explain):</b>")
+    for entry in audit_report:
+        if entry["error"]: status_icon, details = "⚠️", entry["error"][:100]
+        elif entry["ok"]: status_icon, details = "✅", ", ".join(entry["indexes"]) or " → ".join(entry["stages"])
+        else: status_icon, details = "💩", "COLLSCAN! " + " → ".join(entry["stages"])
+        lines.append(f"{status_icon} {entry['name']}: <code>{details}</code>")
+    for part in split_long_message_primitive("\n".join(lines), MAX_TELEGRAM_MESSAGE_LENGTH - 50):
+        await update.message.reply_text(part, parse_mode='HTML')
+# --- КОНЕЦ ДИАГНОСТИКИ ИНДЕКСОВ ---
+
+# --- ВНУТРЕННЯЯ СТАТИСТИКА КЭШЕЙ И БУФЕРОВ (ТОЛЬКО АДМИН В ЛС) ---
+async def show_bot_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает счетчики кэша профилей, кольцевых буферов, write-behind и очереди к ИИ (только админ в ЛС)."""
+    if not update.message or not update.message.from_user: return
+    if not (update.message.from_user.id == ADMIN_USER_ID and update.message.chat.type == 'private'):
+        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+        return
+    profile_lookups = profile_cache_stats["hits"] + profile_cache_stats["misses"]
+    hit_rate = profile_cache_stats["hits"] / profile_lookups * 100 if profile_lookups else 0.0
+    lines = [
+        "<b>📈 Кишки Попиздяки:</b>",
+        f"<b>Кэш профилей:</b> {len(profile_cache)}/{PROFILE_CACHE_MAX_SIZE}, TTL {PROFILE_CACHE_TTL_SECONDS}с, "
+        f"попаданий {profile_cache_stats['hits']}, промахов {profile_cache_stats['misses']} ({hit_rate:.1f}% hit), "
+        f"обновлений {profile_cache_stats['updates']}, сбросов {profile_cache_stats['invalidations']}",
+        f"<b>Кольцевые буферы:</b> чатов {len(chat_ring_buffers)}, юзеров {len(user_ring_buffers)}, "
+        f"~{ring_buffer_stats['bytes'] / 1024:.0f} КБ из {RING_BUFFER_MAX_BYTES // 1024} КБ, {ring_buffer_stats}",
+        f"<b>Write-behind:</b> в очереди {write_behind_queue.qsize() if write_behind_queue else 0}/{WRITE_BEHIND_MAX_QUEUE}, {write_behind_stats}",
+        f"<b>Пул утверждений ПиВ:</b> {tos_pool_stats}",
+        f"<b>Сводки чатов:</b> {rolling_summary_stats}",
+        f"<b>Сборщик контекста:</b> {context_builder_stats}",
+        f"<b>Картинки для vision:</b> в кэше {len(vision_image_cache)} (~{vision_image_cache.currsize / 1024 / 1024:.1f} МБ), {vision_image_stats}",
+        f"<b>Кэш ответов ИИ:</b> ключей {len(llm_response_cache)}/{LLM_RESPONSE_CACHE_MAX_SIZE}, {llm_response_cache_stats}",
+    ]
+    llm_snapshot = llm_scheduler_snapshot()
+    lines.append(
+        f"<b>Очередь к ИИ:</b> в работе {llm_snapshot['active']}/{LLM_MAX_CONCURRENCY} (чатов {llm_snapshot['active_chats']}), "
+        f"жетонов {llm_snapshot['tokens']}/{LLM_RATE_BURST} при {LLM_RATE_PER_SECOND}/с"
+    )
+    for name, queue_stats in llm_snapshot["queues"].items():
+        lines.append(
+            f"  {name}: ждут {queue_stats['depth']} (макс {queue_stats['max_depth']}), выдано {queue_stats['granted']}, "
+            f"ожидание ср. {queue_stats['wait_avg']:.2f}с / макс {queue_stats['wait_max']:.2f}с, таймаутов {queue_stats['timeouts']}"
+        )
+    open_breakers = [model_id for model_id, breaker in llm_breakers.items() if breaker["state"] != "closed"]
+    lines.append(
+        f"<b>Живучесть ИИ:</b> {llm_resilience_stats}, предохранители не закрыты: {', '.join(open_breakers) or 'нет'}, "
+        f"хедж в {LLM_HEDGE_FALLBACK_MODEL_ID or 'выключен'}"
+    )
+    for model_id, health in llm_model_health.items():
+        lines.append(
+            f"  {model_id}: ср. латентность {health['latency']:.1f}с, ошибок {health['error_rate'] * 100:.0f}%, замеров {health['calls']}"
+        )
+    lines.append(f"<b>Роутер фраз:</b> {trigger_router_stats}")
+    deepest_lanes = ", ".join(f"{kind} {lane_chat_id}: {depth}" for (kind, lane_chat_id), depth in update_processor.deepest_lanes(5))
+    lines.append(
+        f"<b>Апдейты:</b> параллельно до {UPDATE_CONCURRENCY}, активных полос {len(update_processor.lanes)}, {update_processor.stats}, "
+        f"самые длинные: {deepest_lanes or 'нет'}"
+    )
+    lines.append(
+        f"<b>Исходящие в Телегу:</b> ждут {outbound_limiter.waiting}, ведер чатов {len(outbound_limiter.chats)}, {outbound_limiter.stats}, "
+        f"склейка {telegram_coalesce_stats}"
+    )
+    lines.append(f"<b>Роутер моделей:</b> деградаций {llm_router_degradations['count']}, {llm_router_stats}")
+    for feature, stream_stats in llm_stream_stats.items():
+        with_preview = stream_stats["calls"] - stream_stats["no_preview"]
+        ttft_avg = stream_stats["ttft_total"] / with_preview if with_preview else 0.0
+        lines.append(
+            f"<b>Стрим {feature}:</b> вызовов {stream_stats['calls']}, TTFT ср. {ttft_avg:.2f}с / макс {stream_stats['ttft_max']:.2f}с, "
+            f"без превью {stream_stats['no_preview']}, правок {stream_stats['edits']}, ср. время {stream_stats['total_time'] / stream_stats['calls']:.1f}с"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+# --- КОНЕЦ СТАТИСТИКИ ---
+
+# --- БЕНЧМАРК СЛОЯ MONGODB (ТОЛЬКО АДМИН В ЛС) ---
+DB_BENCH_DEFAULT_OPS = 500
+
+async def _bench_db_layer(use_async_driver: bool, total_ops: int, concurrency: int) -> float:
+    """Гоняет типичный запрос хендлера (профиль + последние сообщения) и возвращает операций в секунду."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    sync_profiles, sync_history = db['user_profiles'], db['message_history']
+
+    async def one_op(i: int) -> None:
+        async with semaphore:
+            if use_async_driver:
+                await user_profiles_collection.find_one({"user_id": i})
+                await history_collection.find({"chat_id": i}).sort("timestamp", pymongo.DESCENDING).limit(20).to_list()
+            else: # Старый путь: синхронный pymongo через пул потоков
+                await loop.run_in_executor(None, lambda: sync_profiles.find_one({"user_id": i}))
+                cursor = await loop.run_in_executor(None, lambda: sync_history.find({"chat_id": i}).sort("timestamp", pymongo.DESCENDING).limit(20))
+                list(cursor)
+
+    started = loop.time()
+    await asyncio.gather(*(one_op(-i - 1) for i in range(total_ops))) # Отрицательные ID, чтобы не трогать реальные данные
+    return total_ops / max(loop.time() - started, 1e-9)
+
+async def db_benchmark(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сравнивает пропускную способность run_in_executor vs AsyncMongoClient (только админ в ЛС)."""
+    if not update.message or not update.message.from_user: return
+    if not (update.message.from_user.id == ADMIN_USER_ID and update.message.chat.type == 'private'):
+        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+        return
+    try: total_ops = max(10, min(int(context.args[0]), 10000)) if context.args else DB_BENCH_DEFAULT_OPS
+    except ValueError: total_ops = DB_BENCH_DEFAULT_OPS
+    concurrency = MONGO_MAX_POOL_SIZE
+    await update.message.reply_text(f"🗿 Гоняю {total_ops} запросов через оба слоя (параллельно до {concurrency})...")
+    try:
+        executor_ops = await _bench_db_layer(False, total_ops, concurrency)
+        async_ops = await _bench_db_layer(True, total_ops, concurrency)
+    except Exception as e:
+        logger.error(f"/dbbench упал: {e}", exc_info=True)
+        await update.message.reply_text(f"🗿 Бенчмарк обосрался: {type(e).__name__}")
+        return
+    logger.info(f"/dbbench: executor={executor_ops:.1f} оп/с, async={async_ops:.1f} оп/с ({total_ops} оп.)")
+    await update.message.reply_text(
+        f"<b>📊 Бенчмарк MongoDB ({total_ops} оп.)</b>\n"
+        f"run_in_executor + pymongo: <b>{executor_ops:.1f}</b> оп/с\n"
+        f"AsyncMongoClient: <b>{async_ops:.1f}</b> оп/с\n"
+        f"Разница: <b>x{async_ops / max(executor_ops, 1e-9):.2f}</b>",
+        parse_mode='HTML'
+    )
+# --- КОНЕЦ БЕНЧМАРКА ---
+
+# --- БЕНЧМАРК КЛИЕНТА LLM (ТОЛЬКО АДМИН В ЛС) ---
+LLM_BENCH_DEFAULT_CALLS = 200
+_LLM_BENCH_STUB_BODY = json.dumps({
+    "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "bench",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "🗿"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}).encode()
+
+async def _llm_bench_stub_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Заглушка OpenAI-совместимого API: отвечает фиксированным chat.completion, держит keep-alive."""
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"): length = int(line.split(b":", 1)[1])
+            if length: await reader.readexactly(length)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                         + str(len(_LLM_BENCH_STUB_BODY)).encode() + b"\r\n\r\n" + _LLM_BENCH_STUB_BODY)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def _bench_llm_client(client: AsyncOpenAI, total_calls: int, concurrency: int) -> list[float]:
+    """Гоняет _call_ionet_api через заданный клиент и возвращает латентности в мс."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one_call() -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await _call_ionet_api([{"role": "user", "content": "ping"}], "bench", 1, 0.0, client=client, scheduled=False)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(one_call() for _ in range(total_calls)))
+    return latencies
+
+async def llm_benchmark(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сравнивает p50/p99 нашего настроенного клиента и дефолтного AsyncOpenAI на локальной заглушке (только админ в ЛС)."""
+    if not update.message or not update.message.from_user: return
+    if not (update.message.from_user.id == ADMIN_USER_ID and update.message.chat.type == 'private'):
+        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+        return
+    try: total_calls = max(10, min(int(context.args[0]), 5000)) if context.args else LLM_BENCH_DEFAULT_CALLS
+    except ValueError: total_calls = LLM_BENCH_DEFAULT_CALLS
+    concurrency = IONET_HTTP_MAX_KEEPALIVE
+    await update.message.reply_text(f"🗿 Гоняю {total_calls} запросов к заглушке через оба клиента (параллельно до {concurrency})...")
+    server = await asyncio.start_server(_llm_bench_stub_handler, "127.0.0.1", 0)
+    base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1/"
+    results = {}
+    try:
+        # Заглушка говорит только HTTP/1.1, поэтому сравниваем пул/keep-alive/таймауты, а не мультиплексирование
+        tuned_http = build_ionet_http_client(http2=False)
+        clients = {
+            "настроенный": AsyncOpenAI(api_key="bench", base_url=base_url, http_client=tuned_http),
+            "дефолтный": AsyncOpenAI(api_key="bench", base_url=base_url),
+        }
+        for name, client in clients.items():
+            await _bench_llm_client(client, concurrency, concurrency) # Прогрев пула
+            results[name] = statistics.quantiles(await _bench_llm_client(client, total_calls, concurrency), n=100)
+            await client.close()
     except Exception as e:
-        logger.critical(f"HEALTH CHECK FAILED: Ошибка при проверке статуса в БД: {e}", exc_info=True)
-        return Response(f"Error during health check: {e}", status=500, mimetype='text/plain')
-
-
-async def run_bot_async(application: Application) -> None: # Запускает и корректно останавливает бота
+        logger.error(f"/llmbench упал: {e}", exc_info=True)
+        await update.message.reply_text(f"🗿 Бенчмарк обосрался: {type(e).__name__}")
+        return
+    finally:
+        server.close()
+        await server.wait_closed()
+    lines = [f"<b>📊 Бенчмарк клиента LLM ({total_calls} вызовов)</b>"]
+    for name, q in results.items():
+        lines.append(f"{name}: p50 <b>{q[49]:.1f}</b> мс, p99 <b>{q[98]:.1f}</b> мс")
+        logger.info(f"/llmbench {name}: p50={q[49]:.1f} мс, p99={q[98]:.1f} мс ({total_calls} вызовов)")
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+# --- КОНЕЦ БЕНЧМАРКА КЛИЕНТА LLM ---
+
+# --->>> МЕДЛЕННЫЕ КОЛБЭКИ И ПРОФИЛИРОВАНИЕ ЛУПА <<<---
+# ASYNCIO_SLOW_CALLBACK_SECONDS > 0 включает debug-режим asyncio: он пишет в лог каждый шаг лупа дольше порога
+# (сам debug-режим тормозит - включать только на время разбирательств).
+# /profile N (админ в ЛС) или PROFILE_ON_BOOT_SECONDS - cProfile всего лупа на N секунд, отчет в файл.
+ASYNCIO_SLOW_CALLBACK_SECONDS = float(os.getenv("ASYNCIO_SLOW_CALLBACK_SECONDS", "0"))
+PROFILE_ON_BOOT_SECONDS = int(os.getenv("PROFILE_ON_BOOT_SECONDS", "0"))
+PROFILE_OUTPUT_DIR = os.getenv("PROFILE_OUTPUT_DIR", "profiles")
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_REPORT_TOP_FUNCTIONS = 40
+profiler_state = {"running": False}
+
+def enable_slow_callback_logging(loop: asyncio.AbstractEventLoop) -> None:
+    if ASYNCIO_SLOW_CALLBACK_SECONDS <= 0: return
+    loop.set_debug(True)
+    loop.slow_callback_duration = ASYNCIO_SLOW_CALLBACK_SECONDS
+    logging.getLogger("asyncio").setLevel(logging.WARNING) # Туда asyncio и пишет "Executing <Handle ...> took X seconds"
+    logger.warning(f"Debug-режим asyncio ВКЛЮЧЕН: логирую колбэки дольше {ASYNCIO_SLOW_CALLBACK_SECONDS}с (бот будет медленнее).")
+
+def _handler_time_totals() -> dict[str, tuple[float, int]]:
+    """Суммарное время и число вызовов по хендлерам из реестра метрик."""
+    with _metrics_lock:
+        return {dict(key).get("handler", "?"): (histogram[1], histogram[2])
+                for key, histogram in _metric_series["bot_handler_duration_seconds"].items()}
+
+def _loop_lag_spikes_total() -> int:
+    """Сколько замеров лага лупа с начала работы было больше EVENT_LOOP_LAG_WARN_SECONDS (по корзинам гистограммы)."""
+    with _metrics_lock:
+        histogram = _metric_series["bot_event_loop_lag_seconds"].get(())
+        return sum(histogram[0][bisect.bisect_left(METRICS_LATENCY_BUCKETS, EVENT_LOOP_LAG_WARN_SECONDS) + 1:]) if histogram else 0
+
+def _write_profile_report(path: str, report: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f: f.write(report)
+
+async def run_loop_profile(seconds: int, reason: str) -> tuple[str, str, str]:
+    """Гоняет cProfile на потоке лупа seconds секунд. Возвращает (путь к файлу, полный отчет, короткую выжимку)."""
+    profiler_state["running"] = True
+    handlers_before = _handler_time_totals()
+    lag_spikes_before = _loop_lag_spikes_total()
+    profiler = cProfile.Profile()
+    logger.info(f"Профилирование лупа на {seconds}с ({reason})...")
     try:
-        logger.info("Init TG App..."); await application.initialize()
-        if not application.updater: logger.critical("No updater!"); return
-        logger.info("Start polling..."); await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
-        logger.info("Start TG App..."); await application.start()
-        logger.info("Bot started (idle)..."); await asyncio.Future() # Ожидаем вечно
-    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError): logger.info("Stop signal received.")
-    except Exception as e: logger.critical(f"ERROR in run_bot_async: {e}", exc_info=True)
-    finally: # Shutdown
-        logger.info("Stopping bot...");
-        if application.running: await application.stop(); logger.info("App stopped.")
-        if application.updater and application.updater.is_running: await application.updater.stop(); logger.info("Updater stopped.")
-        await application.shutdown(); logger.info("Bot stopped.")
-
-# --- ФУНКЦИИ ДЛЯ УПРАВЛЕНИЯ ТЕХРАБОТАМИ (ТОЛЬКО АДМИН В ЛС) ---
-async def maintenance_on(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Включает режим техработ (только админ в ЛС)."""
-    user_id = update.message.from_user.id
-    chat_type = update.message.chat.type
-    if user_id == ADMIN_USER_ID and chat_type == 'private':
-        loop = asyncio.get_running_loop()
-        success = await set_maintenance_mode(True, loop)
-        await update.message.reply_text(f"🔧 Режим техработ {'УСПЕШНО ВКЛЮЧЕН' if success else 'НЕ УДАЛОСЬ ВКЛЮЧИТЬ (ошибка БД)'}.")
-    else:
-        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
-
-async def maintenance_off(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Выключает режим техработ (только админ в ЛС)."""
-    user_id = update.message.from_user.id
-    chat_type = update.message.chat.type
-    if user_id == ADMIN_USER_ID and chat_type == 'private':
-        loop = asyncio.get_running_loop()
-        success = await set_maintenance_mode(False, loop)
-        await update.message.reply_text(f"✅ Режим техработ {'УСПЕШНО ВЫКЛЮЧЕН' if success else 'НЕ УДАЛОСЬ ВЫКЛЮЧИТЬ (ошибка БД)'}.")
-    else:
+        profiler.enable()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        profiler_state["running"] = False
+
+    # Горячие хендлеры за окно: разница сумм из метрик
+    hot_handlers = []
+    for name, (total, count) in _handler_time_totals().items():
+        before_total, before_count = handlers_before.get(name, (0.0, 0))
+        if count > before_count: hot_handlers.append((name, total - before_total, count - before_count))
+    hot_handlers.sort(key=lambda item: item[1], reverse=True)
+    lag_spikes = _loop_lag_spikes_total() - lag_spikes_before
+
+    buffer = io.StringIO()
+    buffer.write(f"Профиль лупа: {seconds}с, причина: {reason}, {datetime.datetime.now(datetime.timezone.utc).isoformat()}\n")
+    buffer.write(f"Всплесков лага > {EVENT_LOOP_LAG_WARN_SECONDS}с за окно: {lag_spikes}\n\nХендлеры (суммарное время / вызовов):\n")
+    for name, total, count in hot_handlers:
+        buffer.write(f"  {name}: {total:.3f}с / {count}\n")
+    stats = pstats.Stats(profiler, stream=buffer)
+    buffer.write("\n=== ПО CUMULATIVE ===\n"); stats.sort_stats("cumulative").print_stats(PROFILE_REPORT_TOP_FUNCTIONS)
+    buffer.write("\n=== ПО TOTTIME (кто жрет сам) ===\n"); stats.sort_stats("tottime").print_stats(PROFILE_REPORT_TOP_FUNCTIONS)
+    report = buffer.getvalue()
+    path = os.path.join(PROFILE_OUTPUT_DIR, f"loop-profile-{datetime.datetime.now():%Y%m%d-%H%M%S}.txt")
+    await asyncio.to_thread(_write_profile_report, path, report) # Диск - не в луп
+    summary = "\n".join(f"{name}: {total:.2f}с за {count} выз." for name, total, count in hot_handlers[:10]) or "хендлеры не вызывались"
+    logger.info(f"Профиль лупа сохранен в {path} (всплесков лага: {lag_spikes}).")
+    return path, report, f"Всплесков лага > {EVENT_LOOP_LAG_WARN_SECONDS}с: {lag_spikes}\n{summary}"
+
+async def profile_loop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Профилирует луп N секунд и присылает отчет файлом (только админ в ЛС)."""
+    if not update.message or not update.message.from_user: return
+    if not (update.message.from_user.id == ADMIN_USER_ID and update.message.chat.type == 'private'):
         await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+        return
+    if profiler_state["running"]:
+        await update.message.reply_text("🗿 Профилирование уже идет, жди.")
+        return
+    try: seconds = max(1, min(int(context.args[0]), PROFILE_MAX_SECONDS)) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError: seconds = PROFILE_DEFAULT_SECONDS
+    await update.message.reply_text(f"🗿 Профилирую луп {seconds}с, гоняй бота в чатах...")
+    try:
+        path, report, summary = await run_loop_profile(seconds, "/profile")
+    except Exception as e:
+        logger.error(f"/profile упал: {e}", exc_info=True)
+        await update.message.reply_text(f"🗿 Профилирование обосралось: {type(e).__name__}")
+        return
+    await update.message.reply_text(f"<b>🔥 Горячие хендлеры за {seconds}с:</b>\n{summary}", parse_mode='HTML')
+    await update.message.reply_document(document=report.encode("utf-8"), filename=os.path.basename(path))
 
-# --- КОНЕЦ ФУНКЦИЙ ТЕХРАБОТ ---
+async def profile_on_boot() -> None:
+    try: await run_loop_profile(PROFILE_ON_BOOT_SECONDS, "PROFILE_ON_BOOT_SECONDS")
+    except Exception as e: logger.error(f"Профилирование на старте упало: {e}", exc_info=True)
+# --->>> КОНЕЦ ПРОФИЛИРОВАНИЯ <<<---
 
 # # --- ФУНКЦИЯ ПОЛУЧЕНИЯ И КОММЕНТИРОВАНИЯ НОВОСТЕЙ (GNEWS) ---
 # async def fetch_and_comment_news(context: ContextTypes.DEFAULT_TYPE) -> list[tuple[str, str, str | None]]:
@@ -1955,34 +3928,10 @@ async def maintenance_off(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 #     await update.message.reply_text("Попытка постинга новостей завершена. Смотри логи.")
 
 # --- ПЕРЕДЕЛАННАЯ praise_user (С КОНТЕКСТОМ И ОТВЕТОМ НА СООБЩЕНИЕ) ---
+@maintenance_gate()
 async def praise_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Генерирует саркастическую 'похвалу' пользователю (на кого ответили) с учетом контекста."""
 
-    # --->>> НАЧАЛО НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
-# Проверяем наличие update и message - без них проверка невозможна
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-        logger.warning(f"Не могу проверить техработы - нет данных в update ({__name__})") # Логгируем имя текущей функции
-        # Если это важная команда, можно тут вернуть ошибку пользователю
-        # await context.bot.send_message(chat_id=update.effective_chat.id, text="Ошибка проверки данных.")
-        return # Или просто выйти
-
-    real_chat_id = update.message.chat.id
-    real_user_id = update.message.from_user.id
-    real_chat_type = update.message.chat.type
-
-    loop = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop) # Вызываем функцию проверки
-
-    # Блокируем, если техработы ВКЛЮЧЕНЫ и это НЕ админ в ЛС
-    if maintenance_active and (real_user_id != ADMIN_USER_ID or real_chat_type != 'private'):
-        logger.info(f"Команда отклонена из-за режима техработ в чате {real_chat_id}")
-        try: # Пытаемся ответить и удалить команду
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось ответить/удалить сообщение о техработах: {e}")
-        return # ВЫХОДИМ ИЗ ФУНКЦИИ
-# --->>> КОНЕЦ НОВОЙ ПРОВЕРКИ ТЕХРАБОТ <<<---
 
     # 2. Проверка, что это ответ на сообщение и не на бота
     if (not update.message or not update.message.reply_to_message or
@@ -2016,11 +3965,7 @@ async def praise_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     user_context = "[Недавних сообщений не найдено]"
     USER_CONTEXT_LIMIT_PRAISE = 3 # Хватит 3 сообщений
     try:
-        loop = asyncio.get_running_loop()
-        query = {"chat_id": chat_id, "user_id": target_user.id}
-        sort_order = [("timestamp", pymongo.DESCENDING)]
-        user_hist_cursor = await loop.run_in_executor(None, lambda: history_collection.find(query).sort(sort_order).limit(USER_CONTEXT_LIMIT_PRAISE))
-        user_messages = list(user_hist_cursor)[::-1]
+        user_messages = await get_recent_user_messages(chat_id, target_user.id, USER_CONTEXT_LIMIT_PRAISE)
         if user_messages:
             context_lines = [msg.get('text', '[...]') for msg in user_messages]
             user_context = "\n".join(context_lines)
@@ -2049,11 +3994,9 @@ async def praise_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         messages_for_api = [{"role": "user", "content": praise_prompt}]
         # Вызов ИИ (_call_ionet_api или model.generate_content_async)
         praise_text = await _call_ionet_api( # ИЛИ model.generate_content_async
-            messages=messages_for_api, model_id=IONET_TEXT_MODEL_ID, max_tokens=100, temperature=0.85
+            messages=messages_for_api, model_id=route_model("praise"), max_tokens=100, temperature=0.85, chat_id=chat_id
         ) or f"[Похвала для {target_name} не придумалась]"
         if not praise_text.startswith(("🗿", "[")): praise_text = "🗿 " + praise_text
-        try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
 
         #MAX_MESSAGE_LENGTH = 4096; # Обрезка
         if len(praise_text) > MAX_TELEGRAM_MESSAGE_LENGTH: praise_text = praise_text[:MAX_TELEGRAM_MESSAGE_LENGTH - 3] + "..."
@@ -2061,17 +4004,14 @@ async def praise_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         # Отправляем "похвалу"
         target_mention = target_user.mention_html() if target_user.username else f"<b>{target_name}</b>"
         final_text = f"Типа похвала для {target_mention} от {user.mention_html()}:\n\n{praise_text}"
-        await context.bot.send_message(chat_id=chat_id, text=final_text, parse_mode='HTML')
+        await replace_thinking_message(context.bot, chat_id, thinking_message, final_text, parse_mode='HTML')
         logger.info(f"Отправлена похвала для {target_name}.")
         # Запись для /retry (если нужна, с type='praise')
         # ...
 
     except Exception as e:
         logger.error(f"ПИЗДЕЦ при генерации похвалы для {target_name}: {e}", exc_info=True)
-        try:
-            if 'thinking_message' in locals(): await context.bot.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
-        except Exception: pass
-        await context.bot.send_message(chat_id=chat_id, text=f"Бля, {user_name}, не могу похвалить '{target_name}'. Видимо, не за что. Ошибка: `{type(e).__name__}`.")
+        await replace_thinking_message(context.bot, chat_id, locals().get('thinking_message'), f"Бля, {user_name}, не могу похвалить '{target_name}'. Видимо, не за что. Ошибка: `{type(e).__name__}`.")
 
 # --- КОНЕЦ ПЕРЕДЕЛАННОЙ praise_user ---
 
@@ -2104,11 +4044,7 @@ async def get_user_profile_data(user: User | None) -> dict:
     profile_in_db = None # Сам документ из БД
 
     try:
-        loop = asyncio.get_running_loop()
-        profile_in_db = await loop.run_in_executor(
-            None,
-            lambda: user_profiles_collection.find_one({"user_id": user.id})
-        )
+        profile_in_db = await get_cached_profile_doc(user.id)
 
         if profile_in_db:
             # Если профиль есть, берем данные из него
@@ -2173,17 +4109,14 @@ async def set_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     # if re.search(r"[^\w\s\-]", nickname): ...
 
     try:
-        loop = asyncio.get_running_loop()
         # Обновляем или создаем профиль с новым ником
-        await loop.run_in_executor(
-            None,
-            lambda: user_profiles_collection.update_one(
+        await user_profiles_collection.update_one(
                 {"user_id": user.id}, # Фильтр
                 {"$set": {"custom_nickname": nickname, "tg_first_name": user.first_name, "tg_username": user.username},
                  "$setOnInsert": {"user_id": user.id, "message_count": 0, "current_title": None, "penis_size": 0, "last_penis_growth": datetime.datetime.fromtimestamp(0, datetime.timezone.utc), "current_penis_title": None}},
                 upsert=True # <--- ТЕПЕРЬ ЭТА СТРОКА ВНУТРИ update_one()!
-            ) # <--- Скобка от lambda закрывается здесь
-        )
+            )
+        profile_cache_invalidate(user.id)
         logger.info(f"Пользователь {user.id} ({user.first_name}) установил никнейм: {nickname}")
         await context.bot.send_message(chat_id=chat_id, text=f"🗿 Записал, отныне ты будешь зваться '<b>{nickname}</b>'. Смотри не обосрись с таким погонялом.", parse_mode='HTML')
         # --->>> ВСТАВЛЯЕМ ВЫЗОВ ФОНОВОГО ОБНОВЛЕНИЯ ИСТОРИИ <<<---
@@ -2202,26 +4135,9 @@ async def set_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 # --- КОНЕЦ ФУНКЦИИ УСТАНОВКИ НИКНЕЙМА ---
 
 # --- ИСПРАВЛЕННАЯ ФУНКЦИЯ ДЛЯ КОМАНДЫ /whoami ---
+@maintenance_gate()
 async def who_am_i(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает инфу о пользователе: ник, кол-во сообщений, звание, писюн (по чату)."""
-    # --->>> НАЧАЛО ПРОВЕРКИ ТЕХРАБОТ (ВСТАВЬ В КАЖДУЮ КОМАНДНУЮ ФУНКЦИЮ!) <<<---
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-         logger.warning(f"grow_tits: нет данных в update для проверки техработ")
-         return
-    real_chat_id = update.message.chat.id; real_user_id = update.message.from_user.id; real_chat_type = update.message.chat.type
-    try: admin_id = int(os.getenv("ADMIN_USER_ID", "0"))
-    except ValueError: admin_id = 0
-    if admin_id == 0: logger.warning("ADMIN_USER_ID не задан для grow_tits!") # Можно убрать это логгирование в каждой функции
-    loop_for_maint = asyncio.get_running_loop() # Отдельный loop для вызова is_maintenance_mode
-    maintenance_active = await is_maintenance_mode(loop_for_maint)
-    if maintenance_active and (real_user_id != admin_id or real_chat_type != 'private'):
-        logger.info(f"Команда grow_tits отклонена из-за техработ в чате {real_chat_id}")
-        try:
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e: logger.warning(f"Не удалось ответить/удалить сообщение о техработах (grow_tits): {e}")
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
     if not update or not update.message or not update.message.from_user or not update.message.chat:
         logger.warning(f"who_am_i: нет данных для проверки техработ")
         return
@@ -2230,7 +4146,6 @@ async def who_am_i(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.message.from_user
     chat_id = update.message.chat.id
 
-    loop = asyncio.get_running_loop()
 
     logger.info(f"Пользователь {user.id} ({user.first_name or 'Безымянный'}) запросил /whoami")
 
@@ -2258,9 +4173,7 @@ async def who_am_i(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     reply_text += f"\n<b>Погоняло в банде:</b> {calculated_title}"
 
     # --->>> ИЗМЕНЕННЫЙ БЛОК ДЛЯ ПИСЬКИ (по текущему чату) <<<---
-    penis_stat_for_current_chat = await loop.run_in_executor( # Используем loop
-         None, lambda: penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
-    )
+    penis_stat_for_current_chat = await penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
     current_penis_size_chat = 0
     calculated_penis_title_chat = "Неизмеряемый отросток (в этом чате)"
     if penis_stat_for_current_chat:
@@ -2276,9 +4189,7 @@ async def who_am_i(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     reply_text += f"\n\n<b>Твои Дыньки (в этом чате '{update.message.chat.title or 'тут'}'):</b>"
     # Получаем сисько-статистику для ЭТОГО ЮЗЕРА в ЭТОМ ЧАТЕ
-    tits_stat_chat = await loop.run_in_executor( # Убедись, что loop определен выше
-         None, lambda: tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
-    )
+    tits_stat_chat = await tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
     current_tits_size_chat = 0
     calculated_tits_title_chat = "Плоскодонка (в этом чате)" # Дефолт
     if tits_stat_chat:
@@ -2298,53 +4209,30 @@ async def who_am_i(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def update_history_with_new_name(user_id: int, new_nickname: str, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Начинаю фоновое обновление имени на '{new_nickname}' в истории для user_id {user_id}...")
     try:
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: history_collection.update_many(
+        result = await history_collection.update_many(
                 {"user_id": user_id}, # Найти все сообщения этого юзера
                 {"$set": {"user_name": new_nickname}} # Заменить user_name на новый ник
             )
-        )
+        ring_buffer_rename_user(user_id, new_nickname)
         logger.info(f"Обновление имени в истории для user_id {user_id} завершено: Найдено={result.matched_count}, Обновлено={result.modified_count}")
     except Exception as e:
         logger.error(f"Ошибка фонового обновления имени в истории для user_id {user_id}: {e}", exc_info=True)
 # --- КОНЕЦ ФОНОВОЙ ЗАДАЧИ ---
 
 # --- ИЗМЕНЕННАЯ grow_penis (С НАКАЗАНИЕМ ЗА ЧАСТУЮ ДРОЧКУ И КОМПЕНСАЦИЕЙ) ---
+@maintenance_gate()
 async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # --->>> НАЧАЛО ПРОВЕРКИ ТЕХРАБОТ (код как был) <<<---
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-         logger.warning(f"grow_penis: нет данных в update для проверки техработ") # Изменил имя функции в логе
-         return
-    real_chat_id = update.message.chat.id; real_user_id = update.message.from_user.id; real_chat_type = update.message.chat.type
-    try: admin_id = int(os.getenv("ADMIN_USER_ID", "0"))
-    except ValueError: admin_id = 0
-    if admin_id == 0: logger.warning("ADMIN_USER_ID не задан для grow_penis!")
-    loop_for_maint = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop_for_maint)
-    if maintenance_active and (real_user_id != admin_id or real_chat_type != 'private'):
-        logger.info(f"Команда grow_penis отклонена из-за техработ в чате {real_chat_id}")
-        try:
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e: logger.warning(f"Не удалось ответить/удалить сообщение о техработах (grow_penis): {e}")
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
 
     if not update.message or not update.message.from_user or not update.message.chat: return # Повторная проверка
     user = update.message.from_user
     chat_id = update.message.chat.id
-    loop = asyncio.get_running_loop()
 
     profile_data_for_name = await get_user_profile_data(user)
     user_display_name = profile_data_for_name["display_name"]
 
     logger.info(f"Пользователь '{user_display_name}' (ID: {user.id}) дергает писькомер в чате {chat_id}.")
 
-    penis_stat = await loop.run_in_executor(
-        None, lambda: penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
-    )
+    penis_stat = await penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
 
     last_growth_time = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
     current_penis_size = 0
@@ -2368,14 +4256,14 @@ async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         h = int(remaining_time // 3600); m = int((remaining_time % 3600) // 60)
         if not warned_during_cooldown:
             await context.bot.send_message(chat_id=chat_id, text=f"🗿 Э, {user_display_name}, ты заебал! Твой стручок еще на кулдауне! Осталось <b>{h} ч {m} мин</b>. Еще раз дернешь - укорочу нахуй!", parse_mode='HTML')
-            await loop.run_in_executor(None, lambda: penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"warned_during_cooldown": True}}, upsert=True))
+            await penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"warned_during_cooldown": True}}, upsert=True)
             logger.info(f"Пользователь {user_display_name} получил предупреждение за частую дрочку писюна.")
         else:
             shrink_amount = random.randint(1, 15)
             new_size_after_punishment = max(0, current_penis_size - shrink_amount) # Не может быть меньше 0
             logger.info(f"НАКАЗАНИЕ! Писюн {user_display_name} в чате {chat_id} УКОРОЧЕН на {shrink_amount} см за заебывание, теперь {new_size_after_punishment} см! Кулдаун сброшен.")
             await context.bot.send_message(chat_id=chat_id, text=f"🗿 АХ ТЫ Ж ХУЕСОС НЕТЕРПЕЛИВЫЙ, {user_display_name}! Я ЖЕ ПРЕДУПРЕЖДАЛ! Твой писюн **УСОХ на {shrink_amount} см** за твое заебалово! Теперь он <b>{new_size_after_punishment} см</b>! Кулдаун сброшен, можешь дрочить заново через {PENIS_GROWTH_COOLDOWN_SECONDS // 3600} часов, если еще есть что.", parse_mode='HTML')
-            await loop.run_in_executor(None, lambda: penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"penis_size": new_size_after_punishment, "last_penis_growth": current_time, "warned_during_cooldown": False}}, upsert=True))
+            await penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"penis_size": new_size_after_punishment, "last_penis_growth": current_time, "warned_during_cooldown": False}}, upsert=True)
             # Проверка на изменение звания после укорочения (логика как была)
             new_penis_title_achieved_punish = None; new_penis_title_message_punish = ""
             for size_threshold, (title_name, achievement_message) in sorted(PENIS_TITLES_BY_SIZE.items()):
@@ -2383,11 +4271,11 @@ async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
                 else: break
             if new_penis_title_achieved_punish != current_penis_title_from_db:
                 if new_penis_title_achieved_punish:
-                     await loop.run_in_executor(None, lambda: penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": new_penis_title_achieved_punish}}))
+                     await penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": new_penis_title_achieved_punish}})
                      mention = user.mention_html(); achievement_text = new_penis_title_message_punish.format(mention=mention, size=new_size_after_punishment)
                      await context.bot.send_message(chat_id=chat_id, text=achievement_text, parse_mode='HTML')
                 elif current_penis_title_from_db:
-                     await loop.run_in_executor(None, lambda: penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": None}}))
+                     await penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": None}})
                      await context.bot.send_message(chat_id=chat_id, text=f"🗿 {user.mention_html()}, после укорочения ты потерял все писечные звания! Жалкий.", parse_mode='HTML')
         return
     # --->>> КОНЕЦ ЛОГИКИ КУЛДАУНА <<<---
@@ -2419,11 +4307,11 @@ async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
                 update_doc_penis["$setOnInsert"].pop(key_to_pop, None)
 
 
-        await loop.run_in_executor(None, lambda: penis_stats_collection.update_one(
+        await penis_stats_collection.update_one(
             {"user_id": user.id, "chat_id": chat_id},
             update_doc_penis,
             upsert=True
-        ))
+        )
         await context.bot.send_message(chat_id=chat_id, text=change_message, parse_mode='HTML')
 
         # --->>> ЛОГИКА КОМПЕНСАЦИИ, ЕСЛИ ПИСЬКА УСОХЛА ЕСТЕСТВЕННО <<<---
@@ -2431,9 +4319,7 @@ async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             if random.random() < 0.52: # 52% шанс на компенсацию
                 logger.info(f"Писюн {user_display_name} усох, но повезло! Компенсация сиськами.")
                 # Получаем текущий размер сисек
-                tits_stat_for_compensation = await loop.run_in_executor(
-                    None, lambda: tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
-                )
+                tits_stat_for_compensation = await tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
                 current_tits_size_comp = 0.0
                 current_tits_title_db_comp = None
                 if tits_stat_for_compensation:
@@ -2443,12 +4329,12 @@ async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
                 tits_growth_compensation = 0.5
                 new_tits_size_comp = round(current_tits_size_comp + tits_growth_compensation, 1)
 
-                await loop.run_in_executor(None, lambda: tits_stats_collection.update_one(
+                await tits_stats_collection.update_one(
                     {"user_id": user.id, "chat_id": chat_id},
                     {"$set": {"tits_size": new_tits_size_comp, "user_display_name": user_display_name}, # Не обновляем last_tits_growth здесь, чтобы не сбивать кулдаун сисек
                      "$setOnInsert": {"user_id": user.id, "chat_id": chat_id, "last_tits_growth": datetime.datetime.fromtimestamp(0, datetime.timezone.utc), "current_tits_title": None, "warned_during_cooldown": False}},
                     upsert=True
-                ))
+                )
                 await context.bot.send_message(chat_id=chat_id, text=f"🗿 Но не ссы, {user_display_name}! Попиздяка сегодня добрый (нет). Зато твои сиськи ВНЕЗАПНО **увеличились на {tits_growth_compensation} размера** и стали <b>{new_tits_size_comp:.1f}-го</b>! Такой вот баланс во вселенной, хули.", parse_mode='HTML')
 
                 # Проверка на новое сисечное звание после компенсации
@@ -2458,7 +4344,7 @@ async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
                     else: break
                 if new_tits_title_achieved_comp != current_tits_title_db_comp:
                      if new_tits_title_achieved_comp:
-                        await loop.run_in_executor(None, lambda: tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": new_tits_title_achieved_comp}}))
+                        await tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": new_tits_title_achieved_comp}})
                         mention_comp_tits = user.mention_html(); achievement_text_comp_tits = new_tits_title_message_comp.format(mention=mention_comp_tits, size=f"{new_tits_size_comp:.1f}")
                         await context.bot.send_message(chat_id=chat_id, text=achievement_text_comp_tits, parse_mode='HTML')
                      # Логику потери звания можно опустить для компенсации, чтобы не спамить
@@ -2474,11 +4360,11 @@ async def grow_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             else: break
         if new_penis_title_achieved != current_penis_title_from_db:
              if new_penis_title_achieved:
-                await loop.run_in_executor(None, lambda: penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": new_penis_title_achieved}}))
+                await penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": new_penis_title_achieved}})
                 mention = user.mention_html(); achievement_text = new_penis_title_message.format(mention=mention, size=new_penis_size)
                 await context.bot.send_message(chat_id=chat_id, text=achievement_text, parse_mode='HTML')
              elif current_penis_title_from_db: # Если звание было, а теперь нет (из-за усыхания)
-                await loop.run_in_executor(None, lambda: penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": None}}))
+                await penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": None}})
                 await context.bot.send_message(chat_id=chat_id, text=f"🗿 {user.mention_html()}, после изменения ты потерял все писечные звания!", parse_mode='HTML')
 
     except Exception as e:
@@ -2490,16 +4376,13 @@ async def show_my_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not update.message or not update.message.from_user or not update.message.chat: return
     user = update.message.from_user
     chat_id = update.message.chat.id # ВАЖНО
-    loop = asyncio.get_running_loop()
 
     profile_name_data = await get_user_profile_data(user) # Для актуального имени
     user_display_name = profile_name_data["display_name"]
     logger.info(f"Пользователь '{user_display_name}' (ID: {user.id}) запросил инфу о писюне в чате {chat_id}.")
 
     # Получаем писько-статистику для ЭТОГО ЮЗЕРА в ЭТОМ ЧАТЕ
-    penis_stat = await loop.run_in_executor(
-        None, lambda: penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
-    )
+    penis_stat = await penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
 
     current_penis_size = 0
     current_penis_title = "Неизмеряемый отросток" # Дефолт
@@ -2519,25 +4402,8 @@ async def show_my_penis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 # --- КОНЕЦ ПЕРЕПИСАННОЙ show_my_penis ---
 
 # --- ПЕРЕПИСАННАЯ show_penis_top (ТОП ПО КОНКРЕТНОМУ ЧАТУ) ---
+@maintenance_gate()
 async def show_penis_top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # --->>> НАЧАЛО ПРОВЕРКИ ТЕХРАБОТ (ВСТАВЬ В КАЖДУЮ КОМАНДНУЮ ФУНКЦИЮ!) <<<---
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-         logger.warning(f"grow_tits: нет данных в update для проверки техработ")
-         return
-    real_chat_id = update.message.chat.id; real_user_id = update.message.from_user.id; real_chat_type = update.message.chat.type
-    try: admin_id = int(os.getenv("ADMIN_USER_ID", "0"))
-    except ValueError: admin_id = 0
-    if admin_id == 0: logger.warning("ADMIN_USER_ID не задан для grow_tits!") # Можно убрать это логгирование в каждой функции
-    loop_for_maint = asyncio.get_running_loop() # Отдельный loop для вызова is_maintenance_mode
-    maintenance_active = await is_maintenance_mode(loop_for_maint)
-    if maintenance_active and (real_user_id != admin_id or real_chat_type != 'private'):
-        logger.info(f"Команда grow_tits отклонена из-за техработ в чате {real_chat_id}")
-        try:
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e: logger.warning(f"Не удалось ответить/удалить сообщение о техработах (grow_tits): {e}")
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
 
     if not update.message or not update.message.from_user or not update.message.chat: return
     chat_id = update.message.chat.id # ВАЖНО: используем chat_id ТЕКУЩЕГО ЧАТА
@@ -2547,19 +4413,14 @@ async def show_penis_top(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     TOP_N = 10
     try:
-        loop = asyncio.get_running_loop()
         # Ищем юзеров С penis_size > 0 ИМЕННО В ЭТОМ ЧАТЕ
         query = {"chat_id": chat_id, "penis_size": {"$gt": 0}}
         # Сортируем по penis_size, берем TOP_N
         # Возвращаем user_display_name (мы его дублируем) и penis_size
-        top_users_cursor = await loop.run_in_executor(
-            None,
-            lambda: penis_stats_collection.find(
+        top_users_list = await penis_stats_collection.find(
                 query,
                 {"user_display_name": 1, "penis_size": 1, "_id": 0}
-            ).sort("penis_size", pymongo.DESCENDING).limit(TOP_N)
-        )
-        top_users_list = list(top_users_cursor)
+            ).sort("penis_size", pymongo.DESCENDING).limit(TOP_N).to_list()
 
         if not top_users_list:
             await context.bot.send_message(chat_id=chat_id, text=f"🗿 Пиздец, в чате '{chat_title}' одни бесхуевые или еще никто не начал растить! Топ пуст.")
@@ -2582,32 +4443,15 @@ async def show_penis_top(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # --- КОНЕЦ ПЕРЕПИСАННОЙ show_penis_top ---
 
 # --- ИЗМЕНЕННАЯ grow_tits (ДРОБНЫЙ РОСТ/УСЫХАНИЕ И КОМПЕНСАЦИЯ) ---
+@maintenance_gate()
 async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # --->>> НАЧАЛО ПРОВЕРКИ ТЕХРАБОТ (код как был) <<<---
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-         logger.warning(f"grow_tits: нет данных в update для проверки техработ")
-         return
-    real_chat_id = update.message.chat.id; real_user_id = update.message.from_user.id; real_chat_type = update.message.chat.type
-    try: admin_id = int(os.getenv("ADMIN_USER_ID", "0"))
-    except ValueError: admin_id = 0
-    if admin_id == 0: logger.warning("ADMIN_USER_ID не задан для grow_tits!")
-    loop_for_maint = asyncio.get_running_loop()
-    maintenance_active = await is_maintenance_mode(loop_for_maint)
-    if maintenance_active and (real_user_id != admin_id or real_chat_type != 'private'):
-        logger.info(f"Команда grow_tits отклонена из-за техработ в чате {real_chat_id}")
-        try:
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e: logger.warning(f"Не удалось ответить/удалить сообщение о техработах (grow_tits): {e}")
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
 
     if not update.message or not update.message.from_user or not update.message.chat: return # Повторная проверка
-    user = update.message.from_user; chat_id = update.message.chat.id; loop = asyncio.get_running_loop()
+    user = update.message.from_user; chat_id = update.message.chat.id
     profile_name_data = await get_user_profile_data(user); user_display_name = profile_name_data["display_name"]
     logger.info(f"Пользователь '{user_display_name}' (ID: {user.id}) решил(а) изменить сиськи в чате {chat_id}.")
 
-    tits_stat = await loop.run_in_executor(None, lambda: tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id}))
+    tits_stat = await tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
     last_tits_growth_time = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
     current_tits_size = 0.0
     current_tits_title_db = None; warned_tits_cooldown = False
@@ -2629,14 +4473,14 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         h_tits = int(remaining_time_tits // 3600); m_tits = int((remaining_time_tits % 3600) // 60)
         if not warned_tits_cooldown:
             await context.bot.send_message(chat_id=chat_id, text=f"🗿 Э, {user_display_name}, не торопись! Твои дыньки еще на кулдауне! Осталось <b>{h_tits} ч {m_tits} мин</b>. Еще раз попросишь - сдуются нахуй!", parse_mode='HTML')
-            await loop.run_in_executor(None, lambda: tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"warned_during_cooldown": True}}, upsert=True))
+            await tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"warned_during_cooldown": True}}, upsert=True)
             logger.info(f"Пользователь {user_display_name} получил предупреждение за частую тряску сисек.")
         else:
             shrink_amount_tits_punish = round(random.uniform(0.1, 1.0), 1)
             new_size_tits_after_punish = round(max(0.0, current_tits_size - shrink_amount_tits_punish), 1)
             logger.info(f"НАКАЗАНИЕ! Сиськи {user_display_name} СДУЛИСЬ на {shrink_amount_tits_punish}, теперь {new_size_tits_after_punish}!")
             await context.bot.send_message(chat_id=chat_id, text=f"🗿 АХ ТЫ Ж НЕТЕРПЕЛИВАЯ СУЧКА, {user_display_name}! Твои сиськи **СДУЛИСЬ на {shrink_amount_tits_punish} размера**! Теперь они <b>{new_size_tits_after_punish:.1f}-го размера</b>! Кулдаун сброшен.", parse_mode='HTML')
-            await loop.run_in_executor(None, lambda: tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"tits_size": new_size_tits_after_punish, "last_tits_growth": current_time, "warned_during_cooldown": False}}, upsert=True))
+            await tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"tits_size": new_size_tits_after_punish, "last_tits_growth": current_time, "warned_during_cooldown": False}}, upsert=True)
             # Проверка звания после наказания (логика как была)
             new_tits_title_achieved_punish = None; new_tits_title_message_punish = ""
             for size_thresh_t, (title_name_t, achievement_msg_t) in sorted(TITS_TITLES_BY_SIZE.items()):
@@ -2644,11 +4488,11 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 else: break
             if new_tits_title_achieved_punish != current_tits_title_db:
                  if new_tits_title_achieved_punish:
-                    await loop.run_in_executor(None, lambda: tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": new_tits_title_achieved_punish}}))
+                    await tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": new_tits_title_achieved_punish}})
                     mention_t_p = user.mention_html(); achievement_text_t_p = new_tits_title_message_punish.format(mention=mention_t_p, size=f"{new_size_tits_after_punish:.1f}")
                     await context.bot.send_message(chat_id=chat_id, text=achievement_text_t_p, parse_mode='HTML')
                  elif current_tits_title_db:
-                    await loop.run_in_executor(None, lambda: tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": None}}))
+                    await tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": None}})
                     await context.bot.send_message(chat_id=chat_id, text=f"🗿 {user.mention_html()}, после изменения твои сиськи потеряли все звания!", parse_mode='HTML')
         return
     # --->>> КОНЕЦ ЛОГИКИ КУЛДАУНА ДЛЯ СИСЕК <<<---
@@ -2679,11 +4523,11 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                  update_doc_tits["$setOnInsert"].pop(key_to_pop, None)
 
 
-        await loop.run_in_executor(None, lambda: tits_stats_collection.update_one(
+        await tits_stats_collection.update_one(
             {"user_id": user.id, "chat_id": chat_id},
             update_doc_tits,
             upsert=True
-        ))
+        )
         await context.bot.send_message(chat_id=chat_id, text=change_message_tits, parse_mode='HTML')
 
         # --->>> ЛОГИКА КОМПЕНСАЦИИ, ЕСЛИ СИСЬКИ УСОХЛИ ЕСТЕСТВЕННО <<<---
@@ -2691,9 +4535,7 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             if random.random() < 0.52: # 52% шанс на компенсацию
                 logger.info(f"Сиськи {user_display_name} сдулись, но повезло! Компенсация писюном.")
                 # Получаем текущий размер письки
-                penis_stat_for_compensation = await loop.run_in_executor(
-                    None, lambda: penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
-                )
+                penis_stat_for_compensation = await penis_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
                 current_penis_size_comp = 0
                 current_penis_title_db_comp = None
                 if penis_stat_for_compensation:
@@ -2703,12 +4545,12 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 penis_growth_compensation = 10 # см
                 new_penis_size_comp = current_penis_size_comp + penis_growth_compensation
 
-                await loop.run_in_executor(None, lambda: penis_stats_collection.update_one(
+                await penis_stats_collection.update_one(
                     {"user_id": user.id, "chat_id": chat_id},
                     {"$set": {"penis_size": new_penis_size_comp, "user_display_name": user_display_name}, # Не обновляем last_penis_growth
                      "$setOnInsert": {"user_id": user.id, "chat_id": chat_id, "last_penis_growth": datetime.datetime.fromtimestamp(0, datetime.timezone.utc), "current_penis_title": None, "warned_during_cooldown": False}},
                     upsert=True
-                ))
+                )
                 await context.bot.send_message(chat_id=chat_id, text=f"🗿 Но не горюй, {user_display_name}! В качестве утешительного приза твой писюн ВНЕЗАПНО **подрос на {penis_growth_compensation} см** и стал <b>{new_penis_size_comp} см</b>! Закон сохранения хуйни в природе!", parse_mode='HTML')
 
                 # Проверка на новое писечное звание после компенсации
@@ -2718,7 +4560,7 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     else: break
                 if new_penis_title_achieved_comp_p != current_penis_title_db_comp: # Сравниваем с тем, что было в БД для писек
                      if new_penis_title_achieved_comp_p:
-                        await loop.run_in_executor(None, lambda: penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": new_penis_title_achieved_comp_p}}))
+                        await penis_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_penis_title": new_penis_title_achieved_comp_p}})
                         mention_comp_penis = user.mention_html(); achievement_text_comp_penis = new_penis_title_message_comp_p.format(mention=mention_comp_penis, size=new_penis_size_comp)
                         await context.bot.send_message(chat_id=chat_id, text=achievement_text_comp_penis, parse_mode='HTML')
             else:
@@ -2734,11 +4576,11 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             else: break
         if new_tits_title_achieved != current_tits_title_db:
              if new_tits_title_achieved:
-                await loop.run_in_executor(None, lambda: tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": new_tits_title_achieved}}))
+                await tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": new_tits_title_achieved}})
                 mention = user.mention_html(); achievement_text = new_tits_title_message.format(mention=mention, size=f"{new_tits_size:.1f}")
                 await context.bot.send_message(chat_id=chat_id, text=achievement_text, parse_mode='HTML')
              elif current_tits_title_db: # Если звание было, а теперь нет
-                await loop.run_in_executor(None, lambda: tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": None}}))
+                await tits_stats_collection.update_one({"user_id": user.id, "chat_id": chat_id},{"$set": {"current_tits_title": None}})
                 await context.bot.send_message(chat_id=chat_id, text=f"🗿 {user.mention_html()}, после изменения твои сиськи потеряли все звания!", parse_mode='HTML')
     except Exception as e:
         logger.error(f"Ошибка при изменении сисек для {user_display_name}: {e}", exc_info=True)
@@ -2746,31 +4588,14 @@ async def grow_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 # --- КОНЕЦ ИЗМЕНЕННОЙ grow_tits ---
 
 
+@maintenance_gate()
 async def show_my_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # --->>> НАЧАЛО ПРОВЕРКИ ТЕХРАБОТ (ВСТАВЬ В КАЖДУЮ КОМАНДНУЮ ФУНКЦИЮ!) <<<---
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-         logger.warning(f"grow_tits: нет данных в update для проверки техработ")
-         return
-    real_chat_id = update.message.chat.id; real_user_id = update.message.from_user.id; real_chat_type = update.message.chat.type
-    try: admin_id = int(os.getenv("ADMIN_USER_ID", "0"))
-    except ValueError: admin_id = 0
-    if admin_id == 0: logger.warning("ADMIN_USER_ID не задан для grow_tits!") # Можно убрать это логгирование в каждой функции
-    loop_for_maint = asyncio.get_running_loop() # Отдельный loop для вызова is_maintenance_mode
-    maintenance_active = await is_maintenance_mode(loop_for_maint)
-    if maintenance_active and (real_user_id != admin_id or real_chat_type != 'private'):
-        logger.info(f"Команда grow_tits отклонена из-за техработ в чате {real_chat_id}")
-        try:
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e: logger.warning(f"Не удалось ответить/удалить сообщение о техработах (grow_tits): {e}")
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
     if not update.message or not update.message.from_user or not update.message.chat: return
-    user = update.message.from_user; chat_id = update.message.chat.id; loop = asyncio.get_running_loop()
+    user = update.message.from_user; chat_id = update.message.chat.id
     profile_name_data = await get_user_profile_data(user); user_display_name = profile_name_data["display_name"]
     logger.info(f"Пользователь '{user_display_name}' (ID: {user.id}) запросил инфу о сиськах в чате {chat_id}.")
 
-    tits_stat = await loop.run_in_executor(None, lambda: tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id}))
+    tits_stat = await tits_stats_collection.find_one({"user_id": user.id, "chat_id": chat_id})
     current_tits_size = 0; current_tits_title = "Неизвестного размера (пока)"
     if tits_stat:
         current_tits_size = tits_stat.get("tits_size", 0)
@@ -2788,34 +4613,15 @@ async def show_my_tits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await context.bot.send_message(chat_id=chat_id, text=reply_text, parse_mode='HTML')
 
 
+@maintenance_gate()
 async def show_tits_top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # --->>> НАЧАЛО ПРОВЕРКИ ТЕХРАБОТ (ВСТАВЬ В КАЖДУЮ КОМАНДНУЮ ФУНКЦИЮ!) <<<---
-    if not update or not update.message or not update.message.from_user or not update.message.chat:
-         logger.warning(f"grow_tits: нет данных в update для проверки техработ")
-         return
-    real_chat_id = update.message.chat.id; real_user_id = update.message.from_user.id; real_chat_type = update.message.chat.type
-    try: admin_id = int(os.getenv("ADMIN_USER_ID", "0"))
-    except ValueError: admin_id = 0
-    if admin_id == 0: logger.warning("ADMIN_USER_ID не задан для grow_tits!") # Можно убрать это логгирование в каждой функции
-    loop_for_maint = asyncio.get_running_loop() # Отдельный loop для вызова is_maintenance_mode
-    maintenance_active = await is_maintenance_mode(loop_for_maint)
-    if maintenance_active and (real_user_id != admin_id or real_chat_type != 'private'):
-        logger.info(f"Команда grow_tits отклонена из-за техработ в чате {real_chat_id}")
-        try:
-            await context.bot.send_message(chat_id=real_chat_id, text="🔧 Сорян, у меня сейчас технические работы. Попробуй позже.")
-            await context.bot.delete_message(chat_id=real_chat_id, message_id=update.message.message_id)
-        except Exception as e: logger.warning(f"Не удалось ответить/удалить сообщение о техработах (grow_tits): {e}")
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
     if not update.message or not update.message.from_user or not update.message.chat: return
     chat_id = update.message.chat.id; user_name_req = update.message.from_user.first_name or "Фанатка Сисек"; chat_title = update.message.chat.title or "этого чата"
     logger.info(f"Пользователь '{user_name_req}' запросил топ сисек в чате '{chat_title}' ({chat_id})")
     TOP_N = 10
     try:
-        loop = asyncio.get_running_loop()
         query = {"chat_id": chat_id, "tits_size": {"$gte": 0}} # Берем всех, у кого не отрицательный размер
-        top_users_cursor = await loop.run_in_executor( None, lambda: tits_stats_collection.find(query, {"user_display_name": 1, "tits_size": 1, "_id": 0}).sort("tits_size", pymongo.DESCENDING).limit(TOP_N))
-        top_users_list = list(top_users_cursor)
+        top_users_list = await tits_stats_collection.find(query, {"user_display_name": 1, "tits_size": 1, "_id": 0}).sort("tits_size", pymongo.DESCENDING).limit(TOP_N).to_list()
         if not top_users_list:
             await context.bot.send_message(chat_id=chat_id, text=f"🗿 Пиздец, в чате '{chat_title}' одни плоскодонки или еще никто не начал растить сиськи! Топ пуст."); return
         reply_text_parts = [f"<b>🏆 Топ-{len(top_users_list)} Сисястых Богинь Чата '{chat_title}':</b>\n"]
@@ -2849,20 +4655,14 @@ async def list_bot_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text("🗿 Собираю досье на все притоны, где я прописан... Минутку.")
 
     try:
-        loop = asyncio.get_running_loop()
         
         # Запрашиваем все документы из chat_activity_collection, нам нужны chat_id и last_message_time
         # Дополнительно можно запросить название чата, если мы его храним там же
         # (но обычно название чата получается через context.bot.get_chat())
-        chat_docs_cursor = await loop.run_in_executor(
-            None,
-            lambda: chat_activity_collection.find(
+        chat_list = await chat_activity_collection.find(
                 {}, # Пустой фильтр - выбрать все документы
                 {"chat_id": 1, "last_message_time": 1, "_id": 0} # Проекция: только нужные поля
-            ).sort("last_message_time", pymongo.DESCENDING) # Сортируем по последней активности
-        )
-        
-        chat_list = list(chat_docs_cursor)
+            ).sort("last_message_time", pymongo.DESCENDING).to_list()
 
         if not chat_list:
             await update.message.reply_text("🗿 Похоже, меня еще никуда не добавили, либо я забыл, где я. Пусто, как в твоей голове после зарплаты.")
@@ -2926,8 +4726,7 @@ async def list_bot_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Отправляем сообщения админу
         for msg_part in response_messages:
             if msg_part.strip(): # Проверяем, что часть не пустая
-                await context.bot.send_message(chat_id=request_chat_id, text=msg_part, parse_mode='HTML')
-            await asyncio.sleep(0.3) # Небольшая задержка между сообщениями, чтобы не спамить API
+                await context.bot.send_message(chat_id=request_chat_id, text=msg_part, parse_mode='HTML') # Темп держит outbound_limiter
 
     except pymongo.errors.PyMongoError as e_mongo:
         logger.error(f"Ошибка MongoDB при получении списка чатов: {e_mongo}", exc_info=True)
@@ -2938,23 +4737,13 @@ async def list_bot_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 # Переименуем функцию для ясности
+@maintenance_gate("🔧 Техработы, сейчас не до выдумывания кличек.", delete_command=False)
 async def generate_and_set_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.from_user or not update.message.chat:
         return
 
     user = update.message.from_user
     chat_id = update.message.chat.id
-    loop = asyncio.get_running_loop()
-
-    # --->>> ПРОВЕРКА ТЕХРАБОТ (как и раньше) <<<---
-    maintenance_active = await is_maintenance_mode(loop)
-    if maintenance_active and (user.id != ADMIN_USER_ID or update.message.chat.type != 'private'):
-        # ... (сообщение о техработах и return) ...
-        logger.info(f"Команда генерации ника отклонена из-за техработ в чате {chat_id}")
-        try: await update.message.reply_text("🔧 Техработы, сейчас не до выдумывания кличек.")
-        except Exception: pass
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
 
     user_profile_data = await get_user_profile_data(user) # Получаем текущие данные для имени и пр.
     user_display_name_before = user_profile_data["display_name"]
@@ -2971,10 +4760,7 @@ async def generate_and_set_nickname(update: Update, context: ContextTypes.DEFAUL
         query_context = {"user_id": user.id}
         sort_order_context = [("timestamp", pymongo.DESCENDING)]
         
-        history_cursor_context = await loop.run_in_executor(
-            None, lambda: history_collection.find(query_context).sort(sort_order_context).limit(USER_CONTEXT_LIMIT_FOR_NICKNAME)
-        )
-        user_messages_docs = list(history_cursor_context)[::-1] # Переворачиваем для хронологии
+        user_messages_docs = (await history_collection.find(query_context).sort(sort_order_context).limit(USER_CONTEXT_LIMIT_FOR_NICKNAME).to_list())[::-1] # Переворачиваем для хронологии
 
         if user_messages_docs:
             # Берем только текстовое содержимое, игнорируя стикеры/картинки для простоты промпта
@@ -3022,9 +4808,9 @@ async def generate_and_set_nickname(update: Update, context: ContextTypes.DEFAUL
 
     generated_nickname = await _call_ionet_api(
         messages=[{"role": "user", "content": nickname_generation_prompt}],
-        model_id=IONET_TEXT_MODEL_ID,
+        model_id=route_model("nickname"),
         max_tokens=30, # Ник короткий
-        temperature=0.9 # Высокая температура для креативности
+        temperature=0.9, chat_id=chat_id # Высокая температура для креативности
     )
 
     if not generated_nickname or generated_nickname.startswith("[") or len(generated_nickname.split()) > 5 or len(generated_nickname) > 40: # Проверка на адекватность ответа
@@ -3046,9 +4832,7 @@ async def generate_and_set_nickname(update: Update, context: ContextTypes.DEFAUL
     # --->>> 3. УСТАНОВКА НИКА И КОММЕНТАРИЙ ОТ ПОПИЗДЯКИ <<<---
     try:
         # Обновляем или создаем профиль с новым ником
-        await loop.run_in_executor(
-            None,
-            lambda: user_profiles_collection.update_one(
+        await user_profiles_collection.update_one(
                 {"user_id": user.id},
                 {"$set": {"custom_nickname": generated_nickname, "tg_first_name": user.first_name, "tg_username": user.username},
                  "$setOnInsert": { "user_id": user.id, "message_count": 0, "current_title": None,
@@ -3057,7 +4841,7 @@ async def generate_and_set_nickname(update: Update, context: ContextTypes.DEFAUL
                 },
                 upsert=True
             )
-        )
+        profile_cache_invalidate(user.id)
         
         # Сообщение от Попиздяки с новым ником (тоже через ИИ)
         comment_on_new_nickname_prompt = (
@@ -3074,9 +4858,9 @@ async def generate_and_set_nickname(update: Update, context: ContextTypes.DEFAUL
 
         ai_comment_message = await _call_ionet_api(
             messages=[{"role": "user", "content": comment_on_new_nickname_prompt}],
-            model_id=IONET_TEXT_MODEL_ID,
+            model_id=route_model("nickname"),
             max_tokens=150, # Чуть больше для комментария
-            temperature=0.8
+            temperature=0.8, chat_id=chat_id
         ) or f"🗿 Короче, теперь ты у нас <b>{generated_nickname}</b>. Привыкай, хуила."
 
         if not ai_comment_message.startswith("🗿"): ai_comment_message = "🗿 " + ai_comment_message
@@ -3112,15 +4896,12 @@ async def _reveal_truth_or_shit_answer(
         original_question_msg_id: int,
         triggered_by_user: User | None = None # Кто нажал кнопку "Раскрыть" (если применимо)
     ):
-    loop = asyncio.get_running_loop()
     logger.info(f"Запрос на раскрытие ответа для игры (msg_id: {original_question_msg_id}) в чате {chat_id}.")
 
-    game_data = await loop.run_in_executor(
-        None, lambda: active_truth_or_shit_games_collection.find_one_and_update(
+    game_data = await active_truth_or_shit_games_collection.find_one_and_update(
             {"chat_id": chat_id, "message_id_question": original_question_msg_id, "revealed": False},
             {"$set": {"revealed": True}} # Сразу помечаем как раскрытое, чтобы избежать гонок состояний
         )
-    )
 
     if not game_data: # Либо игра не найдена, либо уже была раскрыта
         logger.info(f"Игра (msg_id: {original_question_msg_id}) в чате {chat_id} не найдена или уже раскрыта. Ничего не делаем.")
@@ -3166,7 +4947,7 @@ async def _reveal_truth_or_shit_answer(
     )
     ai_reveal_comment = await _call_ionet_api(
         messages=[{"role": "user", "content": reveal_comment_prompt}],
-        model_id=IONET_TEXT_MODEL_ID, max_tokens=200, temperature=0.8
+        model_id=route_model("tos_comment"), max_tokens=200, temperature=0.8, chat_id=chat_id
     ) or "🗿 Ну вот и все. Кто угадал - тот не совсем дебил. Остальные - просто дебилы, смиритесь."
     if not ai_reveal_comment.startswith("🗿"): ai_reveal_comment = "🗿 " + ai_reveal_comment
 
@@ -3200,13 +4981,11 @@ async def _reveal_truth_or_shit_answer(
     logger.info(f"Игра (msg_id: {original_question_msg_id}) в чате {chat_id} успешно раскрыта. Правильный ответ: {correct_answer_is_truth}")
 
     # Обновляем время последней игры в chat_activity для кулдауна
-    await loop.run_in_executor(
-        None, lambda: chat_activity_collection.update_one(
+    await chat_activity_collection.update_one(
             {"chat_id": chat_id},
             {"$set": {"last_tos_game_end_time": datetime.datetime.now(datetime.timezone.utc)}}, # Используем время окончания
             upsert=True
         )
-    )
 # --- КОНЕЦ ВСПОМОГАТЕЛЬНОЙ ФУНКЦИИ ---
 
 # --- JOB ДЛЯ АВТОМАТИЧЕСКОГО РАСКРЫТИЯ "ПРАВДА ИЛИ ВЫСЕР" ---
@@ -3223,26 +5002,135 @@ async def auto_reveal_truth_or_shit_job(context: ContextTypes.DEFAULT_TYPE) -> N
     await _reveal_truth_or_shit_answer(context, chat_id, message_id_question, triggered_by_user=None)
 # --- КОНЕЦ JOB ДЛЯ АВТОМАТИЧЕСКОГО РАСКРЫТИЯ ---
 
+# --->>> ПУЛ ЗАГОТОВЛЕННЫХ УТВЕРЖДЕНИЙ ДЛЯ "ПРАВДА ИЛИ ВЫСЕР" <<<---
+# Фоновая джоба держит в Монге запас правд и высеров, игры берут оттуда мгновенно.
+# Дубли режем по хэшу нормализованного текста (уникальный индекс), использованные не удаляем - они тоже участвуют в дедупе.
+TOS_POOL_LOW_WATERMARK = int(os.getenv("TOS_POOL_LOW_WATERMARK", "15")) # Ниже этого (на каждый тип) - доливаем
+TOS_POOL_TARGET_SIZE = int(os.getenv("TOS_POOL_TARGET_SIZE", "40"))     # До скольки доливаем
+TOS_POOL_REFILL_MAX_PER_RUN = int(os.getenv("TOS_POOL_REFILL_MAX_PER_RUN", "20")) # Потолок генераций за один прогон джобы
+TOS_POOL_REFILL_CONCURRENCY = 2
+TOS_POOL_REFILL_INTERVAL_SECONDS = int(os.getenv("TOS_POOL_REFILL_INTERVAL_SECONDS", "600"))
+tos_pool_refill_lock = asyncio.Lock()
+tos_pool_stats = {"drawn": 0, "live_fallbacks": 0, "generated": 0, "duplicates": 0}
+
+def _tos_statement_prompt(should_be_truth: bool) -> str:
+    if should_be_truth:
+        return (
+            "Ты - Попиздяка, кладезь странных, но реальных фактов. Придумай ОДИН МАЛОИЗВЕСТНЫЙ, но РЕАЛЬНЫЙ и ПРОВЕРЯЕМЫЙ факт. "
+            "Он должен быть сформулирован как утверждение, коротко (1-2 предложения) и без указания, что это правда. "
+            "Не используй фразы типа 'Попиздяка утверждает'. Просто сам факт."
+            "\nПример: Медуза Turritopsis Dohrnii потенциально бессмертна."
+            "\nВАЖНО: Не повторяй факты, которые ты уже мог генерировать." # Попытка уменьшить повторы
+        )
+    # Должен быть высер
+    return (
+        "Ты - Попиздяка, генератор абсурдного бреда. Придумай ОДИН АБСОЛЮТНО ЛЖИВЫЙ, но НАУКООБРАЗНЫЙ и ПРАВДОПОДОБНО ЗВУЧАЩИЙ высер. "
+        "Он должен быть сформулирован как утверждение, коротко (1-2 предложения) и без указания, что это ложь. "
+        "Не используй фразы типа 'Попиздяка утверждает'. Просто сам высер."
+        "\nПример: Если чихнуть с открытыми глазами, они вылетят из орбит со скоростью пробки от шампанского."
+        "\nВАЖНО: Не повторяй высеры, которые ты уже мог генерировать."
+    )
+
+def _tos_statement_hash(statement: str) -> str:
+    """Хэш нормализованного текста: регистр, ё/е, пунктуация и пробелы не влияют."""
+    normalized = statement.lower().replace("ё", "е")
+    normalized = re.sub(r"^\W*попиздяка утверждает\W*", "", normalized)
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", normalized).split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+async def _generate_tos_statement(should_be_truth: bool, priority: int, chat_id: int | None = None) -> str | None:
+    """Один свежий вызов ИИ. Возвращает текст утверждения или None, если ИИ выдал хуйню/ошибку."""
+    generated_statement_text = await _call_ionet_api(
+        messages=[{"role": "user", "content": _tos_statement_prompt(should_be_truth)}],
+        model_id=route_model("tos_statement"), max_tokens=100, temperature=0.9, # Повысим температуру для разнообразия
+        priority=priority, chat_id=chat_id
+    )
+    if not generated_statement_text or generated_statement_text.startswith(("[", "🗿")) or len(generated_statement_text.strip()) < 10:
+        return None
+    return generated_statement_text.strip()
+
+async def _add_tos_statement_to_pool(statement: str, is_truth: bool, used_in_chat: int | None = None) -> bool:
+    """Кладет утверждение в пул (used_in_chat - сразу помечает использованным). False - такое уже было."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        await tos_statement_pool_collection.insert_one({
+            "text_hash": _tos_statement_hash(statement), "statement": statement, "is_truth": is_truth,
+            "created_at": now, "used_at": now if used_in_chat is not None else None, "used_in_chat": used_in_chat,
+        })
+        return True
+    except pymongo.errors.DuplicateKeyError:
+        tos_pool_stats["duplicates"] += 1
+        return False
+
+async def draw_tos_statement(should_be_truth: bool, chat_id: int, priority: int = LLM_PRIORITY_COMMAND) -> str | None:
+    """Берет неиспользованное утверждение из пула, если пул пуст - генерит вживую (и запоминает для дедупа)."""
+    try:
+        pooled = await tos_statement_pool_collection.find_one_and_update(
+            {"is_truth": should_be_truth, "used_at": None},
+            {"$set": {"used_at": datetime.datetime.now(datetime.timezone.utc), "used_in_chat": chat_id}},
+            sort=[("created_at", pymongo.ASCENDING)]
+        )
+        if pooled:
+            tos_pool_stats["drawn"] += 1
+            return pooled["statement"]
+    except Exception as e:
+        logger.error(f"Ошибка выборки из пула утверждений: {e}")
+
+    tos_pool_stats["live_fallbacks"] += 1
+    logger.info(f"Пул утверждений ({'правда' if should_be_truth else 'высер'}) пуст, генерю вживую для чата {chat_id}.")
+    statement = None
+    for _ in range(2): # Одна повторная попытка, если ИИ выдал уже виденное
+        statement = await _generate_tos_statement(should_be_truth, priority, chat_id)
+        if not statement:
+            return None
+        try:
+            if await _add_tos_statement_to_pool(statement, should_be_truth, used_in_chat=chat_id):
+                break
+        except Exception as e:
+            logger.warning(f"Не удалось записать живое утверждение в пул: {e}")
+            break
+    return statement # Даже повтор лучше, чем ничего
+
+async def refill_tos_statement_pool(context: ContextTypes.DEFAULT_TYPE | None = None) -> None:
+    """Джоба: доливает пул каждого типа до TOS_POOL_TARGET_SIZE, если он упал ниже TOS_POOL_LOW_WATERMARK."""
+    if maintenance_state["active"] or tos_pool_refill_lock.locked():
+        return
+    async with tos_pool_refill_lock:
+        semaphore = asyncio.Semaphore(TOS_POOL_REFILL_CONCURRENCY)
+
+        async def generate_one(should_be_truth: bool) -> None:
+            async with semaphore:
+                statement = await _generate_tos_statement(should_be_truth, LLM_PRIORITY_BACKGROUND)
+                if statement and await _add_tos_statement_to_pool(statement, should_be_truth):
+                    tos_pool_stats["generated"] += 1
+
+        for should_be_truth in (True, False):
+            kind = "правд" if should_be_truth else "высеров"
+            try:
+                available = await tos_statement_pool_collection.count_documents({"is_truth": should_be_truth, "used_at": None})
+                if available >= TOS_POOL_LOW_WATERMARK:
+                    continue
+                to_generate = min(TOS_POOL_TARGET_SIZE - available, TOS_POOL_REFILL_MAX_PER_RUN)
+                logger.info(f"В пуле {available} {kind}, доливаю {to_generate}...")
+                results = await asyncio.gather(*(generate_one(should_be_truth) for _ in range(to_generate)), return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception): logger.warning(f"Генерация в пул {kind} упала: {result}")
+            except Exception as e:
+                logger.error(f"Ошибка долива пула {kind}: {e}", exc_info=True)
+        logger.info(f"Долив пула утверждений завершен: {tos_pool_stats}")
+# --->>> КОНЕЦ ПУЛА УТВЕРЖДЕНИЙ <<<---
+
 # --- КОМАНДА ЗАПУСКА ИГРЫ "ПРАВДА ИЛИ ВЫСЕР" ---
+@maintenance_gate("🔧 Техработы, не до игр разума сегодня.", delete_command=False)
 async def start_truth_or_shit_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.chat or not update.message.from_user:
         return
 
     chat_id = update.message.chat.id
     user = update.message.from_user
-    loop = asyncio.get_running_loop()
-
-    # --->>> ПРОВЕРКА ТЕХРАБОТ <<<---
-    maintenance_active = await is_maintenance_mode(loop)
-    if maintenance_active and (user.id != ADMIN_USER_ID or update.message.chat.type != 'private'):
-        await update.message.reply_text("🔧 Техработы, не до игр разума сегодня.")
-        return
-    # --->>> КОНЕЦ ПРОВЕРКИ ТЕХРАБОТ <<<---
 
     # --->>> ПРОВЕРКА КУЛДАУНА ДЛЯ ЧАТА <<<---
-    chat_activity = await loop.run_in_executor(
-        None, lambda: chat_activity_collection.find_one({"chat_id": chat_id})
-    )
+    chat_activity = await chat_activity_collection.find_one({"chat_id": chat_id})
     now_utc_start = datetime.datetime.now(datetime.timezone.utc)
     # Используем время окончания предыдущей игры для кулдауна
     if chat_activity and "last_tos_game_end_time" in chat_activity:
@@ -3257,9 +5145,7 @@ async def start_truth_or_shit_game(update: Update, context: ContextTypes.DEFAULT
     # --->>> КОНЕЦ ПРОВЕРКИ КУЛДАУНА <<<---
 
     # --- Проверка, нет ли уже активной (нераскрытой) игры ---
-    active_game = await loop.run_in_executor(
-        None, lambda: active_truth_or_shit_games_collection.find_one({"chat_id": chat_id, "revealed": False})
-    )
+    active_game = await active_truth_or_shit_games_collection.find_one({"chat_id": chat_id, "revealed": False})
     if active_game:
         # Пересоздаем кнопки для существующей игры
         keyboard_active = [
@@ -3285,32 +5171,13 @@ async def start_truth_or_shit_game(update: Update, context: ContextTypes.DEFAULT
     thinking_msg = await update.message.reply_text("🗿 Ща я вам загадку от Попиздяки придумаю, готовьте свои куриные мозги...")
 
     should_be_truth = random.choice([True, False])
-
-    if should_be_truth:
-        statement_prompt = (
-            "Ты - Попиздяка, кладезь странных, но реальных фактов. Придумай ОДИН МАЛОИЗВЕСТНЫЙ, но РЕАЛЬНЫЙ и ПРОВЕРЯЕМЫЙ факт. "
-            "Он должен быть сформулирован как утверждение, коротко (1-2 предложения) и без указания, что это правда. "
-            "Не используй фразы типа 'Попиздяка утверждает'. Просто сам факт."
-            "\nПример: Медуза Turritopsis Dohrnii потенциально бессмертна."
-        )
-    else:
-        statement_prompt = (
-            "Ты - Попиздяка, генератор абсурдного бреда. Придумай ОДИН АБСОЛЮТНО ЛЖИВЫЙ, но НАУКООБРАЗНЫЙ и ПРАВДОПОДОБНО ЗВУЧАЩИЙ высер. "
-            "Он должен быть сформулирован как утверждение, коротко (1-2 предложения) и без указания, что это ложь. "
-            "Не используй фразы типа 'Попиздяка утверждает'. Просто сам высер."
-            "\nПример: Если чихнуть с открытыми глазами, они вылетят из орбит со скоростью пробки от шампанского."
-        )
-    
-    generated_statement_text = await _call_ionet_api(
-        messages=[{"role": "user", "content": statement_prompt}],
-        model_id=IONET_TEXT_MODEL_ID, max_tokens=100, temperature=0.85 # Температуру можно подкрутить
-    )
+    generated_statement_text = await draw_tos_statement(should_be_truth, chat_id)
 
     if thinking_msg:
         try: await context.bot.delete_message(chat_id=chat_id, message_id=thinking_msg.message_id)
         except Exception: pass
 
-    if not generated_statement_text or generated_statement_text.startswith("[") or len(generated_statement_text.strip()) < 10: # Проверка на минимальную длину
+    if not generated_statement_text: # Пул пуст, а живая генерация обосралась
         await update.message.reply_text("🗿 Мой ИИ-мозг сегодня выдал какую-то хуйню вместо загадки. Попробуйте позже или пните админа.")
         return
     
@@ -3338,7 +5205,7 @@ async def start_truth_or_shit_game(update: Update, context: ContextTypes.DEFAULT
         "statement": final_statement_for_game, "is_truth": should_be_truth,
         "created_at": now_utc_start, "votes": {}, "revealed": False
     }
-    await loop.run_in_executor(None, lambda: active_truth_or_shit_games_collection.insert_one(game_data_to_save))
+    await active_truth_or_shit_games_collection.insert_one(game_data_to_save)
     logger.info(f"Игра 'Правда или Высер' запущена в чате {chat_id}. MsgID: {msg_id_for_callback}, Утверждение: '{final_statement_for_game[:50]}...', Ответ: {should_be_truth}")
 
     # Планируем авто-раскрытие
@@ -3391,20 +5258,15 @@ async def truth_or_shit_button_callback(update: Update, context: ContextTypes.DE
 
     chat_id = query.message.chat_id
     user_who_clicked = query.from_user # Это объект telegram.User
-    loop = asyncio.get_running_loop()
 
     # Найти активную игру (еще не раскрытую)
-    game_data = await loop.run_in_executor(
-        None, lambda: active_truth_or_shit_games_collection.find_one(
+    game_data = await active_truth_or_shit_games_collection.find_one(
             {"chat_id": chat_id, "message_id_question": original_question_msg_id, "revealed": False}
         )
-    )
 
     if not game_data:
-        already_revealed_game = await loop.run_in_executor( # Проверим, может она уже раскрыта
-             None, lambda: active_truth_or_shit_games_collection.find_one(
-                {"chat_id": chat_id, "message_id_question": original_question_msg_id, "revealed": True}
-            )
+        already_revealed_game = await active_truth_or_shit_games_collection.find_one( # Проверим, может она уже раскрыта
+            {"chat_id": chat_id, "message_id_question": original_question_msg_id, "revealed": True}
         )
         if already_revealed_game:
              text_for_old_game = (f"<b>Игра 'Правда или Высер' ОКОНЧЕНА!</b>\n\n"
@@ -3438,12 +5300,10 @@ async def truth_or_shit_button_callback(update: Update, context: ContextTypes.DE
         # Запись голоса
         # Мы не можем напрямую обновить поле в словаре votes без $set и указания ключа user_id
         # Поэтому используем $set с "точечной нотацией"
-        update_result = await loop.run_in_executor(
-            None, lambda: active_truth_or_shit_games_collection.update_one(
+        update_result = await active_truth_or_shit_games_collection.update_one(
                 {"_id": game_data["_id"]}, # Находим по уникальному _id документа игры
                 {"$set": {f"votes.{user_who_clicked.id}": {"name": user_who_clicked.first_name, "vote": user_vote_as_bool} }}
             )
-        )
         
         if update_result.modified_count > 0:
             logger.info(f"Пользователь {user_who_clicked.first_name} ({user_who_clicked.id}) в чате {chat_id} проголосовал '{user_vote_as_bool}' за игру msg_id {original_question_msg_id}")
@@ -3490,25 +5350,16 @@ async def truth_or_shit_button_callback(update: Update, context: ContextTypes.DE
 
 # Импорты: InlineKeyboardMarkup, InlineKeyboardButton, User (если еще нет)
 
+@maintenance_gate("🔧 Техработы, не до эпичных заруб.", delete_command=False)
 async def start_tos_battle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.chat or not update.message.from_user:
         return
 
     chat_id = update.message.chat.id
     host_user = update.message.from_user
-    loop = asyncio.get_running_loop()
-
-    # --->>> ПРОВЕРКА ТЕХРАБОТ (стандартная) <<<---
-    # ... (скопируй из других функций)
-    maintenance_active = await is_maintenance_mode(loop)
-    if maintenance_active and (host_user.id != ADMIN_USER_ID or update.message.chat.type != 'private'):
-        await update.message.reply_text("🔧 Техработы, не до эпичных заруб.")
-        return
 
     # --->>> ПРОВЕРКА КУЛДАУНА БАТТЛА <<<---
-    chat_activity = await loop.run_in_executor(
-        None, lambda: chat_activity_collection.find_one({"chat_id": chat_id})
-    )
+    chat_activity = await chat_activity_collection.find_one({"chat_id": chat_id})
     now_utc = datetime.datetime.now(datetime.timezone.utc)
     if chat_activity and "last_tos_battle_end_time" in chat_activity:
         last_battle_end_time = chat_activity["last_tos_battle_end_time"]
@@ -3520,9 +5371,7 @@ async def start_tos_battle(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             return
 
     # --- Проверка, нет ли уже активной игры (набор или идет) ---
-    active_battle = await loop.run_in_executor(
-        None, lambda: tos_battles_collection.find_one({"chat_id": chat_id, "status": {"$in": ["recruiting", "playing"]}})
-    )
+    active_battle = await tos_battles_collection.find_one({"chat_id": chat_id, "status": {"$in": ["recruiting", "playing"]}})
     if active_battle:
         status_text = "идет набор участников" if active_battle['status'] == 'recruiting' else "уже в самом разгаре"
         await update.message.reply_text(f"🗿 Э, тормози, в этом чате уже {status_text} Баттл 'Правда или Высер'! Дождись окончания или участвуй, если еще можно.")
@@ -3608,7 +5457,7 @@ async def start_tos_battle(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         "message_id_last_extension_notice": None, # <<<--- ВОТ ЭТО ПОЛЕ
         "prizes_awarded_info": {} 
     }
-    await loop.run_in_executor(None, lambda: tos_battles_collection.insert_one(battle_data))
+    await tos_battles_collection.insert_one(battle_data)
     logger.info(f"Баттл 'Правда или Высер' (game_id: {game_id}) запущен хостом {host_user.id} в чате {chat_id}. Набор до {recruitment_ends_at}.")
 
     # Планируем окончание набора, если хост не начнет раньше
@@ -3643,7 +5492,6 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
     action = parts[1]
     chat_id = query.message.chat.id
     user_who_clicked = query.from_user 
-    loop = asyncio.get_running_loop()
 
     game_id_from_cb_str = None
     if action in ["extend", "start", "cancel"] and len(parts) >= 3: # tosbattle_ACTION_GAMEID
@@ -3684,16 +5532,12 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
         battle_search_filter.pop("game_id", None) 
         battle_search_filter["status"] = "recruiting" # Ищем любую игру в наборе
 
-    battle = await loop.run_in_executor(
-        None, lambda: tos_battles_collection.find_one(battle_search_filter)
-    )
+    battle = await tos_battles_collection.find_one(battle_search_filter)
 
     if not battle:
         # Если для join без game_id не нашли, а game_id_from_cb был None, значит игра не найдена
         if action == "join" and not game_id_from_cb_str: # Проверяем game_id_from_cb_str, т.к. game_id_int мог не инициализироваться
-             active_recruiting_battle_fallback = await loop.run_in_executor(
-                None, lambda: tos_battles_collection.find_one({"chat_id": chat_id, "status": "recruiting"})
-             )
+             active_recruiting_battle_fallback = await tos_battles_collection.find_one({"chat_id": chat_id, "status": "recruiting"})
              if active_recruiting_battle_fallback:
                  battle = active_recruiting_battle_fallback
                  game_id_int = battle["game_id"] 
@@ -3731,11 +5575,9 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
             user_name_to_store = user_who_clicked.first_name or user_who_clicked.username or f"Анон-{user_who_clicked.id}"
             new_participant_data = {"name": user_name_to_store, "score": 0, "answers": [None] * TOS_BATTLE_NUM_QUESTIONS}
             
-            update_join = await loop.run_in_executor(
-                None, lambda: tos_battles_collection.update_one(
+            update_join = await tos_battles_collection.update_one(
                     {"_id": battle_doc_id}, {"$set": {f"participants.{user_who_clicked.id}": new_participant_data}}
                 )
-            )
             if update_join.modified_count > 0:
                 logger.info(f"User {user_who_clicked.id} присоединился к баттлу {game_id_int}")
                 await context.bot.send_message(chat_id, f"✅ {user_who_clicked.mention_html()} теперь в деле! Готовься позориться или блистать тупостью!", parse_mode='HTML', reply_to_message_id=game_id_int)
@@ -3744,7 +5586,7 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
 
         elif action == "extend" and user_who_clicked.id == battle.get("host_id"):
             # Сначала получим актуальное состояние баттла, включая message_id_last_extension_notice
-            battle_current_for_extend = await loop.run_in_executor(None, lambda: tos_battles_collection.find_one({"_id": battle_doc_id})) # battle_doc_id должен быть определен ранее
+            battle_current_for_extend = await tos_battles_collection.find_one({"_id": battle_doc_id}) # battle_doc_id должен быть определен ранее
             if not battle_current_for_extend or battle_current_for_extend.get("status") != "recruiting":
                 await context.bot.send_message(chat_id, "Не удалось продлить: игра уже не в стадии набора или ошибка.", reply_to_message_id=game_id_int) # game_id_int должен быть определен ранее
                 return
@@ -3757,12 +5599,10 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
 
             new_recruitment_ends_at_utc_for_update = current_recruitment_ends_at_from_db + datetime.timedelta(seconds=TOS_BATTLE_RECRUITMENT_EXTENSION_SECONDS)
             
-            update_result_extend_time = await loop.run_in_executor(
-                None, lambda: tos_battles_collection.update_one(
+            update_result_extend_time = await tos_battles_collection.update_one(
                     {"_id": battle_doc_id, "status": "recruiting"},
                     {"$set": {"recruitment_ends_at": new_recruitment_ends_at_utc_for_update}}
                 )
-            )
             
             if update_result_extend_time.modified_count > 0:
                 logger.info(f"Хост {user_who_clicked.id} продлил набор для баттла {game_id_int} до {new_recruitment_ends_at_utc_for_update}")
@@ -3800,12 +5640,10 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
                         f"Новое время окончания набора: <b>{new_recruitment_ends_at_msk_display.strftime('%H:%M:%S MSK')}</b> (осталось ~{time_left_str_display}).",
                         parse_mode='HTML', reply_to_message_id=game_id_int 
                     )
-                    await loop.run_in_executor(
-                        None, lambda: tos_battles_collection.update_one(
+                    await tos_battles_collection.update_one(
                             {"_id": battle_doc_id},
                             {"$set": {"message_id_last_extension_notice": new_extension_notice_message.message_id}}
                         )
-                    )
                 else: 
                     await context.bot.send_message(chat_id, "Хост пытался продлить, но время уже истекло или что-то пошло не так. Набор завершается...", reply_to_message_id=game_id_int)
                     job_data_manual = {'game_id': game_id_int, 'host_id': battle["host_id"], 'chat_id': chat_id} 
@@ -3826,19 +5664,18 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
 
         elif action == "cancel" and user_who_clicked.id == battle.get("host_id"):
             logger.info(f"Хост {user_who_clicked.id} нажал кнопку отмены баттла {game_id_int} в чате {chat_id}.")
-            update_cancel_result_cb = await loop.run_in_executor(
-                None, lambda: tos_battles_collection.find_one_and_update(
+            update_cancel_result_cb = await tos_battles_collection.find_one_and_update(
                     {"_id": battle_doc_id, "status": "recruiting"},
                     {"$set": {"status": "cancelled_by_host", "finished_at": datetime.datetime.now(datetime.timezone.utc)}},
                     return_document=pymongo.ReturnDocument.AFTER
                 )
-            )
             if not update_cancel_result_cb or update_cancel_result_cb.get("status") != "cancelled_by_host":
                 logger.warning(f"Не удалось отменить баттл {game_id_int}: он уже не в статусе 'recruiting' или ошибка БД.")
                 await query.answer("Не удалось отменить игру.", show_alert=True)
                 try: await query.edit_message_reply_markup(reply_markup=None)
                 except Exception: pass
                 return
+            cancel_battle_tasks(battle_doc_id) # Если старт уже начал генерить вопросы
 
             try: await context.bot.unpin_chat_message(chat_id=chat_id, message_id=game_id_int)
             except Exception: pass 
@@ -3854,11 +5691,9 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
             job_name_to_cancel_cb_j = f"tosbattle_recruit_end_{chat_id}_{game_id_int}"
             for old_job_cb_cancel_j in context.job_queue.get_jobs_by_name(job_name_to_cancel_cb_j): old_job_cb_cancel_j.schedule_removal()
             
-            await loop.run_in_executor(
-                None, lambda: chat_activity_collection.update_one(
+            await chat_activity_collection.update_one(
                     {"chat_id": chat_id}, {"$set": {"last_tos_battle_end_time": datetime.datetime.now(datetime.timezone.utc)}}, upsert=True
                 )
-            )
             logger.info(f"Баттл {game_id_int} отменен хостом. Кулдаун обновлен.")
         
         else: 
@@ -3906,7 +5741,7 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
             return
 
         # Получаем актуальные ответы на этот вопрос из БД, чтобы проверить, не голосовал ли юзер уже
-        battle_reloaded_for_ans_check_cb = await loop.run_in_executor(None, lambda: tos_battles_collection.find_one({"_id": battle_doc_id}))
+        battle_reloaded_for_ans_check_cb = await tos_battles_collection.find_one({"_id": battle_doc_id})
         if not battle_reloaded_for_ans_check_cb:
             # await query.answer("Ошибка: не могу проверить твой предыдущий ответ.", show_alert=True) # Убираем
             return
@@ -3928,19 +5763,17 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
         user_name_ans_rec_db_cb = user_who_clicked.first_name or user_who_clicked.username or f"Анон-{user_who_clicked.id}"
         answer_record_to_db_ans_cb = {"name": user_name_ans_rec_db_cb, "answer_bool": user_answer_as_bool_ans, "answered_at": datetime.datetime.now(datetime.timezone.utc)}
         
-        update_ans_q_db_cb = await loop.run_in_executor(
-            None, lambda: tos_battles_collection.update_one(
+        update_ans_q_db_cb = await tos_battles_collection.update_one(
                 {"_id": battle_doc_id, f"questions.{question_index_cb_ans}.revealed_to_users": False}, 
                 {"$set": {f"questions.{question_index_cb_ans}.user_answers_to_this_q.{user_who_clicked.id}": answer_record_to_db_ans_cb}}
             )
-        )
 
         if update_ans_q_db_cb.modified_count > 0:
             logger.info(f"User {user_who_clicked.id} ответил '{user_answer_as_bool_ans}' на Q{question_index_cb_ans} баттла {game_id_int}")
             
             # --->>> ОБНОВЛЕНИЕ КНОПОК СО СЧЕТЧИКАМИ <<<---
             # Получаем самые свежие данные об ответах на этот вопрос ПОСЛЕ нашего обновления
-            battle_after_vote = await loop.run_in_executor(None, lambda: tos_battles_collection.find_one({"_id": battle_doc_id}))
+            battle_after_vote = await tos_battles_collection.find_one({"_id": battle_doc_id})
             if not battle_after_vote or "questions" not in battle_after_vote or \
                question_index_cb_ans >= len(battle_after_vote["questions"]):
                 logger.error(f"Не удалось получить обновленный баттл для обновления кнопок Q{question_index_cb_ans}")
@@ -4024,47 +5857,119 @@ async def tos_battle_button_callback(update: Update, context: ContextTypes.DEFAU
         awarded_tits = 0.0
 
         if prize_type_choice_cb == "penis":
-            penis_stat_prize_cb_val = await loop.run_in_executor(None, lambda: penis_stats_collection.find_one({"user_id": winner_id_from_prize_cb_val, "chat_id": chat_id}))
+            penis_stat_prize_cb_val = await penis_stats_collection.find_one({"user_id": winner_id_from_prize_cb_val, "chat_id": chat_id})
             current_penis_size_cb_val = penis_stat_prize_cb_val.get("penis_size", 0) if penis_stat_prize_cb_val else 0
             # Приз для одного победителя (TOS_BATTLE_PENIS_REWARD_CM)
             new_penis_size_cb_val = current_penis_size_cb_val + TOS_BATTLE_PENIS_REWARD_CM 
             awarded_penis = TOS_BATTLE_PENIS_REWARD_CM
-            await loop.run_in_executor(None, lambda: penis_stats_collection.update_one(
+            await penis_stats_collection.update_one(
                 {"user_id": winner_id_from_prize_cb_val, "chat_id": chat_id},
                 {"$set": {"penis_size": new_penis_size_cb_val, "user_display_name": winner_display_name_prize_cb}}, upsert=True
-            ))
+            )
             prize_applied_msg_cb = f"🍆 Писюн <b>{winner_display_name_prize_cb}</b> ВНЕЗАПНО вырос на {TOS_BATTLE_PENIS_REWARD_CM}см и теперь составляет <b>{new_penis_size_cb_val}см</b>!"
             logger.info(f"Приз (писюн +{TOS_BATTLE_PENIS_REWARD_CM}) выдан {winner_display_name_prize_cb} за баттл {game_id_int}.")
             
         elif prize_type_choice_cb == "tits":
-            tits_stat_prize_cb_val = await loop.run_in_executor(None, lambda: tits_stats_collection.find_one({"user_id": winner_id_from_prize_cb_val, "chat_id": chat_id}))
+            tits_stat_prize_cb_val = await tits_stats_collection.find_one({"user_id": winner_id_from_prize_cb_val, "chat_id": chat_id})
             current_tits_size_cb_val = float(tits_stat_prize_cb_val.get("tits_size", 0.0)) if tits_stat_prize_cb_val else 0.0
             # Приз для одного победителя (TOS_BATTLE_TITS_REWARD_SIZE)
             new_tits_size_cb_val = round(current_tits_size_cb_val + TOS_BATTLE_TITS_REWARD_SIZE, 1)
             awarded_tits = TOS_BATTLE_TITS_REWARD_SIZE
-            await loop.run_in_executor(None, lambda: tits_stats_collection.update_one(
+            await tits_stats_collection.update_one(
                 {"user_id": winner_id_from_prize_cb_val, "chat_id": chat_id},
                 {"$set": {"tits_size": new_tits_size_cb_val, "user_display_name": winner_display_name_prize_cb}}, upsert=True
-            ))
+            )
             prize_applied_msg_cb = f"🍈 Сиськи <b>{winner_display_name_prize_cb}</b> подросли на {TOS_BATTLE_TITS_REWARD_SIZE:.1f} размера и стали <b>{new_tits_size_cb_val:.1f}-го</b>!"
             logger.info(f"Приз (сиськи +{TOS_BATTLE_TITS_REWARD_SIZE:.1f}) выдан {winner_display_name_prize_cb} за баттл {game_id_int}.")
         
         if prize_applied_msg_cb:
             await context.bot.send_message(chat_id, text=f"🎉 <b>Награда нашла героя!</b> 🎉\n{prize_applied_msg_cb}", parse_mode='HTML')
             # Помечаем, что приз выдан и какой именно
-            await loop.run_in_executor(None, lambda: tos_battles_collection.update_one(
+            await tos_battles_collection.update_one(
                 {"_id": battle_doc_id}, 
                 {"$set": {f"prizes_awarded_info.{winner_id_from_prize_cb_val}": {"type_chosen": prize_type_choice_cb, "penis_added": awarded_penis, "tits_added": awarded_tits}}}
-            ))
+            )
         else:
             await query.answer("Неизвестный тип приза.", show_alert=True)
             
     else: 
         logger.warning(f"Неизвестное действие '{action}' или несоответствующий статус '{battle.get('status')}' в tos_battle_button_callback. CB: {query.data}")
 
+# --->>> ГЕНЕРАЦИЯ ВОПРОСОВ БАТТЛА <<<---
+# battle_doc_id -> список Event'ов "вопрос i уже лежит в БД" (только пока идет догенерация)
+tos_battle_questions_stored: dict[ObjectId, list[asyncio.Event]] = {}
+# battle_doc_id -> фоновые задачи баттла (генерация вопросов + писатель). Отмена/конец баттла их гасит,
+# иначе брошенный баттл продолжает жрать слоты ИИ и писать в мертвый документ.
+tos_battle_tasks: dict[ObjectId, list[asyncio.Task]] = {}
+
+def cancel_battle_tasks(battle_doc_id: ObjectId) -> None:
+    tasks = tos_battle_tasks.pop(battle_doc_id, [])
+    pending = [task for task in tasks if not task.done()]
+    for task in pending: task.cancel()
+    if pending: logger.info(f"Баттл {battle_doc_id}: отменено {len(pending)} фоновых задач генерации вопросов.")
+
+async def _generate_battle_question(i: int, should_be_truth: bool, game_id: int, chat_id: int,
+                                    semaphore: asyncio.Semaphore) -> dict:
+    """Берет один вопрос баттла из пула (или генерит). Никогда не падает - при косяке ИИ подставляет заглушку."""
+    async with semaphore:
+        logger.info(f"Беру вопрос {i+1}/{TOS_BATTLE_NUM_QUESTIONS} для баттла {game_id} (Тип: {'Правда' if should_be_truth else 'Высер'})")
+        try:
+            # Первый вопрос ждут игроки прямо сейчас, остальные - префетч
+            generated_statement_text = await draw_tos_statement(
+                should_be_truth, chat_id, priority=LLM_PRIORITY_COMMAND if i == 0 else LLM_PRIORITY_BACKGROUND
+            )
+        except Exception as e:
+            logger.error(f"Ошибка генерации вопроса {i+1} для баттла {game_id}: {e}")
+            generated_statement_text = None
+
+    if not generated_statement_text:
+        logger.warning(f"Не удалось сгенерировать вопрос {i+1} для баттла {game_id}. Использую заглушку.")
+        generated_statement_text = f"Заглушка-утверждение №{i+1}, потому что ИИ обосрался (это {'правда' if should_be_truth else 'высер'})"
+
+    return {
+        "statement": "🗿 Попиздяка утверждает: " + generated_statement_text.strip(),
+        "is_truth": should_be_truth,
+        "revealed_to_users": False, # Пока не раскрыт
+        "user_answers_to_this_q": {} # {user_id: {"name": "...", "answer_bool": True/False, "answered_at": datetime}}
+    }
+
+def _start_battle_question_writer(battle_doc_id: ObjectId, game_id: int, question_tasks: list) -> None:
+    """Фоном дописывает вопросы 1..N в БД строго по порядку (первый уже сохранен)."""
+    stored_events = [asyncio.Event() for _ in question_tasks]
+    stored_events[0].set()
+    tos_battle_questions_stored[battle_doc_id] = stored_events
+
+    async def writer() -> None:
+        try:
+            for i, task in enumerate(question_tasks[1:], start=1):
+                question = await task
+                await tos_battles_collection.update_one({"_id": battle_doc_id}, {"$push": {"questions": question}})
+                stored_events[i].set()
+            logger.info(f"Все {len(question_tasks)} вопросов баттла {game_id} сохранены.")
+        except Exception as e:
+            logger.error(f"Не удалось дописать вопросы баттла {game_id}: {e}", exc_info=True)
+        finally:
+            for task in question_tasks: task.cancel() # Если вылетели с ошибкой - недогенеренное уже не нужно
+            for event in stored_events: event.set() # Никого не оставляем висеть - дальше разберется проверка индекса
+            tos_battle_questions_stored.pop(battle_doc_id, None)
+            tos_battle_tasks.pop(battle_doc_id, None)
+
+    tos_battle_tasks.setdefault(battle_doc_id, []).append(asyncio.create_task(writer(), name=f"TosBattleQuestionWriter-{game_id}"))
+
+async def _wait_for_battle_question(battle_doc_id: ObjectId, question_index: int) -> None:
+    """Ждет, пока вопрос с этим индексом доедет до БД (если он еще догенерируется)."""
+    stored_events = tos_battle_questions_stored.get(battle_doc_id)
+    if not stored_events or question_index >= len(stored_events) or stored_events[question_index].is_set():
+        return
+    logger.info(f"Вопрос {question_index + 1} баттла {battle_doc_id} еще генерится, ждем...")
+    try:
+        await asyncio.wait_for(stored_events[question_index].wait(), TOS_BATTLE_QUESTION_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.error(f"Вопрос {question_index + 1} баттла {battle_doc_id} так и не сгенерился за {TOS_BATTLE_QUESTION_WAIT_SECONDS}с.")
+# --->>> КОНЕЦ ГЕНЕРАЦИИ ВОПРОСОВ <<<---
+
 async def _actually_start_the_battle_game(context: ContextTypes.DEFAULT_TYPE, battle_doc_id: ObjectId) -> None:
-    loop = asyncio.get_running_loop()
-    battle = await loop.run_in_executor(None, lambda: tos_battles_collection.find_one({"_id": battle_doc_id}))
+    battle = await tos_battles_collection.find_one({"_id": battle_doc_id})
     
     if not battle:
         logger.error(f"_actually_start_the_battle_game: Баттл с _id {battle_doc_id} не найден!")
@@ -4106,8 +6011,7 @@ async def _actually_start_the_battle_game(context: ContextTypes.DEFAULT_TYPE, ba
         reply_to_message_id=game_id
     )
 
-    # --->>> 3. ГЕНЕРАЦИЯ {TOS_BATTLE_NUM_QUESTIONS} ВОПРОСОВ <<<---
-    generated_questions_list = []
+    # --->>> 3. ГЕНЕРАЦИЯ {TOS_BATTLE_NUM_QUESTIONS} ВОПРОСОВ (ПАРАЛЛЕЛЬНО) <<<---
     # Определяем, сколько должно быть правдивых и сколько высеров
     # Можно сделать 50/50 или немного случайно. Для простоты пока 50/50.
     num_truth = TOS_BATTLE_NUM_QUESTIONS // 2
@@ -4115,63 +6019,42 @@ async def _actually_start_the_battle_game(context: ContextTypes.DEFAULT_TYPE, ba
     question_types_to_generate = ([True] * num_truth) + ([False] * num_shit)
     random.shuffle(question_types_to_generate) # Перемешиваем типы вопросов
 
-    for i, should_be_truth in enumerate(question_types_to_generate):
-        logger.info(f"Генерирую вопрос {i+1}/{TOS_BATTLE_NUM_QUESTIONS} для баттла {game_id} (Тип: {'Правда' if should_be_truth else 'Высер'})")
-        if should_be_truth:
-            statement_prompt = (
-                "Ты - Попиздяка, кладезь странных, но реальных фактов. Придумай ОДИН МАЛОИЗВЕСТНЫЙ, но РЕАЛЬНЫЙ и ПРОВЕРЯЕМЫЙ факт. "
-                "Он должен быть сформулирован как утверждение, коротко (1-2 предложения) и без указания, что это правда. "
-                "Не используй фразы типа 'Попиздяка утверждает'. Просто сам факт."
-                "\nПример: Медуза Turritopsis Dohrnii потенциально бессмертна."
-                "\nВАЖНО: Не повторяй факты, которые ты уже мог генерировать." # Попытка уменьшить повторы
-            )
-        else: # Должен быть высер
-            statement_prompt = (
-                "Ты - Попиздяка, генератор абсурдного бреда. Придумай ОДИН АБСОЛЮТНО ЛЖИВЫЙ, но НАУКООБРАЗНЫЙ и ПРАВДОПОДОБНО ЗВУЧАЩИЙ высер. "
-                "Он должен быть сформулирован как утверждение, коротко (1-2 предложения) и без указания, что это ложь. "
-                "Не используй фразы типа 'Попиздяка утверждает'. Просто сам высер."
-                "\nПример: Если чихнуть с открытыми глазами, они вылетят из орбит со скоростью пробки от шампанского."
-                "\nВАЖНО: Не повторяй высеры, которые ты уже мог генерировать."
-            )
-        
-        # Небольшая задержка между запросами к API, чтобы не перегружать
-        if i > 0: await asyncio.sleep(random.uniform(1.0, 2.5)) 
-
-        generated_statement_text = await _call_ionet_api(
-            messages=[{"role": "user", "content": statement_prompt}],
-            model_id=IONET_TEXT_MODEL_ID, max_tokens=100, temperature=0.9 # Повысим температуру для разнообразия
-        )
-
-        if not generated_statement_text or generated_statement_text.startswith("[") or len(generated_statement_text.strip()) < 10:
-            logger.warning(f"Не удалось сгенерировать вопрос {i+1} для баттла {game_id}. Использую заглушку.")
-            generated_statement_text = f"Заглушка-утверждение №{i+1}, потому что ИИ обосрался (это {'правда' if should_be_truth else 'высер'})"
-        
-        final_statement_for_question = "🗿 Попиздяка утверждает: " + generated_statement_text.strip()
-        generated_questions_list.append({
-            "statement": final_statement_for_question, 
-            "is_truth": should_be_truth,
-            "revealed_to_users": False, # Пока не раскрыт
-            "user_answers_to_this_q": {} # {user_id: {"name": "...", "answer_bool": True/False, "answered_at": datetime}}
-        })
-    
-    logger.info(f"Сгенерировано {len(generated_questions_list)} вопросов для баттла {game_id}.")
+    # Все вопросы генерятся сразу (не больше TOS_BATTLE_QUESTION_GEN_CONCURRENCY одновременно),
+    # игра стартует, как только готов первый, остальные докидываются в БД по порядку в фоне.
+    gen_semaphore = asyncio.Semaphore(TOS_BATTLE_QUESTION_GEN_CONCURRENCY)
+    question_tasks = [
+        asyncio.create_task(_generate_battle_question(i, should_be_truth, game_id, chat_id, gen_semaphore),
+                            name=f"TosBattleQuestion-{game_id}-{i}")
+        for i, should_be_truth in enumerate(question_types_to_generate)
+    ]
+    tos_battle_tasks[battle_doc_id] = list(question_tasks)
+    try:
+        first_question = await question_tasks[0]
+    except asyncio.CancelledError:
+        if not question_tasks[0].cancelled(): raise # Отменили нас самих, а не генерацию
+        logger.info(f"Баттл {game_id} отменили, пока генерился первый вопрос.")
+        return
+    logger.info(f"Первый вопрос баттла {game_id} готов, остальные {len(question_tasks) - 1} догенерируются в фоне.")
     if generating_msg:
         try: await context.bot.delete_message(chat_id=chat_id, message_id=generating_msg.message_id)
         except Exception: pass
 
-    # 4. Обновить статус игры на "playing" и сохранить вопросы в БД
+    # 4. Обновить статус игры на "playing" и сохранить первый вопрос в БД
     update_fields = {
         "status": "playing",
         "current_question_index": 0, # Начинаем с 0-го вопроса
-        "questions": generated_questions_list,
+        "questions": [first_question],
         "started_at": datetime.datetime.now(datetime.timezone.utc) # Время фактического начала игры
     }
-    await loop.run_in_executor(
-        None, lambda: tos_battles_collection.update_one(
-            {"_id": battle_doc_id}, {"$set": update_fields}
+    start_result = await tos_battles_collection.update_one(
+            {"_id": battle_doc_id, "status": "recruiting"}, {"$set": update_fields} # Хост мог отменить, пока генерили
         )
-    )
-    
+    if not start_result.modified_count:
+        logger.warning(f"Баттл {game_id} уже не в наборе (отменен?), не стартуем.")
+        cancel_battle_tasks(battle_doc_id)
+        return
+    _start_battle_question_writer(battle_doc_id, game_id, question_tasks)
+
     # 5. Отправить сообщение о начале игры
     participants_data_for_mention = battle.get("participants", {})
     participant_mentions = []
@@ -4211,7 +6094,7 @@ async def _actually_start_the_battle_game(context: ContextTypes.DEFAULT_TYPE, ba
 
     # 6. Запустить логику первого вопроса
     # Обновим battle данными из БД, чтобы иметь актуальный список вопросов
-    battle_updated = await loop.run_in_executor(None, lambda: tos_battles_collection.find_one({"_id": battle_doc_id}))
+    battle_updated = await tos_battles_collection.find_one({"_id": battle_doc_id})
     if battle_updated:
         await _ask_next_tos_battle_question(context, battle_updated) # Передаем весь документ баттла
     else:
@@ -4228,7 +6111,6 @@ async def auto_end_recruitment_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = job.chat_id
     game_id = job.data['game_id'] # Это message_id сообщения о наборе
     # host_id = job.data.get('host_id') # Можно использовать для логов, если нужно
-    loop = asyncio.get_running_loop()
 
     logger.info(f"Сработал Job: автоматическое окончание набора для баттла game_id: {game_id} в чате {chat_id}.")
 
@@ -4237,11 +6119,9 @@ async def auto_end_recruitment_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     # Важно: find_one_and_update вернет документ ДО обновления, если не указать return_document
     # Поэтому сначала найдем, потом проверим время, потом обновим.
     
-    battle_to_process = await loop.run_in_executor(
-        None, lambda: tos_battles_collection.find_one(
+    battle_to_process = await tos_battles_collection.find_one(
             {"chat_id": chat_id, "game_id": game_id, "status": "recruiting"}
         )
-    )
 
     if not battle_to_process:
         logger.info(f"Job (auto_end_recruitment): Баттл {game_id} в чате {chat_id} не найден в статусе 'recruiting'. Возможно, уже начат хостом или отменен.")
@@ -4266,12 +6146,10 @@ async def auto_end_recruitment_job(context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.info(f"Job (auto_end_recruitment): Недостаточно участников ({current_participants_count_job}/{TOS_BATTLE_MIN_PARTICIPANTS}) для старта баттла {game_id}. Отменяем.")
         
         # Атомарно меняем статус на "cancelled_not_enough_players"
-        update_cancel_job_result = await loop.run_in_executor(
-            None, lambda: tos_battles_collection.update_one(
+        update_cancel_job_result = await tos_battles_collection.update_one(
                 {"_id": battle_doc_id_job, "status": "recruiting"}, # Доп. проверка, что статус не изменился
                 {"$set": {"status": "cancelled_not_enough_players", "finished_at": now_utc_job_end}}
             )
-        )
 
         if update_cancel_job_result.modified_count == 0:
             logger.warning(f"Job (auto_end_recruitment): Не удалось обновить статус на 'cancelled_not_enough_players' для баттла {game_id}. Возможно, статус изменился.")
@@ -4297,13 +6175,11 @@ async def auto_end_recruitment_job(context: ContextTypes.DEFAULT_TYPE) -> None:
              logger.error(f"Job (auto_end_recruitment): Ошибка при уведомлении об отмене баттла {game_id}: {e_cancel_job}")
         
         # Обновляем кулдаун, так как игра считается "завершенной" отменой
-        await loop.run_in_executor(
-            None, lambda: chat_activity_collection.update_one(
+        await chat_activity_collection.update_one(
                 {"chat_id": chat_id},
                 {"$set": {"last_tos_battle_end_time": now_utc_job_end}},
                 upsert=True
             )
-        )
         return # Завершаем работу job'а
 
     # Если участников достаточно, начинаем игру
@@ -4313,7 +6189,6 @@ async def auto_end_recruitment_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def _ask_next_tos_battle_question(context: ContextTypes.DEFAULT_TYPE, battle_data: dict) -> None:
     """Отправляет следующий вопрос баттла и запускает таймер на ответ."""
-    loop = asyncio.get_running_loop()
     chat_id = battle_data["chat_id"]
     game_id = battle_data["game_id"] # Это message_id_recruitment
     battle_doc_id = battle_data["_id"]
@@ -4353,12 +6228,10 @@ async def _ask_next_tos_battle_question(context: ContextTypes.DEFAULT_TYPE, batt
             reply_markup=reply_markup_question_initial # <<<--- ИСПОЛЬЗУЕМ КНОПКИ БЕЗ СЧЕТЧИКОВ
         )
         # Сохраняем ID сообщения с текущим вопросом в БД
-        await loop.run_in_executor(
-            None, lambda: tos_battles_collection.update_one(
+        await tos_battles_collection.update_one(
                 {"_id": battle_doc_id},
                 {"$set": {"message_id_current_question": sent_question_msg.message_id}}
             )
-        )
 
         # Планируем автоматическое раскрытие ответа на этот вопрос
         job_name_q_reveal = f"tosbattle_q_reveal_{chat_id}_{game_id}_{current_question_index}"
@@ -4403,9 +6276,8 @@ async def auto_reveal_battle_question_job(context: ContextTypes.DEFAULT_TYPE) ->
     await _process_battle_question_reveal(context, battle_doc_id, question_index_from_job, auto_triggered=True)
 
 async def _process_battle_question_reveal(context: ContextTypes.DEFAULT_TYPE, battle_doc_id: ObjectId, question_index: int, auto_triggered: bool = False):
-    loop = asyncio.get_running_loop()
     # Получаем САМУЮ АКТУАЛЬНУЮ версию баттла из БД
-    battle = await loop.run_in_executor(None, lambda: tos_battles_collection.find_one({"_id": battle_doc_id}))
+    battle = await tos_battles_collection.find_one({"_id": battle_doc_id})
 
     if not battle or battle.get("status") != "playing":
         logger.info(f"_process_battle_question_reveal: Баттл {battle_doc_id} не найден или не в статусе 'playing'. Текущий статус: {battle.get('status')}")
@@ -4440,12 +6312,10 @@ async def _process_battle_question_reveal(context: ContextTypes.DEFAULT_TYPE, ba
     user_answers_for_this_q = statement_data.get("user_answers_to_this_q", {})
 
     # 1. Пометить вопрос как раскрытый в БД
-    await loop.run_in_executor(
-        None, lambda: tos_battles_collection.update_one(
+    await tos_battles_collection.update_one(
             {"_id": battle_doc_id},
             {"$set": {f"questions.{question_index}.revealed_to_users": True}}
         )
-    )
     
     # 2. Убрать кнопки у сообщения с вопросом (если оно было)
     message_id_of_this_question = battle.get("message_id_current_question")
@@ -4489,12 +6359,10 @@ async def _process_battle_question_reveal(context: ContextTypes.DEFAULT_TYPE, ba
 
     # Обновляем данные участников (счета и массив ответов) в БД
     if updated_participants_data: # Если есть участники
-        await loop.run_in_executor(
-            None, lambda: tos_battles_collection.update_one(
+        await tos_battles_collection.update_one(
                 {"_id": battle_doc_id},
                 {"$set": {"participants": updated_participants_data}}
             )
-        )
     
     # 4. Объявить правильный ответ и комментарий Попиздяки
     result_text_q_human = "✅ ЭТО БЫЛА ПРАВДА!" if correct_answer_is_truth else "❌ КОНЕЧНО ЖЕ, ЭТО ВЫСЕР ЕБАНЫЙ!"
@@ -4545,7 +6413,7 @@ async def _process_battle_question_reveal(context: ContextTypes.DEFAULT_TYPE, ba
     )
     ai_round_comment = await _call_ionet_api(
         messages=[{"role": "user", "content": round_comment_prompt}],
-        model_id=IONET_TEXT_MODEL_ID, max_tokens=180, temperature=0.8
+        model_id=route_model("tos_comment"), max_tokens=180, temperature=0.8, chat_id=chat_id
     ) or "🗿 Ну что, кто-то угадал, кто-то обосрался. Обычное дело в этом цирке."
     if not ai_round_comment.startswith("🗿"): ai_round_comment = "🗿 " + ai_round_comment
 
@@ -4561,14 +6429,13 @@ async def _process_battle_question_reveal(context: ContextTypes.DEFAULT_TYPE, ba
     # 5. Перейти к следующему вопросу или завершить игру
     next_question_index = question_index + 1
     if next_question_index < TOS_BATTLE_NUM_QUESTIONS:
-        await loop.run_in_executor(
-            None, lambda: tos_battles_collection.update_one(
+        await tos_battles_collection.update_one(
                 {"_id": battle_doc_id},
                 {"$set": {"current_question_index": next_question_index}}
             )
-        )
+        await _wait_for_battle_question(battle_doc_id, next_question_index) # Вопрос мог еще не догенериться
         # Получаем обновленные данные баттла (с обновленными очками и новым current_question_index)
-        battle_for_next_q = await loop.run_in_executor(None, lambda: tos_battles_collection.find_one({"_id": battle_doc_id}))
+        battle_for_next_q = await tos_battles_collection.find_one({"_id": battle_doc_id})
         if battle_for_next_q:
             await _ask_next_tos_battle_question(context, battle_for_next_q)
         else:
@@ -4583,7 +6450,6 @@ async def _process_battle_question_reveal(context: ContextTypes.DEFAULT_TYPE, ba
 
 async def _end_tos_battle(context: ContextTypes.DEFAULT_TYPE, battle_data: dict, 
                           error_occurred: bool = False, error_message: str = "") -> None:
-    loop = asyncio.get_running_loop()
     chat_id = battle_data["chat_id"]
     game_id = battle_data["game_id"] # message_id_recruitment
     battle_doc_id = battle_data["_id"]
@@ -4601,23 +6467,20 @@ async def _end_tos_battle(context: ContextTypes.DEFAULT_TYPE, battle_data: dict,
     except Exception: pass # Игнорируем другие ошибки открепления здесь
 
     logger.info(f"Завершение баттла {game_id} в чате {chat_id}. Ошибка во время игры: {error_occurred} ('{error_message}')")
+    cancel_battle_tasks(battle_doc_id) # Недогенеренные вопросы уже никому не нужны
 
     now_for_final_finish_end = datetime.datetime.now(datetime.timezone.utc)
-    await loop.run_in_executor(
-        None, lambda: tos_battles_collection.update_one(
+    await tos_battles_collection.update_one(
             {"_id": battle_doc_id},
             {"$set": {"status": "finished", "finished_at": now_for_final_finish_end, "prizes_awarded_info": {}}}, # Добавим поле для информации о выданных призах
             upsert=False 
         )
-    )
     
-    await loop.run_in_executor(
-        None, lambda: chat_activity_collection.update_one(
+    await chat_activity_collection.update_one(
             {"chat_id": chat_id},
             {"$set": {"last_tos_battle_end_time": now_for_final_finish_end}},
             upsert=True
         )
-    )
     logger.info(f"Баттл {game_id} завершен (статус обновлен). Кулдаун для чата обновлен.")
 
     if error_occurred:
@@ -4707,9 +6570,9 @@ async def _end_tos_battle(context: ContextTypes.DEFAULT_TYPE, battle_data: dict,
     )
     ai_final_comment = await _call_ionet_api(
         messages=[{"role": "user", "content": final_comment_prompt}],
-        model_id=IONET_TEXT_MODEL_ID, 
+        model_id=route_model("tos_comment"),
         max_tokens=80, # <<<--- УМЕНЬШЕНО (150-250 символов это примерно 40-70 токенов)
-        temperature=0.85
+        temperature=0.85, chat_id=chat_id
     ) or "🗿 Игра окончена. Кто выиграл - молодец. Кто проиграл - соси хуй. Все просто."
     if not ai_final_comment.startswith("🗿"): ai_final_comment = "🗿 " + ai_final_comment
 
@@ -4749,7 +6612,6 @@ async def _end_tos_battle(context: ContextTypes.DEFAULT_TYPE, battle_data: dict,
     for part_msg_final_send_val in message_parts_final_to_send:
         if part_msg_final_send_val.strip():
             await context.bot.send_message(chat_id, text=part_msg_final_send_val, parse_mode='HTML', reply_to_message_id=game_id)
-            await asyncio.sleep(0.3)
 
     # --- НОВАЯ ЛОГИКА НАЧИСЛЕНИЯ ПРИЗА ---
     prizes_awarded_info_dict = {} # Для записи в БД информации о выданных призах
@@ -4767,24 +6629,24 @@ async def _end_tos_battle(context: ContextTypes.DEFAULT_TYPE, battle_data: dict,
             winner_display_name_s = user_profile_s.get("display_name", winner_name_s)
 
             # Начисляем +5см к писюну
-            penis_stat_s = await loop.run_in_executor(None, lambda: penis_stats_collection.find_one({"user_id": winner_id_s, "chat_id": chat_id}))
+            penis_stat_s = await penis_stats_collection.find_one({"user_id": winner_id_s, "chat_id": chat_id})
             current_penis_s = penis_stat_s.get("penis_size", 0) if penis_stat_s else 0
             new_penis_s = current_penis_s + 5 # TOS_BATTLE_PENIS_REWARD_SINGLE = 5
-            await loop.run_in_executor(None, lambda: penis_stats_collection.update_one(
+            await penis_stats_collection.update_one(
                 {"user_id": winner_id_s, "chat_id": chat_id},
                 {"$set": {"penis_size": new_penis_s, "user_display_name": winner_display_name_s}}, upsert=True
-            ))
+            )
             prize_notifications.append(f"🍆 Писюн единственного чемпиона <b>{winner_display_name_s}</b> вырос на <b>5см</b> и теперь равен <b>{new_penis_s}см</b>!")
             # TODO: Проверка на новое писечное звание
             
             # Начисляем +0.3 к сиськам
-            tits_stat_s = await loop.run_in_executor(None, lambda: tits_stats_collection.find_one({"user_id": winner_id_s, "chat_id": chat_id}))
+            tits_stat_s = await tits_stats_collection.find_one({"user_id": winner_id_s, "chat_id": chat_id})
             current_tits_s = float(tits_stat_s.get("tits_size", 0.0)) if tits_stat_s else 0.0
             new_tits_s = round(current_tits_s + 0.3, 1) # TOS_BATTLE_TITS_REWARD_SINGLE = 0.3
-            await loop.run_in_executor(None, lambda: tits_stats_collection.update_one(
+            await tits_stats_collection.update_one(
                 {"user_id": winner_id_s, "chat_id": chat_id},
                 {"$set": {"tits_size": new_tits_s, "user_display_name": winner_display_name_s}}, upsert=True
-            ))
+            )
             prize_notifications.append(f"🍈 Сиськи <b>{winner_display_name_s}</b> подросли на <b>0.3</b> и стали <b>{new_tits_s:.1f}-го</b> размера!")
             # TODO: Проверка на новое сисечное звание
 
@@ -4807,35 +6669,33 @@ async def _end_tos_battle(context: ContextTypes.DEFAULT_TYPE, battle_data: dict,
                 winner_display_name_m_prize = user_profile_m_prize.get("display_name", winner_name_m_prize)
 
                 # Начисляем писюн
-                penis_stat_m_prize = await loop.run_in_executor(None, lambda: penis_stats_collection.find_one({"user_id": winner_id_m_prize, "chat_id": chat_id}))
+                penis_stat_m_prize = await penis_stats_collection.find_one({"user_id": winner_id_m_prize, "chat_id": chat_id})
                 current_penis_m_prize = penis_stat_m_prize.get("penis_size", 0) if penis_stat_m_prize else 0
                 new_penis_m_prize = current_penis_m_prize + penis_reward_multi
-                await loop.run_in_executor(None, lambda: penis_stats_collection.update_one(
+                await penis_stats_collection.update_one(
                     {"user_id": winner_id_m_prize, "chat_id": chat_id},
                     {"$set": {"penis_size": new_penis_m_prize, "user_display_name": winner_display_name_m_prize}}, upsert=True
-                ))
+                )
                 prize_notifications.append(f"🍆 Писюн <b>{winner_display_name_m_prize}</b> вырос до <b>{new_penis_m_prize}см</b>.")
                 
                 # Начисляем сиськи
-                tits_stat_m_prize = await loop.run_in_executor(None, lambda: tits_stats_collection.find_one({"user_id": winner_id_m_prize, "chat_id": chat_id}))
+                tits_stat_m_prize = await tits_stats_collection.find_one({"user_id": winner_id_m_prize, "chat_id": chat_id})
                 current_tits_m_prize = float(tits_stat_m_prize.get("tits_size", 0.0)) if tits_stat_m_prize else 0.0
                 new_tits_m_prize = round(current_tits_m_prize + tits_reward_multi, 1)
-                await loop.run_in_executor(None, lambda: tits_stats_collection.update_one(
+                await tits_stats_collection.update_one(
                     {"user_id": winner_id_m_prize, "chat_id": chat_id},
                     {"$set": {"tits_size": new_tits_m_prize, "user_display_name": winner_display_name_m_prize}}, upsert=True
-                ))
+                )
                 prize_notifications.append(f"🍈 Сиськи <b>{winner_display_name_m_prize}</b> подросли до <b>{new_tits_m_prize:.1f}-го</b>.")
                 
                 prizes_awarded_info_dict[str(winner_id_m_prize)] = {"penis_added": penis_reward_multi, "tits_added": tits_reward_multi}
             
         await context.bot.send_message(chat_id, text="\n".join(prize_notifications), parse_mode='HTML')
         # Сохраняем информацию о выданных призах в документе баттла
-        await loop.run_in_executor(
-            None, lambda: tos_battles_collection.update_one(
+        await tos_battles_collection.update_one(
                 {"_id": battle_doc_id}, 
                 {"$set": {"prizes_awarded_info": prizes_awarded_info_dict}}
             )
-        )
 
     else: # Нет победителей с положительным счетом
         await context.bot.send_message(chat_id, "🗿 По итогам этой битвы умов, победителей с положительным счетом не нашлось. Какие же вы все-таки долбоебы. Приз остается у Попиздяки!", parse_mode='HTML')
@@ -4847,25 +6707,20 @@ async def _end_tos_battle(context: ContextTypes.DEFAULT_TYPE, battle_data: dict,
     # Сейчас я сделал так, что ОДИН победитель получает +5см И +0.3 сисек автоматически.
     # Если нужно вернуть выбор, сообщи.
 
+@maintenance_gate("🔧 Техработы, не до эпичных заруб.", delete_command=False)
 async def cancel_tos_battle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.from_user or not update.message.chat:
         return
 
     chat_id = update.message.chat.id
     canceller_user = update.message.from_user
-    loop = asyncio.get_running_loop()
-
-    # --->>> ПРОВЕРКА ТЕХРАБОТ (стандартная) <<<---
-    # ...
 
     # Ищем игру в статусе набора, где текущий пользователь является хостом
-    battle_to_cancel = await loop.run_in_executor(
-        None, lambda: tos_battles_collection.find_one_and_update(
+    battle_to_cancel = await tos_battles_collection.find_one_and_update(
             {"chat_id": chat_id, "host_id": canceller_user.id, "status": "recruiting"},
             {"$set": {"status": "cancelled_by_host", "finished_at": datetime.datetime.now(datetime.timezone.utc)}}
             # Сразу меняем статус, чтобы другие действия не могли с ней работать
         )
-    )
 
     if not battle_to_cancel: # Либо нет такой игры, либо он не хост, либо уже не в наборе
         await update.message.reply_text("🗿 Либо ты не хост активной игры в этом чате, либо игра уже началась/закончилась, либо отменять уже нечего.")
@@ -4873,6 +6728,7 @@ async def cancel_tos_battle_command(update: Update, context: ContextTypes.DEFAUL
 
     game_id_to_cancel = battle_to_cancel["game_id"]
     logger.info(f"Хост {canceller_user.id} отменяет баттл {game_id_to_cancel} в чате {chat_id}.")
+    cancel_battle_tasks(battle_to_cancel["_id"]) # Если старт уже начал генерить вопросы
 
     # Открепляем сообщение о наборе
     try:
@@ -4898,13 +6754,11 @@ async def cancel_tos_battle_command(update: Update, context: ContextTypes.DEFAUL
     )
     
     # Обновляем кулдаун, так как игра считается "завершенной" отменой
-    await loop.run_in_executor(
-        None, lambda: chat_activity_collection.update_one(
+    await chat_activity_collection.update_one(
             {"chat_id": chat_id},
             {"$set": {"last_tos_battle_end_time": datetime.datetime.now(datetime.timezone.utc)}},
             upsert=True
         )
-    )
 
 def split_long_message_primitive(text: str, max_len: int) -> list[str]:
     """Примитивно разбивает длинный текст на части по max_len, стараясь резать по строкам или пробелам."""
@@ -4936,24 +6790,152 @@ def split_long_message_primitive(text: str, max_len: int) -> list[str]:
         current_pos = cut_at
     return [p for p in parts if p.strip()]
 
+# --->>> РОУТЕР РУССКИХ ФРАЗ <<<---
+# Раньше каждая фраза была отдельным MessageHandler(filters.Regex(".*\\b(бот|попиздяка)\\b.*...")), и каждое сообщение
+# в группе гонялось по ~20 регуляркам с ведущим .* подряд. Теперь: дешевая проверка подстроки с именем бота (отсекает
+# почти всю болтовню), потом заранее скомпилированные регулярки интентов по порядку до первого совпадения.
+# Порядок в списке = приоритет (как был порядок хендлеров). Одна общая альтернатива тут не годится: она выбирает
+# совпадение, которое раньше НАЧИНАЕТСЯ в тексте ("бот" внутри "субботу" у техработ), а не первый интент по списку.
+# Интенты "только в ответе" без реплая пропускаются, и фраза проваливается к следующим, как раньше.
+TRIGGER_NAME_PREFILTER = ("бот", "попизд") # Хоть одна подстрока должна быть в тексте (в нижнем регистре)
+TRIGGER_INTENTS = [ # (интент, регулярка без ведущего .*, только в ответе, хендлер)
+    ("analyze", r"\b(?:попиздяка|бот)\b.*(?:анализ|анализируй|проанализируй|комментируй|обосри|скажи|мнение)", False, analyze_chat),
+    ("analyze_pic", r"\b(?:попиздяка|бот)\b.*(?:зацени|опиши|обосри|скажи про).*(?:пикч|картинк|фот|изображен|это)", True, analyze_pic),
+    ("poem", r"\b(?:бот|попиздяка)\b.*(?:стих|стишок|поэма)\s+(?:про|для|об)\s+[А-Яа-яЁё\s\-]+", False, generate_poem),
+    ("prediction", r"\b(?:бот|попиздяка)\b.*(?:предскажи|что ждет|прогноз|предсказание|напророчь)", False, get_prediction),
+    ("roast", r"\b(?:бот|попиздяка)\b.*(?:прожарь|зажарь|обосри|унизь)\s+(?:его|ее|этого|эту)", True, roast_user),
+    ("retry", r"\b(?:попиздяка|бот)\b.*(?:переделай|повтори|перепиши|хуйня|другой вариант)", True, retry_analysis),
+    ("help", r"\b(?:попиздяка|попиздоний|бот)\b.*(?:ты кто|кто ты|что умеешь|хелп|помощь|справка|команды)", False, help_command),
+    ("set_name", r"\b(?:бот|попиздяка)\b.*(?:меня зовут|мой ник|никнейм)\s+[А-Яа-яЁё\w\s\-]+", False, set_nickname),
+    ("whoami", r"\b(?:бот|попиздяка)\b.*(?:кто я|мой ник|мой статус|мое звание|whoami)", False, who_am_i),
+    ("grow_penis", r"\b(?:бот|попиздяка)\b.*(?:писька|хуй|член|пенис|елда|стручок|агрегат|змея)", False, grow_penis),
+    ("my_penis", r"\b(?:бот|попиздяка)\b.*(?:моя писька|мой хуй|мой член|мой пенис|какой у меня|что с моей пиписькой)", False, show_my_penis),
+    ("top_penis", r"\b(?:бот|попиздяка)\b.*(?:топ писек|топ хуев|рейтинг членов|у кого самый большой)", False, show_penis_top),
+    ("grow_tits", r"\b(?:бот|попиздяка)\b.*(?:сиськи|грудь|дыньки|буфера)", False, grow_tits),
+    ("my_tits", r"\b(?:бот|попиздяка)\b.*(?:мои сиськи|моя грудь|какие у меня сиськи)", False, show_my_tits),
+    ("top_tits", r"\b(?:бот|попиздяка)\b.*(?:топ сисек|рейтинг грудей|у кого самые большие сиськи)", False, show_tits_top),
+    ("pickup", r"\b(?:бот|попиздяка)\b.*(?:подкат|пикап|склей|познакомься|замути)", True, get_pickup_line),
+    ("praise", r"\b(?:бот|попиздяка)\b.*(?:похвали|молодец|красавчик)\s+(?:его|ее|этого|эту)", True, praise_user),
+    ("gen_nick", r"\b(?:бот|попиздяка)\b\s+(?:рандомный ник|случайный ник|любой ник|смени мне ник|давай ник|придумай ник|какой нибудь ник|какой-нибудь ник|новое имя|новое погоняло|сгенерируй ник|ник по высерам)", False, generate_and_set_nickname),
+    ("list_chats", r"\b(?:бот|попиздяка)\b\s+(?:список чатов|где ты есть|в каких чатах)", False, list_bot_chats),
+    ("tos_battle", r"\b(?:бот|попиздяка)\b\s+(?:пв баттл|правда или высер баттл|заруба в пв|tos battle)", False, start_tos_battle),
+    # Техработы (проверка админа и ЛС внутри функций); имя тут без \b, как было
+    ("maintenance_on", r"(?:бот|попиздяка).*(?:техработ|ремонт|на ремонт|обслуживание|админ вкл)", False, maintenance_on),
+    ("maintenance_off", r"(?:бот|попиздяка).*(?:работай|работать|кончил|закончил|ремонт окончен|админ выкл)", False, maintenance_off),
+]
+TRIGGER_PATTERNS = [(name, re.compile(pattern, re.IGNORECASE), reply_only) for name, pattern, reply_only, _ in TRIGGER_INTENTS]
+TRIGGER_HANDLERS = {name: _timed_handler(handler) for name, _, _, handler in TRIGGER_INTENTS} # Метрики остаются по настоящим хендлерам
+trigger_router_stats = {"checked": 0, "prefiltered": 0, "matched": 0}
+
+def route_trigger_text(text: str | None, is_reply: bool) -> str | None:
+    """Интент русской фразы или None (первый по TRIGGER_INTENTS). Без имени бота в тексте регулярки вообще не трогаем."""
+    trigger_router_stats["checked"] += 1
+    if not text: return None
+    lowered = text.lower()
+    if not any(name in lowered for name in TRIGGER_NAME_PREFILTER):
+        trigger_router_stats["prefiltered"] += 1
+        return None
+    for name, pattern, reply_only in TRIGGER_PATTERNS:
+        if (is_reply or not reply_only) and pattern.search(text):
+            trigger_router_stats["matched"] += 1
+            return name
+    return None
+
+class TriggerRouterFilter(filters.MessageFilter):
+    """Фильтр PTB над route_trigger_text: пропускает только фразы-команды, интент кладет в context.trigger_intent."""
+    def __init__(self):
+        super().__init__(name="TriggerRouterFilter", data_filter=True)
+
+    def filter(self, message: Message):
+        intent = route_trigger_text(message.text, message.reply_to_message is not None)
+        return {"trigger_intent": [intent]} if intent else False
+
+async def dispatch_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Вызывает хендлер интента, который выбрал TriggerRouterFilter."""
+    await TRIGGER_HANDLERS[context.trigger_intent[0]](update, context)
+
+TRIGGER_BENCH_SAMPLE_MESSAGES = [
+    "ну и где вы все", "я вчера такую хуйню видел, пиздец", "кто сегодня идет?", "ахахах", "скинь ссылку плиз",
+    "бот, ты опять тупишь", "мы с ботом не разговариваем", "работать сегодня не пойду",
+    "попиздяка анализируй чат", "бот стих про Васю", "бот моя писька", "бот топ сисек", "попиздяка кто ты",
+    "бот пв баттл", "бот придумай ник", "попиздяка предскажи мне что-нибудь",
+]
+TRIGGER_BENCH_DEFAULT_MESSAGES = 20000
+
+def _bench_trigger_routing(total_messages: int) -> tuple[float, float]:
+    """Микро-бенчмарк: мкс на сообщение у старой цепочки регулярок и у роутера (синтетическая смесь болтовни и команд)."""
+    legacy_patterns = [(name, re.compile(r"(?i).*" + pattern + r".*"), reply_only) for name, pattern, reply_only, _ in TRIGGER_INTENTS]
+    samples = [(text, i % 3 == 0) for i, text in enumerate(TRIGGER_BENCH_SAMPLE_MESSAGES)]
+    messages = [samples[i % len(samples)] for i in range(total_messages)]
+
+    started = time.perf_counter()
+    for text, is_reply in messages: # Как PTB: хендлеры по порядку, до первого совпадения
+        next((name for name, pattern, reply_only in legacy_patterns if (is_reply or not reply_only) and pattern.search(text)), None)
+    legacy_us = (time.perf_counter() - started) / total_messages * 1_000_000
+
+    saved_stats = dict(trigger_router_stats)
+    started = time.perf_counter()
+    for text, is_reply in messages:
+        route_trigger_text(text, is_reply)
+    router_us = (time.perf_counter() - started) / total_messages * 1_000_000
+    trigger_router_stats.update(saved_stats) # Бенчмарк не портит боевые счетчики
+    return legacy_us, router_us
+
+async def trigger_router_benchmark(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сравнивает стоимость маршрутизации сообщения: цепочка регулярок vs роутер (только админ в ЛС)."""
+    if not update.message or not update.message.from_user: return
+    if not (update.message.from_user.id == ADMIN_USER_ID and update.message.chat.type == 'private'):
+        await update.message.reply_text("Эта команда доступна только админу в личной переписке.")
+        return
+    try: total_messages = max(1000, min(int(context.args[0]), 200000)) if context.args else TRIGGER_BENCH_DEFAULT_MESSAGES
+    except ValueError: total_messages = TRIGGER_BENCH_DEFAULT_MESSAGES
+    legacy_us, router_us = _bench_trigger_routing(total_messages) # Чистый CPU на доли секунды - луп переживет
+    logger.info(f"/routebench: цепочка {legacy_us:.1f} мкс/сообщ., роутер {router_us:.1f} мкс/сообщ. ({total_messages} сообщ.)")
+    await update.message.reply_text(
+        f"<b>📊 Роутер фраз ({total_messages} сообщ.)</b>\n"
+        f"Цепочка регулярок: <b>{legacy_us:.1f}</b> мкс/сообщ. (при 1к сообщ./с - {legacy_us / 10:.2f}% ядра)\n"
+        f"Роутер: <b>{router_us:.1f}</b> мкс/сообщ. (при 1к сообщ./с - {router_us / 10:.2f}% ядра)\n"
+        f"Разница: <b>x{legacy_us / max(router_us, 1e-9):.1f}</b>",
+        parse_mode='HTML'
+    )
+# --->>> КОНЕЦ РОУТЕРА ФРАЗ <<<---
+
 # Дальше идет async def main() или другие функции...
 
 async def main() -> None:
     logger.info("Starting main()...")
     logger.info("Building Application...")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Пул соединений к Bot API задаем явно (HTTP/2, keep-alive), long polling - отдельным пулом с длинным read
+    application = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN)
+        .http_version("2").connection_pool_size(TELEGRAM_HTTP_POOL_SIZE)
+        .connect_timeout(5.0).read_timeout(15.0).write_timeout(30.0).pool_timeout(5.0)
+        .get_updates_http_version("2").get_updates_read_timeout(30.0)
+        .concurrent_updates(update_processor) # Разные чаты - параллельно, внутри чата - по очереди
+        .rate_limiter(outbound_limiter) # Все исходящие - через ведра жетонов и обработку RetryAfter
+        .build()
+    )
 
     # Запуск фоновой задачи
     if application.job_queue:
         # --->>> ДОБАВЛЯЕМ ЗАДАЧУ HEARTBEAT <<<---
-        application.job_queue.run_repeating(update_heartbeat, interval=30, first=10)
-        logger.info("Фоновая задача Heartbeat запущена (каждые 30 сек).")
+        application.job_queue.run_repeating(update_heartbeat, interval=HEARTBEAT_INTERVAL_SECONDS, first=1)
+        logger.info(f"Фоновая задача Heartbeat запущена (каждые {HEARTBEAT_INTERVAL_SECONDS} сек, в БД: {HEARTBEAT_PERSIST_INTERVAL_SECONDS or 'нет'}).")
         # --->>> КОНЕЦ ДОБАВЛЕНИЯ <<<---
 
         # Задача для рандомных высеров в тишине
         application.job_queue.run_repeating(check_inactivity_and_shitpost, interval=900, first=60)
         logger.info("Фоновая задача проверки неактивности запущена.")
 
+        # Чистка простаивающих кольцевых буферов истории
+        application.job_queue.run_repeating(evict_idle_ring_buffers, interval=600, first=600)
+
+        # Сворачивание старой истории чатов в сводки для /analyze
+        application.job_queue.run_repeating(fold_rolling_summaries, interval=ROLLING_SUMMARY_INTERVAL_SECONDS, first=120)
+
+        # Долив пула заготовленных утверждений для "Правда или Высер"
+        application.job_queue.run_repeating(refill_tos_statement_pool, interval=TOS_POOL_REFILL_INTERVAL_SECONDS, first=30)
+
         # # --->>> ЗАПУСК ЗАДАЧИ НОВОСТЕЙ <<<---
         # if GNEWS_API_KEY: # Запускаем, только если есть ключ
         #     application.job_queue.run_repeating(post_news_job, interval=60 * 60 * 6, first=60 * 60 * 6) # Например, каждые 6 часов, первый раз через 2 мин
@@ -4968,6 +6950,12 @@ async def main() -> None:
     application.add_handler(CommandHandler("maintenance_on", maintenance_on))
     application.add_handler(CommandHandler("maintenance_off", maintenance_off))
     application.add_handler(CommandHandler("listchats", list_bot_chats)) # Команда для админа
+    application.add_handler(CommandHandler("indexes", show_indexes)) # Диагностика индексов для админа
+    application.add_handler(CommandHandler("dbbench", db_benchmark)) # Бенчмарк слоя Монги для админа
+    application.add_handler(CommandHandler("llmbench", llm_benchmark)) # Бенчмарк клиента LLM для админа
+    application.add_handler(CommandHandler("profile", profile_loop_command)) # cProfile лупа для админа
+    application.add_handler(CommandHandler("routebench", trigger_router_benchmark)) # Бенчмарк роутера фраз для админа
+    application.add_handler(CommandHandler("botstats", show_bot_stats)) # Счетчики кэшей и очередей для админа
     application.add_handler(CommandHandler("analyze", analyze_chat))
     application.add_handler(CommandHandler("analyze_pic", analyze_pic))
     application.add_handler(CommandHandler("poem", generate_poem))
@@ -4992,137 +6980,76 @@ async def main() -> None:
 
 
     # Добавляем обработчики русских фраз (вызывают ТЕ ЖЕ функции)
-    # Можно добавить больше синонимов
-    analyze_pattern = r'(?i).*\b(попиздяка|бот)\b.*(анализ|анализируй|проанализируй|комментируй|обосри|скажи|мнение).*'
-    application.add_handler(MessageHandler(filters.Regex(analyze_pattern) & filters.TEXT & ~filters.COMMAND, analyze_chat)) # Прямой вызов
-
-    analyze_pic_pattern = r'(?i).*\b(попиздяка|бот)\b.*(зацени|опиши|обосри|скажи про).*(пикч|картинк|фот|изображен|это).*'
-    application.add_handler(MessageHandler(filters.Regex(analyze_pic_pattern) & filters.TEXT & filters.REPLY & ~filters.COMMAND, analyze_pic)) # Прямой вызов
-
-    poem_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:стих|стишок|поэма)\s+(?:про|для|об)\s+([А-Яа-яЁё\s\-]+)' # Оставили группу для имени
-    application.add_handler(MessageHandler(filters.Regex(poem_pattern) & filters.TEXT & ~filters.COMMAND, generate_poem)) # Прямой вызов
-
-    prediction_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:предскажи|что ждет|прогноз|предсказание|напророчь).*'
-    application.add_handler(MessageHandler(filters.Regex(prediction_pattern) & filters.TEXT & ~filters.COMMAND, get_prediction)) # Прямой вызов
-
-
-    roast_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:прожарь|зажарь|обосри|унизь)\s+(?:его|ее|этого|эту).*'
-    application.add_handler(MessageHandler(filters.Regex(roast_pattern) & filters.TEXT & filters.REPLY & ~filters.COMMAND, roast_user)) # Прямой вызов
-
-    retry_pattern = r'(?i).*\b(попиздяка|бот)\b.*(переделай|повтори|перепиши|хуйня|другой вариант).*'
-    application.add_handler(MessageHandler(filters.Regex(retry_pattern) & filters.TEXT & filters.REPLY & ~filters.COMMAND, retry_analysis)) # Прямой вызов
-
-    help_pattern = r'(?i).*\b(попиздяка|попиздоний|бот)\b.*(ты кто|кто ты|что умеешь|хелп|помощь|справка|команды).*'
-    application.add_handler(MessageHandler(filters.Regex(help_pattern) & filters.TEXT & ~filters.COMMAND, help_command)) # Прямой вызов
+    # Все фразы с именем бота - одним роутером (см. TRIGGER_INTENTS), порядок там = приоритет. Синонимы добавлять туда же.
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & TriggerRouterFilter(), dispatch_trigger))
 
     # news_pattern = r'(?i).*\b(попиздяка|попиздоний|бот)\b.*(новости|че там|мир).*'
     # application.add_handler(MessageHandler(filters.Regex(news_pattern) & filters.TEXT & ~filters.COMMAND, force_post_news)) # Прямой вызов
 
-    # --->>> ДОБАВЛЯЕМ РУССКИЕ АНАЛОГИ <<<---
-    set_name_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:меня зовут|мой ник|никнейм)\s+([А-Яа-яЁё\w\s\-]+)'
-    application.add_handler(MessageHandler(filters.Regex(set_name_pattern) & filters.TEXT & ~filters.COMMAND, set_nickname))
-    whoami_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:кто я|мой ник|мой статус|мое звание|whoami).*'
-    application.add_handler(MessageHandler(filters.Regex(whoami_pattern) & filters.TEXT & ~filters.COMMAND, who_am_i))
-    # --->>> КОНЕЦ ДОБАВЛЕНИЯ <<<---
-
-# --->>> ПРОВЕРЬ ЭТИ ДВА REGEX И ИХ ФУНКЦИИ <<<---
-    grow_penis_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:писька|хуй|член|пенис|елда|стручок|агрегат|змея)\s*(?:расти|отрасти|увеличь|подрасти|накачай|больше|плюс)?.*'
-    application.add_handler(MessageHandler(filters.Regex(grow_penis_pattern) & filters.TEXT & ~filters.COMMAND, grow_penis)) # Должен вызывать grow_penis
-
-    my_penis_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:моя писька|мой хуй|мой член|мой пенис|какой у меня|что с моей пиписькой).*'
-    application.add_handler(MessageHandler(filters.Regex(my_penis_pattern) & filters.TEXT & ~filters.COMMAND, show_my_penis)) # Должен вызывать show_my_penis
-
-    top_penis_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:топ писек|топ хуев|рейтинг членов|у кого самый большой).*'
-    application.add_handler(MessageHandler(filters.Regex(top_penis_pattern) & filters.TEXT & ~filters.COMMAND, show_penis_top))
-    # --->>> КОНЕЦ ПРОВЕРКИ <<<---
-
-    grow_tits_pattern = r'(?i).*\b(бот|попиздяка)\b.*(сиськи|грудь|дыньки|буфера)\s*(?:расти|отрасти|увеличь|подрасти|накачай|больше|плюс)?.*'
-    application.add_handler(MessageHandler(filters.Regex(grow_tits_pattern) & filters.TEXT & ~filters.COMMAND, grow_tits))
-
-    my_tits_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:мои сиськи|моя грудь|какие у меня сиськи).*'
-    application.add_handler(MessageHandler(filters.Regex(my_tits_pattern) & filters.TEXT & ~filters.COMMAND, show_my_tits))
-
-    top_tits_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:топ сисек|рейтинг грудей|у кого самые большие сиськи).*'
-    application.add_handler(MessageHandler(filters.Regex(top_tits_pattern) & filters.TEXT & ~filters.COMMAND, show_tits_top))
-
 # Добавляем НОВЫЕ обработчики, которые требуют ОТВЕТА на сообщение
     application.add_handler(CommandHandler("pickup", get_pickup_line, filters=filters.REPLY)) # Только в ответе
     application.add_handler(CommandHandler("pickup_line", get_pickup_line, filters=filters.REPLY)) # Только в ответе
-    pickup_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:подкат|пикап|склей|познакомься|замути).*'
-    application.add_handler(MessageHandler(filters.Regex(pickup_pattern) & filters.TEXT & filters.REPLY & ~filters.COMMAND, get_pickup_line)) # Только в ответе
-    # --->>> КОНЕЦ ИЗМЕНЕНИЙ <<<---
-
-     # --->>> ИЗМЕНЯЕМ ОБРАБОТЧИКИ ПОХВАЛЫ <<<---
-    # Убираем старые CommandHandler("praise"...) и MessageHandler(praise_pattern...) если они были
     application.add_handler(CommandHandler("praise", praise_user, filters=filters.REPLY)) # Только в ответе
-    praise_pattern = r'(?i).*\b(бот|попиздяка)\b.*(?:похвали|молодец|красавчик)\s+(?:его|ее|этого|эту).*'
-    application.add_handler(MessageHandler(filters.Regex(praise_pattern) & filters.TEXT & filters.REPLY & ~filters.COMMAND, praise_user)) # Только в ответе
-    # --->>> КОНЕЦ ИЗМЕНЕНИЙ <<<---
-
-    gen_nick_pattern = r'(?i).*\b(бот|попиздяка)\b\s+(?:рандомный ник|случайный ник|любой ник|смени мне ник|давай ник|придумай ник|какой нибудь ник|какой-нибудь ник|новое имя|новое погоняло|сгенерируй ник|ник по высерам).*'
-    application.add_handler(MessageHandler(filters.Regex(gen_nick_pattern) & filters.TEXT & ~filters.COMMAND, generate_and_set_nickname))
-
-    list_chats_pattern = r'(?i).*\b(бот|попиздяка)\b\s+(?:список чатов|где ты есть|в каких чатах).*'
-    application.add_handler(MessageHandler(filters.Regex(list_chats_pattern) & filters.TEXT & ~filters.COMMAND, list_bot_chats))
 
     application.add_handler(CommandHandler("tos_battle", start_tos_battle))
     tos_battle_rus_pattern = r'(?i)^\s*/(?:пв_баттл|пв баттл|баттл пв)\b.*' # Начинается с / и затем команда
     application.add_handler(MessageHandler(filters.Regex(tos_battle_rus_pattern) & filters.COMMAND, start_tos_battle))
-    tos_battle_pattern = r'(?i).*\b(бот|попиздяка)\b\s+(?:пв баттл|правда или высер баттл|заруба в пв|tos battle).*'
-    application.add_handler(MessageHandler(filters.Regex(tos_battle_pattern) & filters.TEXT & ~filters.COMMAND, start_tos_battle))
 
     # Обработчик для кнопок баттла
     application.add_handler(CallbackQueryHandler(tos_battle_button_callback, pattern=r'^tosbattle_.*'))
 
-    # --->>> ДОБАВЛЯЕМ РУССКИЕ АНАЛОГИ ДЛЯ ТЕХРАБОТ <<<---
-    # Regex для ВКЛючения техработ
-    maint_on_pattern = r'(?i).*(?:бот|попиздяка).*(?:техработ|ремонт|на ремонт|обслуживание|админ вкл).*'
-    # Ловим ТОЛЬКО текст, БЕЗ команд, в ЛЮБОМ чате (проверка админа и ЛС будет ВНУТРИ функции)
-    application.add_handler(MessageHandler(filters.Regex(maint_on_pattern) & filters.TEXT & ~filters.COMMAND, maintenance_on)) # Вызываем ту же функцию!
-
-    # Regex для ВЫКЛючения техработ
-    maint_off_pattern = r'(?i).*(?:бот|попиздяка).*(?:работай|работать|кончил|закончил|ремонт окончен|админ выкл).*'
-    application.add_handler(MessageHandler(filters.Regex(maint_off_pattern) & filters.TEXT & ~filters.COMMAND, maintenance_off)) # Вызываем ту же функцию!
-    # --->>> КОНЕЦ ДОБАВЛЕНИЙ <<<---
-
-
     # Обработчик ответов боту (должен идти ПОСЛЕ regex для команд!)
     application.add_handler(MessageHandler(filters.TEXT & filters.REPLY & ~filters.COMMAND, reply_to_bot_handler))
 
-    # --->>> ВОТ ЭТИ ПЯТЬ СТРОК НУЖНЫ <<<---
-    # 1. Только для ТЕКСТА (без команд)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, store_message))
-    # 2. Только для ФОТО
-    application.add_handler(MessageHandler(filters.PHOTO, store_message))
-    # 3. Только для СТИКЕРОВ
-    application.add_handler(MessageHandler(filters.Sticker.ALL, store_message))
-    # 4. Только для ВИДЕО
-    application.add_handler(MessageHandler(filters.VIDEO, store_message))
-    # 5. Только для ГОЛОСА
-    application.add_handler(MessageHandler(filters.VOICE, store_message))
+    # --->>> СОХРАНЕНИЕ СООБЩЕНИЙ - ОТДЕЛЬНОЙ ГРУППОЙ <<<---
+    # Своя группа (раньше команд) и block=False: сообщения-команды тоже попадают в историю,
+    # а запись не ждет и не ждется хендлерами команд. Текст (без команд), фото, стикеры, видео, голос.
+    store_message_filter = (filters.TEXT & ~filters.COMMAND) | filters.PHOTO | filters.Sticker.ALL | filters.VIDEO | filters.VOICE
+    application.add_handler(MessageHandler(store_message_filter, store_message, block=False), group=STORE_MESSAGE_HANDLER_GROUP)
     # --->>> КОНЕЦ <<<---
 
     logger.info("Обработчики Telegram добавлены.")
+    instrument_handlers(application) # Время каждого хендлера в /metrics
+    update_processor.take_unordered_group(application, STORE_MESSAGE_HANDLER_GROUP) # Запись истории - мимо очереди чата
+    heartbeat_state["application"] = application # /healthz смотрит очередь апдейтов и поллинг
+    webhook_state["application"] = application # Вебхук кладет апдейты в ее update_queue
+    if application.job_queue: instrument_job_queue(application.job_queue)
 
     # Настройка и запуск Hypercorn + бота
     port = int(os.environ.get("PORT", 8080)); hypercorn_config = hypercorn.config.Config();
     hypercorn_config.bind = [f"0.0.0.0:{port}"]; hypercorn_config.worker_class = "asyncio"; hypercorn_config.shutdown_timeout = 60.0
     logger.info(f"Конфиг Hypercorn: {hypercorn_config.bind}, worker={hypercorn_config.worker_class}")
     logger.info("Запуск задач Hypercorn и Telegram бота...")
+    await warm_up_ionet_connection() # TLS + HTTP/2 до первого юзерского запроса
+    start_write_behind() # Фоновая запись сообщений пачками
+    await refresh_maintenance_flag("boot") # Флаг техработ в память до первого апдейта
+    maintenance_watcher_task = asyncio.create_task(maintenance_flag_watcher(), name="MaintenanceWatcherTask")
+    enable_slow_callback_logging(asyncio.get_running_loop())
+    loop_lag_task = asyncio.create_task(event_loop_lag_sampler(), name="EventLoopLagSampler")
+    if PROFILE_ON_BOOT_SECONDS > 0: asyncio.create_task(profile_on_boot(), name="BootProfiler")
     shutdown_event = asyncio.Event(); bot_task = asyncio.create_task(run_bot_async(application), name="TelegramBotTask")
-    server_task = asyncio.create_task(hypercorn_async_serve(app, hypercorn_config, shutdown_trigger=shutdown_event.wait), name="HypercornServerTask")
+    server_task = asyncio.create_task(hypercorn_async_serve(web_app, hypercorn_config, shutdown_trigger=shutdown_event.wait, mode="asgi"), name="HypercornServerTask")
 
     # Ожидание и обработка завершения
-    done, pending = await asyncio.wait([bot_task, server_task], return_when=asyncio.FIRST_COMPLETED)
-    logger.warning(f"Задача завершилась! Done: {done}, Pending: {pending}")
-    if server_task in pending: logger.info("Остановка Hypercorn..."); shutdown_event.set()
-    logger.info("Отмена остальных задач..."); [task.cancel() for task in pending]
-    await asyncio.gather(*pending, return_exceptions=True)
-    for task in done: # Проверка ошибок
-        logger.info(f"Проверка завершенной задачи: {task.get_name()}")
-        try: await task
-        except asyncio.CancelledError: logger.info(f"Задача {task.get_name()} отменена.")
-        except Exception as e: logger.error(f"Задача {task.get_name()} не удалась: {e}", exc_info=True)
+    try:
+        done, pending = await asyncio.wait([bot_task, server_task], return_when=asyncio.FIRST_COMPLETED)
+        logger.warning(f"Задача завершилась! Done: {done}, Pending: {pending}")
+        if server_task in pending: logger.info("Остановка Hypercorn..."); shutdown_event.set()
+        logger.info("Отмена остальных задач..."); [task.cancel() for task in pending]
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done: # Проверка ошибок
+            logger.info(f"Проверка завершенной задачи: {task.get_name()}")
+            try: await task
+            except asyncio.CancelledError: logger.info(f"Задача {task.get_name()} отменена.")
+            except Exception as e: logger.error(f"Задача {task.get_name()} не удалась: {e}", exc_info=True)
+    finally:
+        maintenance_watcher_task.cancel(); loop_lag_task.cancel()
+        await asyncio.gather(maintenance_watcher_task, loop_lag_task, return_exceptions=True)
+        # Бот уже остановлен - дописываем в Монгу всё, что висит в write-behind очереди
+        logger.info("Сброс write-behind очереди..."); await stop_write_behind()
+        await flush_title_announcements(application.bot) # Write-behind мог докинуть званий - поэтому после него
+        await async_mongo_client.close()
+        await ionet_http_client.aclose()
     logger.info("main() закончена.")
 
 # --- Точка входа в скрипт ---
@@ -5137,6 +7064,7 @@ if __name__ == "__main__":
         except Exception as e: logger.error(f"Не удалось создать шаблон .env: {e}")
     # Проверка ключей
     if not TELEGRAM_BOT_TOKEN or not IO_NET_API_KEY or not MONGO_DB_URL: logger.critical("ОТСУТСТВУЮТ КЛЮЧЕВЫЕ ПЕРЕМЕННЫЕ ОКРУЖЕНИЯ!"); exit(1)
+    connect_mongo() # Пинг, индексы, аудит - до старта лупа, как раньше при импорте
     # Запуск
     try: logger.info("Запускаю asyncio.run(main())..."); asyncio.run(main()); logger.info("asyncio.run(main()) завершен.")
     except Exception as e: logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА: {e}", exc_info=True); exit(1)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# bot.py читает ключи при импорте; в сеть при импорте не ходит (Монга - в connect_mongo() на старте)
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:test")
+os.environ.setdefault("IO_NET_API_KEY", "test")
+os.environ.setdefault("MONGO_DB_URL", "mongodb://127.0.0.1:1")
+os.environ.setdefault("ADMIN_USER_ID", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
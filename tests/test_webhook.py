@@ -0,0 +1,120 @@
+"""Вебхук Телеги: запросы через ASGI в web_app, настоящий Application поверх заглушки Bot API."""
+import asyncio
+import json
+
+import pytest
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+import bot
+
+GET_ME_BODY = json.dumps({
+    "ok": True, "result": {"id": 1, "is_bot": True, "first_name": "test", "username": "test_bot"},
+}).encode()
+UPDATE_BODY = json.dumps({"update_id": 4242}).encode()
+
+
+async def stub_bot_api(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Заглушка Bot API: на любой метод отвечает как getMe, держит keep-alive."""
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"): length = int(line.split(b":", 1)[1])
+            if length: await reader.readexactly(length)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                         + str(len(GET_ME_BODY)).encode() + b"\r\n\r\n" + GET_ME_BODY)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def asgi_call(method: str, headers: list, chunks: list[bytes], path: str = bot.TELEGRAM_WEBHOOK_PATH) -> int:
+    """Один HTTP-запрос в web_app без сервера, возвращает статус ответа."""
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    sent = []
+    async def receive(): return messages.pop(0) if messages else {"type": "http.disconnect"}
+    async def send(message): sent.append(message)
+    scope = {"type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+             "root_path": "", "query_string": b"", "headers": headers, "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80)}
+    await bot.web_app(scope, receive, send)
+    return next(message["status"] for message in sent if message["type"] == "http.response.start")
+
+
+def secret_headers(secret: str | None = None) -> list:
+    return [(b"x-telegram-bot-api-secret-token", (secret or bot.TELEGRAM_WEBHOOK_SECRET).encode())]
+
+
+@pytest.fixture(autouse=True)
+def webhook_mode(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_MODE", True)
+    monkeypatch.setitem(bot.webhook_state, "application", None)
+
+
+def run_with_application(scenario) -> None:
+    """Поднимает заглушку Bot API и Application без апдейтера, отдает сценарию очередь доставленных апдейтов."""
+    async def runner():
+        server = await asyncio.start_server(stub_bot_api, "127.0.0.1", 0)
+        base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/bot"
+        delivered: asyncio.Queue = asyncio.Queue()
+        async def capture(update: Update, context) -> None: await delivered.put(update)
+        application = Application.builder().token("1:test").base_url(base_url).updater(None).job_queue(None).build()
+        application.add_handler(TypeHandler(Update, capture))
+        try:
+            await application.initialize() # getMe уходит в заглушку
+            await application.start()
+            bot.webhook_state["application"] = application
+            await scenario(delivered)
+        finally:
+            bot.webhook_state["application"] = None
+            if application.running: await application.stop()
+            await application.shutdown()
+            server.close()
+            await server.wait_closed()
+    asyncio.run(runner())
+
+
+def test_not_ready_returns_503():
+    assert asyncio.run(asgi_call("POST", secret_headers(), [UPDATE_BODY])) == 503
+
+
+def test_get_returns_405():
+    assert asyncio.run(asgi_call("GET", secret_headers(), [b""])) == 405
+
+
+@pytest.mark.parametrize("headers", [[], secret_headers("nope")], ids=["missing", "wrong"])
+def test_bad_secret_returns_403(headers):
+    rejected_before = bot.webhook_state["rejected"]
+    assert asyncio.run(asgi_call("POST", headers, [UPDATE_BODY])) == 403
+    assert bot.webhook_state["rejected"] == rejected_before + 1
+
+
+def test_oversized_body_returns_413():
+    chunk = b" " * (bot.TELEGRAM_WEBHOOK_MAX_BODY_BYTES // 4)
+    assert asyncio.run(asgi_call("POST", secret_headers(), [chunk] * 5)) == 413
+
+
+@pytest.mark.parametrize("body", [b"{", b"null"], ids=["bad_json", "null"])
+def test_unparseable_update_returns_400_and_is_not_queued(body):
+    async def scenario(delivered):
+        assert await asgi_call("POST", secret_headers(), [body]) == 400
+        await asyncio.sleep(0.1)
+        assert delivered.empty()
+    run_with_application(scenario)
+
+
+def test_update_reaches_handler():
+    async def scenario(delivered):
+        assert await asgi_call("POST", secret_headers(), [UPDATE_BODY[:5], UPDATE_BODY[5:]]) == 200
+        update = await asyncio.wait_for(delivered.get(), timeout=5)
+        assert update.update_id == 4242
+        assert delivered.empty()
+    run_with_application(scenario)
+
+
+def test_webhook_path_goes_to_flask_without_webhook_mode(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_MODE", False)
+    assert asyncio.run(asgi_call("POST", secret_headers(), [UPDATE_BODY])) == 404